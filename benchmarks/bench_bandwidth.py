@@ -0,0 +1,131 @@
+"""全局带宽上限的精度和开销
+
+用 hls_server.py 提供片段，设置带宽上限后分别用线程引擎和异步引擎下载同一个播放列表，
+按上限下载完一半数据的时间点把上限改为 --change 倍（模拟运行中在设置里修改），分别输出前后两段
+稳定部分的实际速度（按已写入磁盘的字节数计算）与上限的偏差。最后测量不限速和限速时每次取令牌（每块数据一次）的CPU时间。
+
+    python3 benchmarks/bench_bandwidth.py --segments 160 --size 262144 --limit 2M --change 2
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def bytes_on_disk(save_path):
+    total = 0
+    for name in os.listdir(save_path):
+        if name.endswith('.ts'):
+            try:
+                total += os.path.getsize(os.path.join(save_path, name))
+            except OSError:
+                pass
+    return total
+
+
+def window_rate(samples, start, end):
+    """samples 中 [start, end] 时间段内写入磁盘的速度"""
+    inside = [(t, b) for t, b in samples if start <= t <= end]
+    if len(inside) < 2:
+        return 0
+    return (inside[-1][1] - inside[0][1]) / (inside[-1][0] - inside[0][0])
+
+
+def run_engine(engine, url, limit, change, segments, segment_size, threads):
+    """返回 (是否成功, 修改前的速度, 修改后的速度)
+
+    定时统计磁盘上的字节数，修改上限前后的过渡和结束时的收尾不计入，只取每段中间的稳定部分计算速度。
+    """
+    xd.settings['download_engine'] = engine
+    xd.settings['max_threads'] = threads
+    xd.settings['async_concurrency'] = threads
+    xd.settings['adaptive_concurrency'] = False
+    xd.bandwidth_limiter.configure(limit)
+    save_path = tempfile.mkdtemp(prefix='bench_bandwidth_')
+    half = segments * segment_size / 2
+    first_phase = half / limit
+    second_phase = half / (limit * change)
+    samples = []
+    stop = threading.Event()
+
+    def sample():
+        changed = False
+        while not stop.wait(0.1):
+            elapsed = time.perf_counter() - start
+            samples.append((elapsed, bytes_on_disk(save_path)))
+            if not changed and elapsed >= first_phase:
+                # 运行中修改上限
+                xd.bandwidth_limiter.configure(limit * change)
+                changed = True
+
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        stop.set()
+        sampler.join()
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+        xd.bandwidth_limiter.configure(0)
+    first = window_rate(samples, 0.3 * first_phase, first_phase)
+    second = window_rate(samples, first_phase + 0.3 * second_phase, first_phase + 0.8 * second_phase)
+    return ok, first, second
+
+
+def overhead(calls):
+    """每次 try_acquire 的CPU时间（微秒）"""
+    limiter = xd.BandwidthLimiter()
+    results = []
+    for rate in (0, 10 ** 12):
+        limiter.configure(rate)
+        start = time.process_time()
+        for _ in range(calls):
+            limiter.try_acquire(65536)
+        results.append((time.process_time() - start) / calls * 1e6)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=160)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='segment size in bytes')
+    parser.add_argument('--limit', default='2M', help='bandwidth limit per second, e.g. 500K or 2M')
+    parser.add_argument('--change', type=float, default=2.0, help='factor applied to the limit half way through')
+    parser.add_argument('--threads', type=int, default=20, help='download threads / async concurrency')
+    args = parser.parse_args()
+
+    limit = xd.parse_byte_size(args.limit)
+    server, url, _ = hls_server.start_server(hls_server.default_options(segments=args.segments, size=args.size))
+    try:
+        print(f"{args.segments} segments x {args.size // 1024} KB, {args.threads} workers, "
+              f"limit {limit / 1024:.0f} KB/s then {limit * args.change / 1024:.0f} KB/s")
+        print(f"{'engine':<8}{'first half KB/s':>17}{'error':>8}{'second half KB/s':>18}{'error':>8}")
+        engines = ['thread'] + (['async'] if xd.aiohttp is not None else [])
+        for engine in engines:
+            ok, first, second = run_engine(engine, url, limit, args.change, args.segments, args.size, args.threads)
+            if not ok:
+                print(f"{engine}: download failed")
+                continue
+            target = limit * args.change
+            print(f"{engine:<8}{first / 1024:>17.0f}{(first - limit) / limit * 100:>7.1f}%"
+                  f"{second / 1024:>18.0f}{(second - target) / target * 100:>7.1f}%")
+        unlimited, limited = overhead(200000)
+        print(f"try_acquire() per chunk: {unlimited:.2f} us unlimited, {limited:.2f} us limited")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""readinto 缓冲池与 iter_content 的内存对比
+
+用 hls_server.py 提供片段，分别用三种读取方式在独立的子进程中下载同一个播放列表：iter_content
+（settings['readinto'] 为 False）、urllib3 没有 readinto 所需的私有属性时的退回路径
+（URLLIB3_READINTO 为 False）和 readinto 缓冲池。输出峰值RSS、每下载四分之一片段时的RSS
+（稳定状态下应保持不变）、新分配的读缓冲区/数据块对象数、服务器看到的连接数和吞吐量；
+每种方式都检查实际使用的读取路径和每个片段的内容，不符合时报错退出。
+
+    python3 benchmarks/bench_buffers.py --segments 400 --size 4194304 --threads 20
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import urllib3
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def current_rss():
+    """当前RSS（MB），读取 /proc，其他系统返回None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+# 读取方式：(名称, settings['readinto'], URLLIB3_READINTO)
+READERS = (('iter_content', False, True), ('fallback', True, False), ('readinto pool', True, True))
+
+
+def run_child(url, reader, threads, segments, size):
+    """子进程：用一种读取方式下载，结果以JSON输出到stdout"""
+    _, readinto, supported = next(r for r in READERS if r[0] == reader)
+    xd.settings['readinto'] = readinto
+    xd.URLLIB3_READINTO = supported and xd.URLLIB3_READINTO
+    xd.settings['max_threads'] = threads
+    xd.settings['download_engine'] = 'thread'
+    xd.settings['adaptive_concurrency'] = False
+
+    # 统计给出的数据块数；iter_content 的每一块都是新分配的 bytes 对象
+    chunks = [0]
+    iter_response = xd._iter_response
+
+    def counting(response, chunk_size):
+        for chunk in iter_response(response, chunk_size):
+            chunks[0] += 1
+            yield chunk
+
+    xd._iter_response = counting
+
+    # 统计每个响应走的读取路径
+    paths = {'readinto': 0, 'iter_content': 0}
+    readinto_source = xd._readinto_source
+
+    def recording(response):
+        source = readinto_source(response)
+        paths['readinto' if source is not None else 'iter_content'] += 1
+        return source
+
+    xd._readinto_source = recording
+
+    samples = []
+    done_marks = {segments * n // 4 for n in range(1, 5)}
+
+    def progress(done, total):
+        if done in done_marks:
+            samples.append(current_rss())
+
+    save_path = tempfile.mkdtemp(prefix='bench_buffers_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, progress, lambda message: None)
+        elapsed = time.perf_counter() - start
+        names = [f for f in os.listdir(save_path) if f.endswith('.ts')]
+        total_bytes = sum(os.path.getsize(os.path.join(save_path, f)) for f in names)
+        expected = hashlib.sha1(hls_server.ts_payload(size)).hexdigest()
+        corrupt = 0
+        for name in names:
+            with open(os.path.join(save_path, name), 'rb') as f:
+                corrupt += hashlib.sha1(f.read()).hexdigest() != expected
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+    peak = xd.resource.getrusage(xd.resource.RUSAGE_SELF).ru_maxrss / 1024 if xd.resource else None
+    print(json.dumps({'ok': ok, 'elapsed': elapsed, 'bytes': total_bytes, 'peak': peak, 'samples': samples,
+                      'chunks': chunks[0], 'buffers': xd.buffer_pool.allocated, 'paths': paths,
+                      'files': len(names), 'corrupt': corrupt}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=400)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='segment size in bytes')
+    parser.add_argument('--threads', type=int, default=20, help='thread engine workers')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        url, reader = args.child.split(' ', 1)
+        run_child(url, reader, args.threads, args.segments, args.size)
+        return
+
+    options = hls_server.default_options(segments=args.segments, size=args.size)
+    print(f"{args.segments} segments x {args.size // 1024} KB, {args.threads} threads, "
+              f"chunk size {xd.settings.get('chunk_size', 1024)} KB")
+    print(f"{'reader':<14}{'peak RSS':>10}  {'RSS at 25/50/75/100%':<26}{'new buffers':>12}"
+          f"{'connections':>13}{'MB/s':>9}  path")
+    if not xd.URLLIB3_READINTO:
+        print(f"urllib3 {urllib3.__version__} lacks the private attributes readinto needs, "
+              "every reader uses iter_content")
+    failures = []
+    for label, readinto, supported in READERS:
+        # 每次运行一个新的服务器，分别统计连接数
+        server, url, stats = hls_server.start_server(options)
+        try:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--segments', str(args.segments),
+                                                                          '--size', str(args.size), '--threads', str(args.threads),
+                                     '--child', f'{url} {label}'],
+                                    stdout=subprocess.PIPE, check=True).stdout
+        finally:
+            server.shutdown()
+            server.server_close()
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if not result['ok']:
+            print(f"{label}: download failed")
+            failures.append(label)
+            continue
+        samples = '/'.join(f"{s:.0f}" if s is not None else '?' for s in result['samples'])
+        peak = f"{result['peak']:.0f} MB" if result['peak'] is not None else '?'
+        fast = readinto and supported and xd.URLLIB3_READINTO
+        allocations = result['buffers'] if fast else result['chunks']
+        path = 'readinto' if result['paths']['readinto'] else 'iter_content'
+        print(f"{label:<14}{peak:>10}  {samples + ' MB':<26}{allocations:>12}{stats.snapshot()['connections']:>13}"
+              f"{result['bytes'] / result['elapsed'] / 1024 / 1024:>9.1f}  {path}")
+        # 每个片段都应走预期的路径，内容与服务器提供的一致
+        if result['paths']['iter_content' if fast else 'readinto'] or result['files'] != args.segments \
+                or result['corrupt']:
+            print(f"{label}: paths {result['paths']}, {result['files']} files, {result['corrupt']} corrupt")
+            failures.append(label)
+    if failures:
+        sys.exit(f"check failed: {', '.join(failures)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""BYTERANGE 播放列表：合并Range请求与逐片段请求的对比
+
+用 hls_server.py 的 --byterange 模式（模拟首字节延迟），所有片段是同一个文件中
+首尾相接的字节范围。分别以每个片段一个请求和合并请求的方式下载，输出耗时和请求数。
+
+    python3 benchmarks/bench_byterange.py --segments 1000 --size 16384 --latency 0.1
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def run(url, merge_mb, stats):
+    xd.settings['range_merge_mb'] = merge_mb
+    save_path = tempfile.mkdtemp(prefix='bench_byterange_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        before = stats.snapshot()['segments']
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        return ok, time.perf_counter() - start, stats.snapshot()['segments'] - before
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=16 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.1, help='per-request latency in seconds')
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--merge-mb', type=int, default=16, help='range_merge_mb for the coalesced run')
+    args = parser.parse_args()
+
+    options = hls_server.default_options(segments=args.segments, size=args.size, latency=args.latency, byterange=True)
+    server, url, stats = hls_server.start_server(options)
+    segment_size = len(hls_server.ts_payload(args.size))
+
+    xd.settings['max_threads'] = args.threads
+    xd.settings['adaptive_concurrency'] = False
+
+    print(f'{args.segments} ranges x {segment_size} bytes, {args.latency * 1000:.0f} ms latency, {args.threads} threads')
+    print(f"{'mode':<14}{'requests':>10}{'seconds':>10}{'MB/s':>10}")
+    for label, merge_mb in (('per-segment', 0), ('coalesced', args.merge_mb)):
+        ok, elapsed, requests = run(url, merge_mb, stats)
+        print(f"{label:<14}{requests:>10}{elapsed:>10.2f}{args.segments * segment_size / elapsed / 1024 / 1024:>10.2f}"
+              f"{'' if ok else '  (FAILED)'}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""AES-128 片段流式解密速度
+
+用随机密钥加密一段随机数据，按不同的块大小调用 SegmentDecryptor，
+和一次性解密整段数据的速度对比。
+
+    python3 benchmarks/bench_decrypt.py --size 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+
+
+def encrypt(data, key, iv):
+    padding = 16 - len(data) % 16
+    padded = data + bytes([padding]) * padding
+    if xd.aes_backend == 'cryptography':
+        encryptor = xd.Cipher(xd.algorithms.AES(key), xd.modes.CBC(iv)).encryptor()
+        return encryptor.update(padded) + encryptor.finalize()
+    return xd.AES.new(key, xd.AES.MODE_CBC, iv).encrypt(padded)
+
+
+def decrypt_chunked(data, key, iv, chunk_size):
+    decryptor = xd.SegmentDecryptor(key, iv)
+    view = memoryview(data)
+    parts = [decryptor.update(view[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    parts.append(decryptor.finalize())
+    return b''.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=8, help='segment size in MB')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if xd.aes_backend is None:
+        sys.exit("Install 'cryptography' or 'pycryptodome' first.")
+
+    key, iv = os.urandom(16), os.urandom(16)
+    # 故意不对齐16字节，覆盖填充处理
+    plain = os.urandom(args.size * 1024 * 1024 - 5)
+    data = encrypt(plain, key, iv)
+
+    print(f'backend: {xd.aes_backend}, segment: {len(data) / 1024 / 1024:.1f} MB')
+    for chunk_size in (8 * 1024, 64 * 1024, 1024 * 1024, len(data)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = decrypt_chunked(data, key, iv, chunk_size)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert result == plain
+        label = 'whole segment' if chunk_size == len(data) else f'{chunk_size // 1024} KB chunks'
+        print(f'{label:>15}: {len(data) / best / 1024 / 1024:8.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
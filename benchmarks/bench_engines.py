@@ -0,0 +1,73 @@
+"""线程池引擎与异步引擎的吞吐量对比
+
+用 hls_server.py 模拟高延迟的CDN，分别用两种引擎下载同一个播放列表，
+输出每种引擎的耗时、片段/秒和MB/s。
+
+    python3 benchmarks/bench_engines.py --segments 400 --latency 0.2 --size 65536
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def run_engine(engine, url, workers):
+    xd.settings['download_engine'] = engine
+    xd.settings['max_threads'] = workers
+    xd.settings['async_concurrency'] = workers
+    save_path = tempfile.mkdtemp(prefix=f'bench_{engine}_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        elapsed = time.perf_counter() - start
+        total_bytes = sum(os.path.getsize(os.path.join(save_path, f))
+                          for f in os.listdir(save_path) if f.endswith('.ts'))
+        return ok, elapsed, total_bytes
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=400)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.2, help='per-request latency in seconds')
+    parser.add_argument('--threads', type=int, default=20, help='thread engine workers (GUI limit is 20)')
+    parser.add_argument('--concurrency', type=int, default=200, help='async engine concurrent requests')
+    parser.add_argument('--adaptive', action='store_true', help='let the adaptive controller pick the concurrency')
+    args = parser.parse_args()
+
+    options = hls_server.default_options(segments=args.segments, size=args.size, latency=args.latency)
+    server, url, _ = hls_server.start_server(options)
+
+    # 默认使用固定并发数，只比较引擎本身
+    xd.settings['adaptive_concurrency'] = args.adaptive
+
+    engines = [('thread', args.threads)]
+    if xd.aiohttp is not None:
+        engines.append(('async', args.concurrency))
+    else:
+        print('aiohttp is not installed, skipping the async engine')
+
+    print(f'{args.segments} segments x {args.size} bytes, {args.latency * 1000:.0f} ms latency')
+    print(f"{'engine':<8}{'workers':>9}{'seconds':>10}{'seg/s':>10}{'MB/s':>10}")
+    for engine, workers in engines:
+        ok, elapsed, total_bytes = run_engine(engine, url, workers)
+        print(f"{engine:<8}{workers:>9}{elapsed:>10.2f}{args.segments / elapsed:>10.1f}"
+              f"{total_bytes / elapsed / 1024 / 1024:>10.2f}{'' if ok else '  (FAILED)'}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
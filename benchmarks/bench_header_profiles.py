@@ -0,0 +1,75 @@
+"""按主机记住请求头方案前后的请求次数
+
+用 hls_server.py 的 --require-referer 模式（只接受以片段目录为 Referer 的第三种请求头方案），
+连续下载两次同一个播放列表：第一次从空的 header_profiles.json 开始，第二次使用第一次保存的方案。
+输出每次被403拒绝的片段请求数、成功的片段请求数和耗时；--no-cache 时不记录成功的方案，
+相当于原来每个片段都重新升级。
+
+    python3 benchmarks/bench_header_profiles.py --segments 200 --latency 0.05 --threads 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def run_once(url, stats):
+    before = stats.snapshot()
+    save_path = tempfile.mkdtemp(prefix='bench_header_profiles_')
+    try:
+        start = time.perf_counter()
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        after = stats.snapshot()
+        seen = {'rejected': after['forbidden'] - before['forbidden'], 'ok': after['segments'] - before['segments']}
+        return ok, time.perf_counter() - start, seen
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.05, help='per-request latency in seconds')
+    parser.add_argument('--threads', type=int, default=10, help='thread engine workers')
+    parser.add_argument('--no-cache', action='store_true', help='never remember the working profile')
+    args = parser.parse_args()
+
+    options = hls_server.default_options(segments=args.segments, size=args.size, latency=args.latency,
+                                         require_referer=True)
+    server, url, stats = hls_server.start_server(options)
+
+    xd.settings['max_threads'] = args.threads
+    xd.settings['download_engine'] = 'thread'
+    xd.settings['adaptive_concurrency'] = False
+    workdir = tempfile.mkdtemp(prefix='bench_header_profiles_cache_')
+    try:
+        print(f"{args.segments} segments x {args.size // 1024} KB, {args.latency * 1000:.0f} ms latency, "
+              f"{args.threads} threads, server accepts only the referer profile")
+        print(f"{'run':<14}{'rejected':>10}{'ok':>8}{'seconds':>10}")
+        xd.header_profiles = xd.HeaderProfileCache(os.path.join(workdir, 'header_profiles.json'))
+        if args.no_cache:
+            xd.header_profiles.remember = lambda url, profile: None
+        for label in ('first', 'repeat'):
+            ok, elapsed, seen = run_once(url, stats)
+            if not ok:
+                print(f"{label}: download failed")
+                continue
+            print(f"{label:<14}{seen['rejected']:>10}{seen['ok']:>8}{elapsed:>10.2f}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""HTTP/1.1 连接池与 HTTP/2 多路复用的对比
+
+在本地启动一个同时支持 h2 和 http/1.1（ALPN协商）的TLS服务器，用线程引擎分别以两种协议
+下载同一个播放列表，输出TCP+TLS握手次数（服务器看到的连接数）、平均/95分位首字节时间和吞吐量。
+需要 httpx[http2] 和 hypercorn（只有基准测试需要），证书用 cryptography 临时生成。
+
+    python3 benchmarks/bench_http2.py --segments 400 --latency 0.1 --size 262144 --threads 20
+"""
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+
+def make_certificate(directory):
+    """生成 127.0.0.1 的自签名证书，返回 (证书路径, 私钥路径)"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                           critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def make_app(segment_count, segment_size, latency, connections):
+    # 片段内容和播放列表与 hls_server.py 相同，只是由支持HTTP/2的ASGI服务器提供
+    payload = hls_server.ts_payload(segment_size)
+    playlist_body = ('\n'.join(hls_server.playlist_lines(segment_count, 4.0)) + '\n').encode()
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        # 每个客户端端口对应一次TCP+TLS握手
+        connections[scope['client'][1]] = scope['http_version']
+        if scope['path'].startswith('/index.m3u8'):
+            body = playlist_body
+        else:
+            # 模拟CDN的首字节延迟
+            await asyncio.sleep(latency)
+            body = payload
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(app, cert_path, key_path):
+    """在后台线程中运行 hypercorn，返回 (端口, 停止函数)"""
+    port = free_port()
+    config = Config()
+    config.bind = [f'127.0.0.1:{port}']
+    config.certfile = cert_path
+    config.keyfile = key_path
+    config.alpn_protocols = ['h2', 'http/1.1']
+    config.h2_max_concurrent_streams = 100
+    config.backlog = 1024
+    config.loglevel = 'ERROR'
+    config.accesslog = None
+
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete,
+                              args=(serve(app, config, shutdown_trigger=stop.wait),), daemon=True)
+    thread.start()
+    # 等待端口开始监听
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return port, lambda: loop.call_soon_threadsafe(stop.set)
+
+
+def run_protocol(http2, url, workers, cert_path, connections):
+    xd.settings['http2'] = http2
+    xd.settings['max_threads'] = workers
+    xd.settings['download_engine'] = 'thread'
+    xd.settings['adaptive_concurrency'] = False
+    xd.reset_http_session()
+    # REQUESTS_CA_BUNDLE 等环境变量会覆盖会话的 verify
+    xd.http_session.trust_env = False
+    xd.http_session.verify = cert_path
+    latencies = []
+    xd.http_session.hooks['response'].append(
+        lambda response, *args, **kwargs: latencies.append(response.elapsed.total_seconds())
+        if response.url.endswith('.ts') else None
+    )
+    connections.clear()
+    save_path = tempfile.mkdtemp(prefix='bench_http2_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        elapsed = time.perf_counter() - start
+        total_bytes = sum(os.path.getsize(os.path.join(save_path, f))
+                          for f in os.listdir(save_path) if f.endswith('.ts'))
+        return ok, elapsed, total_bytes, latencies, dict(connections)
+    finally:
+        xd.http_session.close()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=400)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.1, help='per-request latency in seconds')
+    parser.add_argument('--threads', type=int, default=20, help='thread engine workers')
+    args = parser.parse_args()
+
+    if xd.httpx is None:
+        sys.exit('httpx with HTTP/2 support is required: pip install httpx[http2]')
+
+    workdir = tempfile.mkdtemp(prefix='bench_http2_cert_')
+    connections = {}
+    try:
+        cert_path, key_path = make_certificate(workdir)
+        port, stop = start_server(make_app(args.segments, args.size, args.latency, connections),
+                                  cert_path, key_path)
+        url = f'https://127.0.0.1:{port}/index.m3u8'
+        print(f"{args.segments} segments x {args.size // 1024} KB, {args.latency * 1000:.0f} ms latency, "
+              f"{args.threads} threads")
+        print(f"{'protocol':<10}{'handshakes':>12}{'ttfb avg':>11}{'ttfb p95':>11}{'seconds':>10}{'seg/s':>9}{'MB/s':>9}")
+        for http2 in (False, True):
+            ok, elapsed, total_bytes, latencies, seen = run_protocol(http2, url, args.threads, cert_path, connections)
+            if not ok:
+                print(f"{'HTTP/2' if http2 else 'HTTP/1.1'}: download failed")
+                continue
+            versions = sorted(set(seen.values()))
+            p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+            print(f"{'HTTP/' + '+'.join(versions):<10}{len(seen):>12}"
+                  f"{statistics.mean(latencies) * 1000:>9.1f}ms{p95 * 1000:>9.1f}ms"
+                  f"{elapsed:>10.2f}{args.segments / elapsed:>9.1f}{total_bytes / elapsed / 1024 / 1024:>9.1f}")
+        stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
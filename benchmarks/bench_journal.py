@@ -0,0 +1,61 @@
+"""续传日志：重新运行大任务时识别已完成片段的耗时，以及批量写入下载结果的耗时
+
+    python3 benchmarks/bench_journal.py --segments 20000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+from bench_parse import make_playlist
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=20000)
+    args = parser.parse_args()
+
+    playlist = xd.parse_media_playlist(make_playlist(args.segments), 'https://cdn.example.com/hls/index.m3u8?t=1')
+    save_path = tempfile.mkdtemp(prefix='bench_journal_')
+    try:
+        journal = xd.SegmentJournal(save_path)
+        start = time.perf_counter()
+        journal.sync(playlist.segments)
+        first_sync = time.perf_counter() - start
+
+        record = xd.TransferRecord()
+        record.start()
+        record.update(b'\x47' * 188)
+        # 重新运行时只有磁盘上存在的片段文件算作已完成
+        for i in range(args.segments):
+            with open(os.path.join(save_path, f'{i:04d}.ts'), 'wb') as f:
+                f.write(b'\x47' * 188)
+        start = time.perf_counter()
+        for i in range(args.segments):
+            journal.record(i, 'done', f'{i:04d}.ts', record)
+        journal.flush()
+        recording = time.perf_counter() - start
+        journal.close()
+
+        # 重新运行：打开已有的日志并查询已完成的片段
+        start = time.perf_counter()
+        journal = xd.SegmentJournal(save_path)
+        completed = journal.sync(playlist.segments)
+        resume = time.perf_counter() - start
+        journal.close()
+        assert len(completed) == args.segments
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    print(f'{args.segments} segments')
+    print(f'first run registration:  {first_sync * 1000:.1f} ms')
+    print(f'recording results:       {recording * 1000:.1f} ms ({recording / args.segments * 1e6:.1f} us/segment)')
+    print(f'resume lookup:           {resume * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""直播录制的片段延迟
+
+用 hls_server.py 的 --live-window 模式模拟直播源（滑动窗口播放列表，每隔一个片段时长发布一个新片段，
+全部发布后加上 EXT-X-ENDLIST），用 record_live 录制，输出录制到/丢失的片段数，以及
+每个片段从出现在播放列表中到写入磁盘的延迟（record_live 自己的统计）和从服务器发布到写入磁盘的延迟。
+
+    python3 benchmarks/bench_live.py --segments 20 --duration 1 --window 4 --latency 0.1
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=1.0, help='segment duration in seconds')
+    parser.add_argument('--window', type=int, default=4, help='segments kept in the sliding window')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.1, help='per-request latency in seconds')
+    args = parser.parse_args()
+
+    options = hls_server.default_options(segments=args.segments, duration=args.duration, live_window=args.window,
+                                         size=args.size, latency=args.latency)
+    server, url, stats = hls_server.start_server(options)
+    started = stats.started
+
+    xd.settings['live_record'] = True
+    xd.settings['adaptive_concurrency'] = False
+    save_path = tempfile.mkdtemp(prefix='bench_live_')
+    messages = []
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, messages.append)
+        finished = time.time()
+
+        # 服务器发布片段的时间 -> 文件写入完成的时间
+        delays = []
+        for name in os.listdir(save_path):
+            if name.startswith('live-') and name.endswith('.ts'):
+                sequence = int(name[5:-3])
+                delays.append(os.path.getmtime(os.path.join(save_path, name)) - (started + sequence * args.duration))
+        delays.sort()
+
+        print(f"{args.segments} segments x {args.duration:.1f} s, window {args.window}, "
+              f"{args.latency * 1000:.0f} ms request latency, {finished - started:.1f} s total")
+        for message in messages:
+            if message.startswith(('Recording finished', 'Segment latency')) or 'window' in message:
+                print(message)
+        if delays:
+            print(f"Published -> on disk: mean {sum(delays) / len(delays):.2f} s, "
+                  f"p95 {delays[min(len(delays) - 1, int(0.95 * len(delays)))]:.2f} s, max {delays[-1]:.2f} s")
+        if not ok:
+            print("Recording reported failures")
+    finally:
+        server.shutdown()
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""合并方式的耗时对比：ffmpeg、native 和 parallel
+
+用ffmpeg生成一段真实的H.264/AAC视频并切成 --segment-seconds 秒的HLS片段，按下载任务目录的格式
+保存（0000.ts、0001.ts ... 和 playlist.m3u8），然后对每种合并方式和输出格式分别合并 --repeat 次，
+输出耗时居中的一次、输出文件大小，以及 parallel 用的进程数。--discontinuities 在播放列表中
+均匀插入 EXT-X-DISCONTINUITY 标记，检查 parallel 是否在这些位置分组。
+
+    python3 benchmarks/bench_merge.py --minutes 20 --workers 0,2,4
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+
+
+def make_job(workdir, minutes, segment_seconds, discontinuities):
+    """生成测试视频和任务目录，返回 (任务目录, 片段数)"""
+    source = os.path.join(workdir, 'source')
+    os.makedirs(source)
+    seconds = int(minutes * 60)
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=25', '-f', 'lavfi', '-i', 'sine=frequency=440',
+                    '-t', str(seconds), '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(25 * segment_seconds),
+                    '-c:a', 'aac', '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_list_size', '0',
+                    '-hls_segment_filename', 's%d.ts', 'source.m3u8'], cwd=source, check=True)
+    with open(os.path.join(source, 'source.m3u8')) as f:
+        names = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    job = os.path.join(workdir, 'job')
+    os.makedirs(job)
+    step = len(names) // (discontinuities + 1)
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{segment_seconds}', '#EXT-X-MEDIA-SEQUENCE:0']
+    for i, name in enumerate(names):
+        if discontinuities and i and i % step == 0 and i // step <= discontinuities:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines += [f'#EXTINF:{segment_seconds}.000,', name]
+        os.replace(os.path.join(source, name), os.path.join(job, f'{i:04d}.ts'))
+    lines.append('#EXT-X-ENDLIST')
+    with open(os.path.join(job, 'playlist.m3u8'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    shutil.rmtree(source)
+    return job, len(names)
+
+
+def run_merge(job, mode, workers, extension, repeat):
+    """返回 (是否成功, 耗时居中一次的秒数, 输出大小MB, 状态消息中的分组信息)"""
+    xd.settings['merge_mode'] = mode
+    xd.settings['merge_workers'] = workers
+    ts_files, _ = xd.merge_file_list(job)
+    output_file = os.path.join(job, f'output.{extension}')
+    times = []
+    ok = True
+    size = 0
+    plan = ''
+    for _ in range(repeat):
+        messages = []
+        start = time.perf_counter()
+        ok = xd.merge_ts_files(job, ts_files, output_file, messages.append) and ok
+        times.append(time.perf_counter() - start)
+        plan = next((m for m in messages if m.startswith('Merging') and 'parts' in m), plan)
+        if os.path.exists(output_file):
+            size = os.path.getsize(output_file) / 1024 / 1024
+            os.remove(output_file)
+    times.sort()
+    return ok, times[len(times) // 2], size, plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, default=20, help='length of the generated video')
+    parser.add_argument('--segment-seconds', type=int, default=4)
+    parser.add_argument('--discontinuities', type=int, default=0, help='EXT-X-DISCONTINUITY tags to insert')
+    parser.add_argument('--workers', default='0,2,4', help='comma-separated merge_workers values for parallel (0 = CPU count)')
+    parser.add_argument('--formats', default='mp4,ts', help='comma-separated output formats')
+    parser.add_argument('--repeat', type=int, default=3, help='merges per mode, the median is reported')
+    args = parser.parse_args()
+
+    if not xd.check_ffmpeg():
+        parser.error('ffmpeg is required to generate the test video')
+    workdir = tempfile.mkdtemp(prefix='bench_merge_')
+    try:
+        job, count = make_job(workdir, args.minutes, args.segment_seconds, args.discontinuities)
+        total = sum(os.path.getsize(os.path.join(job, name)) for name in xd.merge_file_list(job)[0])
+        print(f"{count} segments, {total / 1024 / 1024:.1f} MB, {args.discontinuities} discontinuities, "
+              f"{os.cpu_count()} CPUs")
+        runs = [('ffmpeg', 0), ('native', 0)]
+        runs += [('parallel', int(w)) for w in args.workers.split(',') if w.strip()]
+        print(f"{'mode':<14}{'format':>7}{'time s':>9}{'MB':>9}  parts")
+        for extension in [f.strip() for f in args.formats.split(',') if f.strip()]:
+            for mode, workers in runs:
+                ok, seconds, size, plan = run_merge(job, mode, workers, extension, args.repeat)
+                label = f"{mode} x{workers or os.cpu_count()}" if mode == 'parallel' else mode
+                print(f"{label:<14}{extension:>7}{seconds:>9.2f}{size:>9.1f}  {plan}{'' if ok else '  FAILED'}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""合并顺序：按播放列表和续传日志 vs 按文件名猜测序号
+
+生成一个有 --segments 个片段的任务目录（只有空文件，不需要网络和ffmpeg）：playlist.m3u8、
+按 --names 格式命名的片段文件、续传日志，以及 --stray 个不属于播放列表的 .ts 文件，
+然后分别用 list_ts_files（文件名中的序号）和 merge_file_list（播放列表的顺序）列出合并用的文件，
+输出耗时、顺序是否正确、混入的多余文件数和检测到的缺失片段数。缺失的片段有两种：
+--missing 个已完成片段的文件被删除，--failed 个片段在日志中记为失败但留下了文件。
+最后检查重新下载时（SegmentJournal.sync）被删除的片段是否会再次下载。
+
+    python3 benchmarks/bench_merge_order.py --segments 50000 --names suffixed --stray 3 --missing 2 --failed 2
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+
+# 片段文件名格式：download_ts_files 默认的序号文件名、CDN的原始文件名、序号后面还有版本号的文件名
+NAME_FORMATS = {
+    'index': '{i:04d}.ts',
+    'original': '720P_4000K_441496441_{i}.ts',
+    'suffixed': 'hls_720p_{i}_v1.ts',
+}
+
+
+def make_job(path, count, name_format, stray, missing, failed):
+    """返回 (按播放列表顺序应当合并的文件名, 被删除片段的序号, 失败片段的序号)"""
+    names = [name_format.format(i=i) for i in range(count)]
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+    for name in names:
+        lines += ['#EXTINF:4.000,', name]
+    lines.append('#EXT-X-ENDLIST')
+    with open(os.path.join(path, 'playlist.m3u8'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    # 创建顺序打乱，目录的列出顺序不代表片段顺序
+    for name in random.sample(names, len(names)):
+        open(os.path.join(path, name), 'wb').close()
+    for k in range(stray):
+        open(os.path.join(path, f'preview{k}.ts'), 'wb').close()
+
+    picked = random.sample(range(count), missing + failed)
+    removed = sorted(picked[:missing])
+    failures = sorted(picked[missing:])
+    journal = xd.SegmentJournal(path)
+    journal.sync(xd.load_saved_playlist(path, 'http://example.com/playlist.m3u8').segments)
+    for i, name in enumerate(names):
+        journal.record(i, 'failed' if i in failures else 'done', name)
+    journal.close()
+
+    for i in removed:
+        os.remove(os.path.join(path, names[i]))
+    skipped = set(picked)
+    return [name for i, name in enumerate(names) if i not in skipped], removed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=50000)
+    parser.add_argument('--names', choices=NAME_FORMATS, default='suffixed', help='segment file name format')
+    parser.add_argument('--stray', type=int, default=3, help='.ts files in the directory that are not segments')
+    parser.add_argument('--missing', type=int, default=2, help='segments deleted after the download')
+    parser.add_argument('--failed', type=int, default=2, help='failed segments that left a file behind')
+    parser.add_argument('--repeat', type=int, default=5, help='listings per method, the median is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    path = tempfile.mkdtemp(prefix='bench_merge_order_')
+    try:
+        expected, removed, failures = make_job(path, args.segments, NAME_FORMATS[args.names],
+                                               args.stray, args.missing, args.failed)
+        print(f"{args.segments} segments named like {NAME_FORMATS[args.names].format(i=12)}, "
+              f"{args.stray} stray .ts files, {len(removed)} segments deleted, {len(failures)} failed")
+        print(f"{'method':<16}{'time ms':>9}{'order':>8}{'stray':>7}{'missing':>9}")
+        methods = (
+            ('file names', lambda: (xd.list_ts_files(path), None)),
+            ('playlist', lambda: xd.merge_file_list(path)),
+        )
+        for label, list_files in methods:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                files, missing = list_files()
+                times.append(time.perf_counter() - start)
+            times.sort()
+            segments = [name for name in files if not name.startswith('preview')]
+            if missing is None:
+                found = 'n/a'
+            else:
+                found = 'ok' if missing == sorted(removed + failures) else f'wrong ({len(missing)})'
+            print(f"{label:<16}{times[len(times) // 2] * 1000:>9.1f}{'ok' if segments == expected else 'wrong':>8}"
+                  f"{len(files) - len(segments):>7}{found:>9}")
+
+        # 重新下载时，文件被删除的片段不能再被当作已完成
+        journal = xd.SegmentJournal(path)
+        try:
+            done = journal.sync(xd.load_saved_playlist(path, 'http://example.com/playlist.m3u8').segments)
+        finally:
+            journal.close()
+        again = [i for i in removed + failures if i not in done]
+        print(f"resume: {len(again)} of {len(removed) + len(failures)} missing segments are downloaded again"
+              f"{'' if len(again) == len(removed) + len(failures) else '  WRONG'}")
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""指标接口的开销
+
+用 hls_server.py 提供片段，下载同一个播放列表两次：一次不抓取指标，一次同时以 --scrape-hz 的频率
+抓取 /metrics（Prometheus 文本格式），输出两次的吞吐量、抓取的平均/最大耗时和响应大小，
+最后对照指标中的字节数、片段数和响应数检查计数是否与实际下载一致。
+
+    python3 benchmarks/bench_metrics.py --segments 400 --size 262144 --scrape-hz 10
+"""
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def download(url):
+    save_path = tempfile.mkdtemp(prefix='bench_metrics_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, lambda message: None)
+        elapsed = time.perf_counter() - start
+        total_bytes = sum(os.path.getsize(os.path.join(save_path, f))
+                          for f in os.listdir(save_path) if f.endswith('.ts'))
+        return ok, elapsed, total_bytes
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=400)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='segment size in bytes')
+    parser.add_argument('--threads', type=int, default=20, help='thread engine workers')
+    parser.add_argument('--scrape-hz', type=float, default=10.0, help='scrapes per second during the second run')
+    args = parser.parse_args()
+
+    server, url, _ = hls_server.start_server(hls_server.default_options(segments=args.segments, size=args.size))
+
+    xd.settings['max_threads'] = args.threads
+    xd.settings['download_engine'] = 'thread'
+    xd.settings['adaptive_concurrency'] = False
+    metrics_port = xd.start_metrics_server(free_port())
+    metrics_url = f'http://127.0.0.1:{metrics_port}/metrics'
+    try:
+        print(f"{args.segments} segments x {args.size // 1024} KB, {args.threads} threads")
+        ok, elapsed, total_bytes = download(url)
+        print(f"{'no scraping':<22}{total_bytes / elapsed / 1024 / 1024:>8.1f} MB/s")
+
+        scrapes = []
+        stop = threading.Event()
+
+        def scrape():
+            while not stop.wait(1 / args.scrape_hz):
+                start = time.perf_counter()
+                body = urllib.request.urlopen(metrics_url).read()
+                scrapes.append((time.perf_counter() - start, len(body)))
+
+        xd.metrics = xd.DownloadMetrics()
+        scraper = threading.Thread(target=scrape, daemon=True)
+        scraper.start()
+        ok, elapsed, total_bytes = download(url)
+        stop.set()
+        scraper.join()
+        print(f"{f'scraping at {args.scrape_hz:g} Hz':<22}{total_bytes / elapsed / 1024 / 1024:>8.1f} MB/s")
+        if scrapes:
+            print(f"{len(scrapes)} scrapes: mean {sum(t for t, _ in scrapes) / len(scrapes) * 1000:.2f} ms, "
+                  f"max {max(t for t, _ in scrapes) * 1000:.2f} ms, {scrapes[-1][1]} bytes")
+
+        snapshot = xd.metrics.snapshot()
+        responses = sum(sum(codes.values()) for codes in snapshot['responses'].values())
+        print(f"counted: {snapshot['downloaded_bytes']} bytes (on disk {total_bytes}), "
+              f"{snapshot['segments']['done']} segments done, {responses} responses, "
+              f"{snapshot['segment_duration_seconds']['count']} segment durations")
+        if not ok:
+            print("Download reported failures")
+    finally:
+        xd.stop_metrics_server()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
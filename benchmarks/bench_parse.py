@@ -0,0 +1,68 @@
+"""播放列表解析速度和内存占用
+
+生成一个包含指定数量片段的媒体播放列表，输出解析耗时（取多次中最快的一次）
+和解析结果每个片段占用的内存。
+
+    python3 benchmarks/bench_parse.py --segments 50000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+
+
+def make_playlist(count, with_byterange=False):
+    lines = ['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:1000',
+             '#EXT-X-KEY:METHOD=AES-128,URI="https://keys.example.com/key?id=1"']
+    for i in range(count):
+        if i and i % 1000 == 0:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append('#EXTINF:5.005,')
+        if with_byterange:
+            lines.append('#EXT-X-BYTERANGE:1048576')
+            lines.append('720P_4000K_441496441.ts')
+        else:
+            lines.append(f'720P_4000K_441496441_{i}.ts')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--byterange', action='store_true', help='use EXT-X-BYTERANGE entries into one file')
+    args = parser.parse_args()
+
+    content = make_playlist(args.segments, args.byterange)
+    url = 'https://cdn.example.com/hls/720p/index.m3u8?t=1700000000&token=abcdef'
+
+    best = None
+    for _ in range(args.repeat):
+        gc.collect()
+        start = time.perf_counter()
+        playlist = xd.parse_media_playlist(content, url)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert len(playlist.segments) == args.segments
+    del playlist
+
+    gc.collect()
+    tracemalloc.start()
+    playlist = xd.parse_media_playlist(content, url)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(playlist.segments) == args.segments
+
+    print(f'{args.segments} segments, {len(content) / 1024:.0f} KB playlist')
+    print(f'parse time:          {best * 1000:.1f} ms ({best / args.segments * 1e6:.2f} us/segment)')
+    print(f'memory per segment:  {current / args.segments:.0f} bytes (including URL strings)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""多任务调度：一个大任务和多个小任务，逐个下载与共用连接同时下载的对比
+
+两个 hls_server.py 实例（大任务和小任务的播放列表）模拟首字节延迟。输出全部完成的耗时和各任务从提交到完成的平均等待时间。
+
+    python3 benchmarks/bench_scheduler.py --small 5 --big-segments 400 --latency 0.05
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def run(jobs, max_jobs, connections):
+    xd.settings['max_threads'] = connections
+    scheduler = xd.JobScheduler(connections, max_jobs)
+    root = tempfile.mkdtemp(prefix='bench_scheduler_')
+    finished = {}
+    start = time.perf_counter()
+
+    def job(share, n, url):
+        save_path = os.path.join(root, str(n))
+        xd.run_job(url, save_path, lambda message: None, lambda done, total: None,
+                   share=share)
+        finished[n] = time.perf_counter() - start
+
+    try:
+        for n, url in enumerate(jobs):
+            scheduler.submit(lambda share, n=n, url=url: job(share, n, url), str(n))
+        scheduler.wait()
+        return time.perf_counter() - start, finished
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--small', type=int, default=5, help='number of small jobs')
+    parser.add_argument('--small-segments', type=int, default=20)
+    parser.add_argument('--big-segments', type=int, default=400)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--connections', type=int, default=20)
+    args = parser.parse_args()
+
+    servers = {}
+    for segments in (args.big_segments, args.small_segments):
+        options = hls_server.default_options(segments=segments, size=args.size, latency=args.latency)
+        servers[segments] = hls_server.start_server(options)
+
+    xd.settings['adaptive_concurrency'] = False
+    # 大任务先提交
+    jobs = [servers[args.big_segments][1]] + [servers[args.small_segments][1]] * args.small
+
+    print(f'1 job x {args.big_segments} segments + {args.small} jobs x {args.small_segments} segments, '
+          f'{args.latency * 1000:.0f} ms latency, {args.connections} connections')
+    print(f"{'mode':<12}{'total s':>9}{'mean job s':>12}{'small jobs s':>14}")
+    for label, max_jobs in (('sequential', 1), ('shared', len(jobs))):
+        total, finished = run(jobs, max_jobs, args.connections)
+        small = [finished[n] for n in range(1, len(jobs))]
+        print(f"{label:<12}{total:>9.2f}{sum(finished.values()) / len(finished):>12.2f}"
+              f"{sum(small) / len(small):>14.2f}")
+
+    for server, _, _ in servers.values():
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""大片段拆分下载：按连接限速的服务器上，单连接与多连接下载同一批大片段的对比
+
+hls_server.py 对每个连接限速（--bandwidth，模拟CDN的单连接限速），支持HEAD和Range。
+stalls 列是测速线程报告的卡住的连接数：服务器没有卡住的连接，应当为0
+（拆分下载的片段本身不是一个连接，不能因为字节都计在各部分上而被当成卡住）。
+
+    python3 benchmarks/bench_split.py --segments 2 --size-mb 24 --rate-mb 4 --connections 4 --stall-seconds 1
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+
+def run(url, connections):
+    xd.settings['split_connections'] = connections
+    save_path = tempfile.mkdtemp(prefix='bench_split_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        messages = []
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, messages.append)
+        stalls = sum(1 for message in messages if message.startswith('Segment') and 'is stalled' in message)
+        return ok, time.perf_counter() - start, stalls
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=3)
+    parser.add_argument('--size-mb', type=int, default=8, help='segment size in MB')
+    parser.add_argument('--rate-mb', type=float, default=4, help='per-connection limit in MB/s')
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--stall-seconds', type=float, default=1, help='stall detection window')
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    options = hls_server.default_options(segments=args.segments, duration=60, size=size,
+                                         bandwidth=args.rate_mb * 1024 * 1024)
+    server, url, _ = hls_server.start_server(options)
+
+    xd.settings['split_threshold_mb'] = 1
+    xd.settings['adaptive_concurrency'] = False
+    xd.settings['stall_seconds'] = args.stall_seconds
+
+    total_mb = args.segments * args.size_mb
+    print(f'{args.segments} segments x {args.size_mb} MB, {args.rate_mb} MB/s per connection')
+    print(f"{'connections':<14}{'seconds':>10}{'MB/s':>10}{'stalls':>8}")
+    for connections in (1, args.connections):
+        ok, elapsed, stalls = run(url, connections)
+        print(f"{connections:<14}{elapsed:>10.2f}{total_mb / elapsed:>10.2f}{stalls:>8}{'' if ok else '  (FAILED)'}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""下载和合并流水线的吞吐量基准测试套件
+
+对每个场景启动一个本地HLS替身服务器（hls_server.py），在独立的子进程中运行真实的
+download_m3u8 -> download_ts_files -> merge_ts_files 流水线，以JSON输出 MB/s、片段/秒、
+片段耗时的 p50/p99、峰值RSS、合并耗时，以及服务器和客户端看到的403/429/断开/重试次数。
+保存结果后可以用 --compare 与之前的结果对比，判断改动让下载变快还是变慢。
+
+场景：baseline（无延迟不限速）、latency（50 ms首字节延迟）、bandwidth（每个连接2 MB/s）、
+referer（没有正确Referer时返回403）、throttle（周期性的429）、disconnect（5%的片段传输中断开）、
+stall（2%的片段以16 KB/s发送）。
+下载使用程序的默认设置（settings.json 不会被读取），合并使用原生TS拼接，不需要ffmpeg。
+
+    python3 benchmarks/bench_suite.py --output before.json
+    python3 benchmarks/bench_suite.py --compare before.json --scenarios baseline,latency
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+# 场景名 -> 服务器选项
+SCENARIOS = {
+    'baseline': {},
+    'latency': {'latency': 0.05},
+    'bandwidth': {'bandwidth': 2 * 1024 * 1024},
+    'referer': {'require_referer': True},
+    'throttle': {'throttle_every': 25, 'throttle_burst': 3},
+    'disconnect': {'disconnect_rate': 0.05},
+    'stall': {'slow_rate': 0.02},
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_pipeline(url, engine, threads):
+    """子进程：运行一次完整的下载和合并，返回结果字典"""
+    xd.settings['download_engine'] = engine
+    xd.settings['max_threads'] = threads
+    xd.settings['merge_mode'] = 'native'
+    xd.settings['merge_format'] = 'ts'
+
+    # 记录每个片段的下载耗时（两种引擎、拆分和Range组都经过 segment_finished）
+    durations = []
+    segment_finished = xd.metrics.segment_finished
+
+    def timed(started, success):
+        if success:
+            durations.append(time.time() - started)
+        segment_finished(started, success)
+
+    xd.metrics.segment_finished = timed
+
+    workdir = tempfile.mkdtemp(prefix='bench_suite_')
+    # 请求头方案缓存写到临时目录，不影响也不依赖当前目录中的 header_profiles.json
+    xd.header_profiles = xd.HeaderProfileCache(os.path.join(workdir, 'header_profiles.json'))
+    save_path = os.path.join(workdir, 'job')
+    os.makedirs(save_path)
+    messages = []
+    try:
+        if not xd.download_m3u8(url, save_path, messages.append):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, lambda done, total: None, messages.append)
+        seconds = time.perf_counter() - start
+        ts_files, _ = xd.merge_file_list(save_path)
+        total_bytes = sum(os.path.getsize(os.path.join(save_path, name)) for name in ts_files)
+
+        output_file = os.path.join(save_path, 'output.ts')
+        merge_start = time.perf_counter()
+        merge_ok = xd.merge_ts_files(save_path, ts_files, output_file, messages.append)
+        merge_seconds = time.perf_counter() - merge_start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    snapshot = xd.metrics.snapshot()
+    peak = None
+    if xd.resource is not None:
+        peak = xd.resource.getrusage(xd.resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    return {
+        'ok': ok,
+        'segments': len(ts_files),
+        'bytes': total_bytes,
+        'seconds': round(seconds, 3),
+        'mb_s': round(total_bytes / seconds / 1024 / 1024, 2),
+        'segments_s': round(len(ts_files) / seconds, 1),
+        'latency_p50_ms': round(percentile(durations, 0.5) * 1000, 1) if durations else None,
+        'latency_p99_ms': round(percentile(durations, 0.99) * 1000, 1) if durations else None,
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+        'merge_ok': merge_ok,
+        'merge_seconds': round(merge_seconds, 3),
+        'client_retries': sum(snapshot['retries'].values()),
+        'client_errors': sum(sum(kinds.values()) for kinds in snapshot['errors'].values()),
+    }
+
+
+def run_scenario(name, args):
+    """启动该场景的服务器，在子进程中运行流水线 --repeat 次，返回耗时居中的一次"""
+    options = hls_server.default_options(segments=args.segments, size=args.size, **SCENARIOS[name])
+    runs = []
+    for _ in range(args.repeat):
+        server, url, stats = hls_server.start_server(options)
+        try:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', url,
+                 '--engine', args.engine, '--threads', str(args.threads)],
+                stdout=subprocess.PIPE, check=True
+            ).stdout
+        finally:
+            server.shutdown()
+            server.server_close()
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        result['server'] = stats.snapshot()
+        runs.append(result)
+    runs.sort(key=lambda run: run['seconds'])
+    result = dict(runs[len(runs) // 2], scenario=name)
+    if len(runs) > 1:
+        result['mb_s_runs'] = [run['mb_s'] for run in runs]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results, baseline=None):
+    previous = {result['scenario']: result for result in (baseline or {}).get('results', [])}
+    print(f"{'scenario':<12}{'MB/s':>8}{'seg/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>8}{'merge s':>9}"
+          f"{'retries':>9}  {'vs baseline' if previous else ''}")
+    for result in results:
+        line = (f"{result['scenario']:<12}{result['mb_s']:>8.1f}{result['segments_s']:>8.1f}"
+                f"{result['latency_p50_ms'] or 0:>9.1f}{result['latency_p99_ms'] or 0:>9.1f}"
+                f"{result['peak_rss_mb'] or 0:>8.0f}{result['merge_seconds']:>9.3f}{result['client_retries']:>9}")
+        old = previous.get(result['scenario'])
+        if old:
+            changes = []
+            for key, label in (('mb_s', 'MB/s'), ('latency_p99_ms', 'p99'), ('merge_seconds', 'merge')):
+                if old.get(key) and result.get(key) is not None:
+                    changes.append(f"{label} {(result[key] - old[key]) / old[key] * 100:+.1f}%")
+            line += '  ' + ', '.join(changes)
+        if not result['ok'] or not result['merge_ok']:
+            line += '  FAILED'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512 * 1024, help='segment size in bytes')
+    parser.add_argument('--engine', choices=('thread', 'async'), default='thread')
+    parser.add_argument('--threads', type=int, default=10, help='thread engine workers (default setting: 10)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the median run is reported')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_pipeline(args.child, args.engine, args.threads)))
+        return
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'segments': args.segments, 'size': args.size, 'engine': args.engine,
+                       'threads': args.threads, 'repeat': args.repeat},
+        'results': [],
+    }
+    for name in names:
+        report['results'].append(run_scenario(name, args))
+
+    print_table(report['results'], baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
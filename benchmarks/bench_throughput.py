@@ -0,0 +1,138 @@
+"""实时速度、剩余时间和卡住连接检测的准确性
+
+用 hls_server.py 提供每个连接限速的片段，下载时每秒读取任务的 ThroughputMeter：
+把瞬时速度和平滑速度与服务器每秒实际发出的字节数比较，并在完成25%/50%/75%时记录预计剩余时间，
+与实际剩余时间比较。然后让一部分片段以很低的速度发送，分别在打开和关闭卡住连接检测
+（stall_seconds）时下载，比较总耗时。
+
+    python3 benchmarks/bench_throughput.py --segments 200 --size 524288 --bandwidth 1M --threads 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+import xxxhub_downloader as xd
+import hls_server
+
+meters = []
+
+
+class RecordingMeter(xd.ThroughputMeter):
+    """记录下载任务创建的测速对象，供采样线程读取"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        meters.append(self)
+
+
+xd.ThroughputMeter = RecordingMeter
+
+
+def download(url, progress=None):
+    save_path = tempfile.mkdtemp(prefix='bench_throughput_')
+    try:
+        if not xd.download_m3u8(url, save_path):
+            raise RuntimeError('failed to download playlist')
+        start = time.perf_counter()
+        ok = xd.download_ts_files(url, save_path, progress or (lambda done, total: None), lambda message: None)
+        return ok, time.perf_counter() - start
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+
+def accuracy(args, bandwidth):
+    """返回 (速度采样 [(服务器速度, 瞬时速度, 平滑速度)], ETA采样 [(完成比例, 预计, 实际)], 总耗时)"""
+    options = hls_server.default_options(segments=args.segments, size=args.size, bandwidth=bandwidth)
+    server, url, stats = hls_server.start_server(options)
+    meters.clear()
+    speed_samples = []
+    eta_samples = []
+    marks = {args.segments * n // 4: n / 4 for n in (1, 2, 3)}
+    stop = threading.Event()
+
+    def sample():
+        last = (time.monotonic(), stats.snapshot()['bytes'])
+        while not stop.wait(1):
+            now, sent = time.monotonic(), stats.snapshot()['bytes']
+            if meters and meters[-1].ewma:
+                speed_samples.append(((sent - last[1]) / (now - last[0]), meters[-1].rate, meters[-1].ewma))
+            last = (now, sent)
+
+    def progress(done, total):
+        if done in marks and meters:
+            eta_samples.append((marks.pop(done), meters[-1].eta(), time.perf_counter()))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    try:
+        sampler.start()
+        ok, elapsed = download(url, progress)
+        finished = time.perf_counter()
+    finally:
+        stop.set()
+        server.shutdown()
+    if not ok:
+        raise RuntimeError('download failed')
+    etas = [(fraction, predicted, finished - at) for fraction, predicted, at in eta_samples]
+    # 前两秒是慢启动，不计入
+    return speed_samples[2:], etas, elapsed
+
+
+def stall_run(args, bandwidth, stall_seconds):
+    options = hls_server.default_options(segments=args.segments, size=args.size, bandwidth=bandwidth,
+                                         slow_rate=args.slow_rate, slow_bandwidth=args.slow_bandwidth)
+    server, url, stats = hls_server.start_server(options)
+    xd.settings['stall_seconds'] = stall_seconds
+    try:
+        ok, elapsed = download(url)
+    finally:
+        server.shutdown()
+    return ok, elapsed, stats.snapshot()['slow'], meters[-1].stalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512 * 1024, help='segment size in bytes')
+    parser.add_argument('--bandwidth', default='1M', help='server bandwidth per connection, e.g. 500K or 1M')
+    parser.add_argument('--threads', type=int, default=8, help='thread engine workers')
+    parser.add_argument('--slow-rate', type=float, default=0.05, help='fraction of segments sent slowly')
+    parser.add_argument('--slow-bandwidth', type=int, default=16 * 1024, help='bytes per second of slow segments')
+    parser.add_argument('--stall-seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    bandwidth = xd.parse_byte_size(args.bandwidth)
+    xd.settings['download_engine'] = 'thread'
+    xd.settings['max_threads'] = args.threads
+    xd.settings['adaptive_concurrency'] = False
+    xd.settings['show_speed'] = False
+    xd.header_profiles = xd.HeaderProfileCache(os.path.join(tempfile.gettempdir(), 'bench_throughput_profiles.json'))
+    print(f"{args.segments} segments x {args.size // 1024} KB, {args.threads} threads, "
+          f"{bandwidth / 1024:.0f} KB/s per connection")
+
+    speeds, etas, elapsed = accuracy(args, bandwidth)
+    if speeds:
+        rate_error = sum(abs(rate - actual) / actual for actual, rate, _ in speeds) / len(speeds)
+        ewma_error = sum(abs(ewma - actual) / actual for actual, _, ewma in speeds) / len(speeds)
+        actual = sum(actual for actual, _, _ in speeds) / len(speeds)
+        print(f"server sent {actual / 1024 / 1024:.2f} MB/s on average; mean error of the instantaneous "
+              f"speed {rate_error * 100:.1f}%, of the smoothed speed {ewma_error * 100:.1f}% ({len(speeds)} samples)")
+    for fraction, predicted, actual in etas:
+        shown = f"{predicted:.1f} s" if predicted is not None else 'unknown'
+        print(f"ETA at {fraction:.0%}: predicted {shown}, actual {actual:.1f} s")
+
+    print(f"{'stall detection':<18}{'time s':>8}{'slow responses':>16}{'restarted':>11}")
+    for stall_seconds in (0, args.stall_seconds):
+        ok, elapsed, slow, stalls = stall_run(args, bandwidth, stall_seconds)
+        label = f"{stall_seconds:g} s" if stall_seconds else 'off'
+        print(f"{label:<18}{elapsed:>8.1f}{slow:>16}{stalls:>11}{'' if ok else '  FAILED'}")
+
+
+if __name__ == '__main__':
+    main()
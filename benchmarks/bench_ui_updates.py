@@ -0,0 +1,150 @@
+"""界面更新队列的开销和有界性
+
+模拟 --jobs 个任务同时下载，每个任务 --segments 个片段：每完成一个片段报告一次进度和一条状态消息，
+另有一个线程模拟 ffmpeg 合并时逐行输出的 --merge-lines 行。消费线程按 --hz 频率取出更新
+（与界面线程的做法相同），输出每次调用的耗时、刷新次数、每次刷新最多要显示的行数和进度项数，
+以及刷新结束后状态日志（只保留 status_log_lines 行）和日志文件的大小。
+
+有图形环境（DISPLAY）时再用真实的Tk窗口对比旧做法（每个事件一次 root.after 并插入文本）和更新队列：
+生产者全部结束后界面还需要多久才能处理完，以及文本控件中的行数。
+
+    python3 benchmarks/bench_ui_updates.py --jobs 4 --segments 20000 --hz 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import xxxhub_downloader as xd
+
+
+def produce(post_status, post_progress, jobs, segments, merge_lines):
+    """启动生产者线程并等待结束，返回每次调用的平均耗时（微秒）"""
+    def job(n):
+        for i in range(1, segments + 1):
+            post_progress(f'job{n}', i, segments)
+            post_status(f'[job{n}] Downloaded segment {i}/{segments}')
+
+    def merge():
+        for i in range(merge_lines):
+            post_status(f'frame={i} fps=0.0 q=-1.0 size={i * 188}kB time=00:00:{i % 60:02d}.00 speed=N/A')
+
+    threads = [threading.Thread(target=job, args=(n,)) for n in range(jobs)]
+    threads.append(threading.Thread(target=merge))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return elapsed / (jobs * segments * 2 + merge_lines) * 1e6
+
+
+def run_queue(args, log_path):
+    queue = xd.UiUpdateQueue(xd.settings['status_log_lines'], log_path)
+    shown = []  # 模拟的状态日志控件
+    frames = []  # 每次刷新的 (显示行数, 进度项数)
+    stop = threading.Event()
+
+    def consume():
+        while True:
+            finished = stop.wait(1 / args.hz)
+            messages, dropped, progress, calls = queue.drain()
+            if messages or progress:
+                frames.append((len(messages) + bool(dropped), len(progress)))
+                shown.extend(messages)
+                del shown[:-xd.settings['status_log_lines']]
+            if finished:
+                return
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    per_call = produce(queue.post_status, queue.post_progress, args.jobs, args.segments, args.merge_lines)
+    stop.set()
+    consumer.join()
+    return per_call, frames, len(shown)
+
+
+def run_tk(args, use_queue):
+    """真实的Tk窗口：返回 (生产者结束后界面追上所需的秒数, 文本控件的行数)"""
+    root = xd.tk.Tk()
+    text = xd.scrolledtext.ScrolledText(root)
+    text.pack()
+    label = xd.tk.Label(root)
+    label.pack()
+
+    if use_queue:
+        queue = xd.UiUpdateQueue(xd.settings['status_log_lines'], '')
+        xd.status_text = text
+
+        def show_progress(progress):
+            label.config(text=' '.join(f'{done_count}/{total}' for done_count, total in progress.values()))
+
+        queue.start(root, args.hz, xd.append_status_lines, show_progress)
+        post_status, post_progress, finish = queue.post_status, queue.post_progress, queue.call_soon
+    else:
+        def insert(message):
+            text.insert(xd.tk.END, message + '\n')
+            text.see(xd.tk.END)
+
+        def post_status(message):
+            root.after(0, lambda: insert(message))
+
+        def post_progress(key, done_count, total):
+            root.after(0, lambda: label.config(text=f'{done_count}/{total}'))
+
+        def finish(func):
+            root.after(0, func)
+
+    result = {}
+
+    def producer():
+        produce(post_status, post_progress, args.jobs, args.segments, args.merge_lines)
+        result['produced'] = time.perf_counter()
+        finish(root.quit)
+
+    threading.Thread(target=producer, daemon=True).start()
+    root.mainloop()
+    caught_up = time.perf_counter() - result['produced']
+    lines = int(text.index('end-1c').split('.')[0]) - 1
+    root.destroy()
+    return caught_up, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=20000, help='segments per job')
+    parser.add_argument('--merge-lines', type=int, default=20000, help='simulated ffmpeg output lines')
+    parser.add_argument('--hz', type=float, default=10.0, help='UI refresh rate')
+    args = parser.parse_args()
+
+    events = args.jobs * args.segments * 2 + args.merge_lines
+    print(f"{args.jobs} jobs x {args.segments} segments + {args.merge_lines} merge lines = {events} events, "
+          f"refresh at {args.hz:g} Hz, log widget keeps {xd.settings['status_log_lines']} lines")
+    log_dir = tempfile.mkdtemp(prefix='bench_ui_updates_')
+    log_path = os.path.join(log_dir, 'downloader.log')
+    try:
+        per_call, frames, shown = run_queue(args, log_path)
+        print(f"post per event: {per_call:.2f} us, {len(frames)} refreshes, "
+              f"max {max(f[0] for f in frames)} lines and {max(f[1] for f in frames)} progress items per refresh")
+        print(f"log widget: {shown} lines; log file: {os.path.getsize(log_path) / 1024 / 1024:.1f} MB")
+    finally:
+        for name in os.listdir(log_dir):
+            os.remove(os.path.join(log_dir, name))
+        os.rmdir(log_dir)
+
+    if xd.tk is None or (os.name == 'posix' and sys.platform != 'darwin' and not os.environ.get('DISPLAY')):
+        print("No display: skipping the Tk comparison")
+        return
+    print(f"{'Tk window':<22}{'catch-up s':>12}{'widget lines':>14}")
+    for use_queue in (False, True):
+        caught_up, lines = run_tk(args, use_queue)
+        print(f"{'update queue' if use_queue else 'root.after per event':<22}{caught_up:>12.2f}{lines:>14}")
+
+
+if __name__ == '__main__':
+    main()
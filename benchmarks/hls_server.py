@@ -0,0 +1,298 @@
+"""本地HLS替身服务器
+
+提供合成的媒体播放列表（/hls/index.m3u8）和TS片段（/hls/seg-<n>.ts），用于基准测试和手动测试，
+可以模拟CDN的各种行为：
+
+- 首字节延迟（--latency）和每个连接的带宽（--bandwidth，字节/秒，按小块发送）
+- 请求头检查（--require-referer）：没有以片段所在目录为 Referer 的请求返回403，
+  下载器的请求头回退（browser -> simple -> referer）最终成功
+- Range 请求（总是支持，返回206）和 HEAD 请求
+- BYTERANGE 播放列表（--byterange）：所有片段是 /hls/video.ts 中首尾相接的字节范围
+- 直播（--live-window N）：服务器启动后每隔一个片段时长发布一个新片段，播放列表只列出最近的N个，
+  全部发布后加上 EXT-X-ENDLIST
+- 429限流（--throttle-every N --throttle-burst M）：每N个片段请求之后的M个请求返回429
+- 传输中断开（--disconnect-rate）：按比例在发送一半内容后断开连接，同一片段的下一次请求正常返回
+- 卡住的连接（--slow-rate --slow-bandwidth）：按比例以很低的速度发送片段，同一片段的下一次请求正常返回
+
+随机行为使用固定的种子，同样的参数和请求顺序得到同样的结果。片段内容是以0x47开头的空TS包，
+可以通过片段校验和原生合并。各个基准测试通过 start_server 在进程内使用它，也可以单独运行：
+
+    python3 benchmarks/hls_server.py --port 8800 --segments 100 --latency 0.05 --require-referer
+"""
+import argparse
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TS_PACKET = b'\x47\x1f\xff\x10' + b'\xff' * 184  # 空包（PID 0x1FFF）
+
+
+def ts_payload(size):
+    """约 size 字节（188字节的整数倍，至少一个包）的TS片段内容"""
+    return TS_PACKET * max(1, size // len(TS_PACKET))
+
+
+def playlist_lines(segments, duration, first=0, end_list=True, byterange=None, name='seg-{i}.ts'):
+    """媒体播放列表的各行：序号 first 到 segments-1 的片段，byterange 为每个片段的字节数"""
+    lines = ['#EXTM3U', f'#EXT-X-VERSION:{4 if byterange else 3}', f'#EXT-X-TARGETDURATION:{math.ceil(duration)}',
+             f'#EXT-X-MEDIA-SEQUENCE:{first}']
+    for i in range(first, segments):
+        lines.append(f'#EXTINF:{duration:.3f},')
+        if byterange:
+            lines.append(f'#EXT-X-BYTERANGE:{byterange}')
+        lines.append(name.format(i=i))
+    if end_list:
+        lines.append('#EXT-X-ENDLIST')
+    return lines
+
+
+class ServerStats:
+    """服务器看到的请求情况，线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'segments': 0, 'ranges': 0, 'forbidden': 0, 'throttled': 0,
+                       'disconnects': 0, 'slow': 0, 'bytes': 0}
+        self.connections = set()
+        self.started = time.time()  # 服务器启动的时间，直播片段从此时开始发布
+
+    def add(self, key, value=1):
+        with self._lock:
+            self.counts[key] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts, connections=len(self.connections))
+
+
+def make_handler(options, stats):
+    """options 为 argparse.Namespace 或具有相同属性的对象（见 default_options）"""
+    payload = ts_payload(options.size)
+    if options.byterange:
+        # 所有片段是同一个文件中首尾相接的字节范围
+        playlist = playlist_lines(options.segments, options.duration, byterange=len(payload), name='video.ts')
+        payload = payload * options.segments
+    else:
+        playlist = playlist_lines(options.segments, options.duration)
+    playlist_body = ('\n'.join(playlist) + '\n').encode()
+
+    def live_playlist():
+        """直播的滑动窗口播放列表：按启动以来的时间计算已发布的片段"""
+        published = min(options.segments, int((time.time() - stats.started) / options.duration) + 1)
+        lines = playlist_lines(published, options.duration, first=max(0, published - options.live_window),
+                               end_list=published == options.segments)
+        return ('\n'.join(lines) + '\n').encode()
+
+    lock = threading.Lock()
+    rng = random.Random(options.seed)
+    state = {'segment_requests': 0, 'throttle_left': 0, 'cut': set()}
+
+    def decide(path):
+        """按请求顺序决定这次片段请求是否限流或断开（与网络时序无关的部分保持可重复）"""
+        with lock:
+            state['segment_requests'] += 1
+            if state['throttle_left'] > 0:
+                state['throttle_left'] -= 1
+                return 'throttle'
+            if options.throttle_every and state['segment_requests'] % options.throttle_every == 0:
+                state['throttle_left'] = options.throttle_burst - 1
+                return 'throttle'
+            # 同一片段只断开（或慢速发送）一次，重试时正常返回
+            if path in state['cut']:
+                return None
+            if options.disconnect_rate and rng.random() < options.disconnect_rate:
+                state['cut'].add(path)
+                return 'disconnect'
+            if options.slow_rate and rng.random() < options.slow_rate:
+                state['cut'].add(path)
+                return 'slow'
+            return None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_body(self, body, limit=None, bandwidth=None):
+            """按每个连接的带宽分块发送，limit 为断开前发送的字节数"""
+            end = len(body) if limit is None else limit
+            bandwidth = bandwidth or options.bandwidth
+            step = 64 * 1024
+            if bandwidth:
+                step = max(1024, min(step, int(bandwidth / 20)))
+            started = time.monotonic()
+            sent = 0
+            while sent < end:
+                chunk = body[sent:min(end, sent + step)]
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                stats.add('bytes', len(chunk))
+                if bandwidth:
+                    ahead = sent / bandwidth - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def reply(self, status, body=b'', headers=()):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def is_segment(self, path):
+            if options.byterange:
+                return path == '/hls/video.ts'
+            return path.startswith('/hls/seg-') and path.endswith('.ts')
+
+        def do_HEAD(self):
+            if not self.is_segment(self.path.split('?', 1)[0]):
+                self.reply(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp2t')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+
+        def do_GET(self):
+            stats.add('requests')
+            with stats._lock:
+                stats.connections.add(self.client_address)
+            path = self.path.split('?', 1)[0]
+            if path == '/hls/index.m3u8':
+                body = live_playlist() if options.live_window else playlist_body
+                self.reply(200, body, [('Content-Type', 'application/vnd.apple.mpegurl')])
+                return
+            if not self.is_segment(path):
+                self.reply(404)
+                return
+            # 首字节延迟对被拒绝的请求同样存在
+            if options.latency:
+                time.sleep(options.latency)
+            if options.require_referer:
+                expected = f'http://{self.headers.get("Host")}/hls/'
+                if self.headers.get('Referer') != expected:
+                    stats.add('forbidden')
+                    self.reply(403, b'Forbidden')
+                    return
+            action = decide(path)
+            if action == 'throttle':
+                stats.add('throttled')
+                self.reply(429, b'Too Many Requests', [('Retry-After', '0')])
+                return
+            stats.add('segments')
+
+            body = payload
+            status = 200
+            headers = [('Content-Type', 'video/mp2t'), ('Accept-Ranges', 'bytes')]
+            range_header = self.headers.get('Range')
+            if range_header and range_header.startswith('bytes='):
+                start_text, _, end_text = range_header[6:].partition('-')
+                try:
+                    start = int(start_text)
+                    end = int(end_text) if end_text else len(payload) - 1
+                except ValueError:
+                    start, end = 0, len(payload) - 1
+                if start >= len(payload):
+                    self.reply(416, b'', [('Content-Range', f'bytes */{len(payload)}')])
+                    return
+                end = min(end, len(payload) - 1)
+                body = payload[start:end + 1]
+                status = 206
+                headers.append(('Content-Range', f'bytes {start}-{end}/{len(payload)}'))
+                stats.add('ranges')
+
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if action == 'disconnect':
+                stats.add('disconnects')
+                self.send_body(body, len(body) // 2)
+                self.close_connection = True
+                return
+            if action == 'slow':
+                stats.add('slow')
+                self.send_body(body, bandwidth=options.slow_bandwidth)
+                return
+            self.send_body(body)
+
+        def handle(self):
+            try:
+                super().handle()
+            except (ConnectionResetError, BrokenPipeError):
+                pass  # 客户端提前关闭了连接
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def default_options(**overrides):
+    """与命令行参数默认值相同的选项，供其他脚本在进程内使用"""
+    options = build_parser().parse_args([])
+    for key, value in overrides.items():
+        if not hasattr(options, key):
+            raise TypeError(f"Unknown server option: {key}")
+        setattr(options, key, value)
+    return options
+
+
+class _Server(ThreadingHTTPServer):
+    # 默认的监听队列只有5个，异步引擎同时建立几十上百个连接时多出的SYN被丢弃，客户端要等1秒重传
+    request_queue_size = 1024
+
+
+def start_server(options, host='127.0.0.1', port=0):
+    """在后台线程中启动服务器，返回 (服务器, 播放列表地址, ServerStats)"""
+    stats = ServerStats()
+    server = _Server((host, port), make_handler(options, stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}/hls/index.m3u8', stats
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--size', type=int, default=512 * 1024, help='segment size in bytes')
+    parser.add_argument('--duration', type=float, default=4.0, help='segment duration in the playlist')
+    parser.add_argument('--latency', type=float, default=0.0, help='time to first byte in seconds')
+    parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second per connection, 0 = unlimited')
+    parser.add_argument('--require-referer', action='store_true',
+                        help='answer 403 unless the Referer is the segment directory')
+    parser.add_argument('--throttle-every', type=int, default=0, help='answer 429 after every N segment requests')
+    parser.add_argument('--throttle-burst', type=int, default=1, help='number of 429 answers in a row')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0,
+                        help='fraction of segments whose first response is cut off half way')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='fraction of segments whose first response is sent at --slow-bandwidth')
+    parser.add_argument('--slow-bandwidth', type=float, default=16 * 1024, help='bytes per second of slow responses')
+    parser.add_argument('--byterange', action='store_true',
+                        help='serve all segments as consecutive byte ranges of one file')
+    parser.add_argument('--live-window', type=int, default=0,
+                        help='live playlist: publish one segment per duration and list only the last N, 0 = VOD')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    server, url, stats = start_server(options, port=options.port)
+    print(f"Serving {options.segments} segments on {url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(10)
+    except KeyboardInterrupt:
+        print(stats.snapshot())
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
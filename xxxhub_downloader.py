@@ -1,5 +1,3 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, scrolledtext
 import os
 import requests
 import subprocess
@@ -9,11 +7,77 @@ import time
 import sys
 import platform
 import json
-from urllib.parse import urlparse
+import io
+import shutil
+import argparse
+from collections import deque
+from urllib.parse import urlparse, urljoin
 import datetime
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+from urllib3.response import HTTPResponse as Urllib3Response
+from urllib3.util.retry import Retry, RequestHistory
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
 import re
+import asyncio
+import contextvars
+import math
+import hashlib
+import sqlite3
+import mmap
+import importlib.util
+
+try:
+    import aiohttp
+except ImportError:
+    # 异步下载引擎为可选功能，未安装aiohttp时使用线程池引擎
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    # HTTP/2 为可选功能，未安装时所有请求使用HTTP/1.1连接池
+    httpx = None
+# httpx 的HTTP/2支持需要 h2（pip install httpx[http2]），由httpx自己导入，这里只检查是否已安装
+if httpx is not None and importlib.util.find_spec('h2') is None:
+    httpx = None
+
+try:
+    import resource
+except ImportError:
+    # Windows没有resource模块，不报告峰值内存
+    resource = None
+
+try:
+    import numpy as np
+except ImportError:
+    # 片段校验的可选加速，未安装numpy时使用纯Python实现
+    np = None
+
+# AES-128 解密优先使用 cryptography，其次 pycryptodome；都没有时无法下载加密的流
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    aes_backend = 'cryptography'
+except ImportError:
+    try:
+        from Crypto.Cipher import AES
+        aes_backend = 'pycryptodome'
+    except ImportError:
+        aes_backend = None
+
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk, scrolledtext
+except ImportError:
+    # 服务器等无图形环境可能没有tkinter，命令行模式不需要它
+    tk = None
+
+# 是否以图形界面模式运行（命令行模式下错误信息输出到stderr而不是弹窗）
+gui_mode = False
 
 # 检查ffmpeg是否安装
 def check_ffmpeg():
@@ -23,10 +87,202 @@ def check_ffmpeg():
     except:
         return False
 
-# 程序启动时检查
-if not check_ffmpeg():
-    messagebox.showerror("Error", "ffmpeg is not installed or not in PATH. Please install ffmpeg to use this program.")
-    sys.exit(1)
+def show_error(message):
+    """显示错误信息：GUI模式弹窗，命令行模式输出到stderr"""
+    if gui_mode:
+        messagebox.showerror("Error", message)
+    else:
+        print(f"Error: {message}", file=sys.stderr)
+
+def show_warning(message):
+    """显示警告信息：GUI模式弹窗，命令行模式输出到stderr"""
+    if gui_mode:
+        messagebox.showwarning("Warning", message)
+    else:
+        print(f"Warning: {message}", file=sys.stderr)
+
+# 添加设置变量
+settings = {
+    'last_directory': '',
+    'max_threads': 10,
+    'delete_ts_after_merge': False,
+    'chunk_size': 1024,
+    'readinto': True,  # 响应体直接读入可重复使用的缓冲区（不能时退回 iter_content）
+    'show_speed': True,
+    'use_original_filenames': False,
+    'download_engine': 'thread',  # thread: 线程池, async: asyncio + aiohttp
+    'async_concurrency': 100,
+    'adaptive_concurrency': True,
+    'streaming_output': '',  # '': 下载后再合并, 'ts': 边下载边追加到output.ts, 'mp4': 边下载边通过ffmpeg封装为output.mp4
+    'stream_buffer_mb': 256,
+    'merge_mode': 'ffmpeg',  # ffmpeg: concat demuxer, native: 内核态直接拼接片段, parallel: 分组后多个ffmpeg并行转封装
+    'merge_workers': 0,  # parallel 合并同时运行的ffmpeg进程数，0表示CPU核数
+    'merge_format': 'mp4',  # 合并输出的容器格式：mp4 或 ts
+    'variant_policy': 'highest',  # 主播放列表的版本选择：highest, lowest, resolution, bandwidth
+    'variant_target_height': 720,
+    'variant_max_kbps': 0,
+    'range_merge_mb': 16,  # BYTERANGE播放列表中首尾相接的片段合并为一次Range请求的最大字节数
+    'split_threshold_mb': 32,  # 超过该大小的片段拆分为多个Range请求并行下载
+    'split_connections': 4,  # 单个大片段的并行连接数，1表示不拆分
+    'validate_segments': True,  # 下载后检查MPEG-TS包结构，损坏的片段重新下载
+    'validate_retries': 2,
+    'max_jobs': 3,  # 同时运行的下载任务数
+    'max_connections': 20,  # 所有任务共用的片段请求连接数
+    'http2': False,  # https 请求通过 httpx 使用HTTP/2，同一主机的请求复用少量连接
+    'token_refresh': True,  # 片段地址的签名过期（连续多个片段返回401/403/410）时重新获取播放列表
+    'token_refresh_failures': 3,  # 判定为过期所需的连续失败片段数
+    'token_refresh_limit': 5,  # 每个任务最多刷新播放列表的次数
+    'token_refresh_wait': 120,  # 刷新失败后等待新地址（refresh_url.txt）的秒数，0表示不等待
+    'live_record': False,  # 没有 EXT-X-ENDLIST 的直播播放列表：持续轮询并录制新片段
+    'live_max_minutes': 0,  # 直播录制的时长上限，0表示不限制
+    'live_max_mb': 0,  # 直播录制的大小上限，0表示不限制
+    'bandwidth_limit_kb': 0,  # 所有下载共用的带宽上限（KB/s），0表示不限速
+    'bandwidth_burst_kb': 0,  # 令牌桶容量（KB），0表示使用上限的四分之一秒
+    'metrics_port': 0,  # 本地指标接口（/metrics 和 /metrics.json）的端口，0表示不启用
+    'stall_seconds': 10,  # 片段连接在这段时间内的速度远低于平均时重新连接，0表示不检测
+    'ui_refresh_hz': 10,  # 界面刷新进度和状态日志的频率
+    'status_log_lines': 1000,  # 状态日志控件保留的行数
+    'status_log_file': 'downloader.log'  # 完整的状态日志，'' 表示不写文件
+}
+
+# 加载上次使用的目录
+def load_settings():
+    try:
+        if os.path.exists('settings.json'):
+            with open('settings.json', 'r') as f:
+                loaded_settings = json.load(f)
+                settings.update(loaded_settings)
+    except:
+        pass  # 如果加载失败，使用默认设置
+
+# 保存设置
+def save_settings():
+    try:
+        with open('settings.json', 'w') as f:
+            json.dump(settings, f)
+    except:
+        pass
+
+# HTTP/2 不允许的逐跳请求头（requests 默认会带 Connection: keep-alive）
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'}
+
+class _HTTP2Body:
+    """把 httpx 的流式响应包装成 requests.Response.raw，iter_content、close 和重试记录的用法不变"""
+
+    def __init__(self, response, retries):
+        self._response = response
+        self.retries = retries
+        # extract_cookies_to_jar 从 _original_response.msg 读取 Set-Cookie
+        msg = http.client.HTTPMessage()
+        for name, value in response.headers.multi_items():
+            msg[name] = value
+        self._original_response = SimpleNamespace(msg=msg)
+
+    def stream(self, chunk_size, decode_content=True):
+        chunks = self._response.iter_bytes(chunk_size) if decode_content else self._response.iter_raw(chunk_size)
+        try:
+            yield from chunks
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ConnectionError(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def close(self):
+        self._response.close()
+
+    release_conn = close
+
+class HTTP2Adapter(BaseAdapter):
+    """通过 httpx 发送请求的 requests 适配器，服务器支持时使用HTTP/2
+
+    同一主机的并发请求复用少量连接上的多个流，不再是每个并发片段一次TCP+TLS握手。
+    状态码重试按 max_retries（与 HTTPAdapter 相同的 Retry）进行，返回普通的 requests.Response，
+    请求头回退、Range 和断点续传的代码不需要区分协议。需要走代理的请求交给 HTTPAdapter。
+    """
+
+    def __init__(self, max_retries, max_connections=10):
+        super().__init__()
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.fallback = HTTPAdapter(max_retries=max_retries, pool_connections=20, pool_maxsize=50)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, verify, cert):
+        """按证书设置复用 httpx 客户端（连接池）"""
+        key = (verify, cert if not isinstance(cert, list) else tuple(cert))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                limits = httpx.Limits(max_connections=self.max_connections,
+                                      max_keepalive_connections=self.max_connections)
+                # retries 只重试建立连接失败，对应 Retry 的 connect 重试
+                transport = httpx.HTTPTransport(http2=True, verify=verify, cert=cert, limits=limits,
+                                                retries=self.max_retries.total or 0)
+                client = httpx.Client(transport=transport, follow_redirects=False)
+                self._clients[key] = client
+            return client
+
+    @staticmethod
+    def _timeout(timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return httpx.Timeout(connect=connect, read=read, write=read, pool=None)
+        return httpx.Timeout(timeout, pool=None)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if select_proxy(request.url, proxies):
+            return self.fallback.send(request, stream, timeout, verify, cert, proxies)
+        
+        client = self._client(verify, cert)
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        retries = self.max_retries
+        while True:
+            try:
+                response = client.send(client.build_request(request.method, request.url, headers=headers,
+                                                            content=request.body, timeout=self._timeout(timeout)),
+                                       stream=True)
+            except httpx.ConnectTimeout as e:
+                raise requests.exceptions.ConnectTimeout(e, request=request)
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(e, request=request)
+            
+            retry_after = response.headers.get('Retry-After')
+            if not retries.is_retry(request.method, response.status_code, retry_after is not None):
+                break
+            # 与 urllib3 相同：记录这次的状态码，次数用完时抛出 RetryError
+            response.close()
+            history = RequestHistory(request.method, request.url, None, response.status_code, None)
+            retries = retries.new(total=retries.total - 1, history=retries.history + (history,))
+            if retries.is_exhausted():
+                raise requests.exceptions.RetryError(
+                    f"Max retries exceeded with url: {request.url} (too many {response.status_code} error responses)",
+                    request=request)
+            if retry_after is not None and retries.respect_retry_after_header:
+                time.sleep(retries.parse_retry_after(retry_after))
+            else:
+                time.sleep(retries.get_backoff_time())
+        
+        result = requests.Response()
+        result.status_code = response.status_code
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.encoding = get_encoding_from_headers(result.headers)
+        result.reason = response.reason_phrase
+        result.url = request.url
+        result.raw = _HTTP2Body(response, retries)
+        result.request = request
+        result.connection = self
+        extract_cookies_to_jar(result.cookies, request, result.raw)
+        return result
+
+    def close(self):
+        self.fallback.close()
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
 
 # 创建一个会话对象，用于连接复用
 def create_session():
@@ -45,11 +301,129 @@ def create_session():
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
+    # HTTP/2 需要TLS（ALPN协商），明文 http:// 仍使用HTTP/1.1
+    if settings.get('http2') and httpx is not None:
+        session.mount("https://", HTTP2Adapter(retry_strategy))
+    
     return session
 
 # 在程序开始时创建会话
 http_session = create_session()
 
+def reset_http_session():
+    """按当前设置（如HTTP/2开关）重新创建会话，之后的请求使用新的连接池
+
+    旧会话不主动关闭，正在进行的下载可以继续使用它的连接
+    """
+    global http_session
+    http_session = create_session()
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+def build_request_headers(url, profile='browser'):
+    """按请求头方案构造请求头：browser（完整浏览器头）、simple（最简头）、referer（以上级目录为Referer）"""
+    parsed_url = urlparse(url)
+    origin = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    
+    if profile == 'simple':
+        return {
+            'User-Agent': USER_AGENT,
+            'Accept': '*/*'
+        }
+    
+    if profile == 'referer':
+        # 使用路径的上一级目录作为Referer
+        possible_referer = f"{origin}/"
+        path_parts = parsed_url.path.split('/')
+        if len(path_parts) > 2:
+            referer_path = '/'.join(path_parts[:-1])
+            possible_referer = f"{origin}{referer_path}/"
+        return {
+            'User-Agent': USER_AGENT,
+            'Accept': '*/*',
+            'Referer': possible_referer,
+            'Origin': origin
+        }
+    
+    # 更完整的浏览器样式的请求头
+    return {
+        'User-Agent': USER_AGENT,
+        'Accept': '*/*',
+        'Accept-Language': 'en-US,en;q=0.9',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive',
+        'Referer': f"{origin}/",
+        'Origin': origin,
+        'Sec-Fetch-Dest': 'empty',
+        'Sec-Fetch-Mode': 'cors',
+        'Sec-Fetch-Site': 'same-origin',
+        'Pragma': 'no-cache',
+        'Cache-Control': 'no-cache'
+    }
+
+# 遇到403时依次尝试的请求头方案
+HEADER_PROFILES = ('browser', 'simple', 'referer')
+
+class HeaderProfileCache:
+    """记录每个主机/路径前缀上一次成功的请求头方案，之后的请求直接从该方案开始
+
+    该方案开始返回403时再按 HEADER_PROFILES 的顺序尝试其他方案。保存在 header_profiles.json 中，
+    下次下载同一CDN时不再浪费403请求。
+    """
+
+    MAX_ENTRIES = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._profiles = None  # 第一次使用时加载
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _prefix(url):
+        """主机加第一级路径，同一CDN上不同站点的规则可能不同"""
+        parsed_url = urlparse(url)
+        return f"{parsed_url.netloc}/{parsed_url.path.lstrip('/').split('/', 1)[0]}"
+
+    def _load(self):
+        if self._profiles is None:
+            self._profiles = {}
+            try:
+                with open(self.path, 'r') as f:
+                    loaded = json.load(f)
+                self._profiles.update((k, v) for k, v in loaded.items() if v in HEADER_PROFILES)
+            except (OSError, ValueError, AttributeError):
+                pass  # 文件不存在或损坏时从空缓存开始
+        return self._profiles
+
+    def order(self, url):
+        """按尝试顺序返回请求头方案：上次成功的方案在前"""
+        with self._lock:
+            preferred = self._load().get(self._prefix(url), 'browser')
+        return (preferred,) + tuple(profile for profile in HEADER_PROFILES if profile != preferred)
+
+    def preferred(self, url):
+        return self.order(url)[0]
+
+    def remember(self, url, profile):
+        """记录成功的方案，有变化时写入文件"""
+        prefix = self._prefix(url)
+        with self._lock:
+            profiles = self._load()
+            if profiles.get(prefix, 'browser') == profile:
+                return
+            profiles.pop(prefix, None)
+            profiles[prefix] = profile
+            while len(profiles) > self.MAX_ENTRIES:
+                del profiles[next(iter(profiles))]
+            try:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(profiles, f)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError:
+                pass
+
+header_profiles = HeaderProfileCache('header_profiles.json')
+
 def normalize_m3u8_url(url):
     """标准化 .m3u8 URL，处理带查询参数的情况"""
     # 验证URL格式
@@ -124,60 +498,410 @@ def normalize_m3u8_url(url):
         else:
             return f"{base_url}/index.m3u8"
 
-def download_m3u8(url, save_path):
-    """下载 .m3u8 文件"""
-    try:
-        # 添加更完整的浏览器样式的请求头
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Referer': f"{urlparse(url).scheme}://{urlparse(url).netloc}/",
-            'Origin': f"{urlparse(url).scheme}://{urlparse(url).netloc}",
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-origin',
-            'Pragma': 'no-cache',
-            'Cache-Control': 'no-cache'
-        }
+# m3u8 标签的属性列表，值可能带引号且包含逗号，如 CODECS="avc1.64001f,mp4a.40.2"
+_ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^",]*)')
+
+def parse_attribute_list(text):
+    """解析 m3u8 标签的属性列表，返回 {属性名: 值}（去掉引号）"""
+    return {key: value.strip('"') for key, value in _ATTRIBUTE_RE.findall(text)}
+
+def resolve_url(base_url, uri):
+    """把播放列表中的地址解析为完整URL；地址没有自己的查询参数时保留基准URL的查询参数（可能包含认证信息）"""
+    url = urljoin(base_url, uri)
+    query = urlparse(base_url).query
+    if query and '?' not in uri:
+        url = f"{url.split('?')[0]}?{query}"
+    return url
+
+class Variant:
+    """主播放列表（EXT-X-STREAM-INF）中的一个码率/分辨率版本"""
+    __slots__ = ('url', 'bandwidth', 'width', 'height', 'codecs')
+
+    def __init__(self, url, attributes):
+        self.url = url
+        self.bandwidth = int(attributes.get('BANDWIDTH') or 0)
+        self.codecs = attributes.get('CODECS', '')
+        self.width = self.height = 0
+        resolution = attributes.get('RESOLUTION', '')
+        if 'x' in resolution:
+            width, height = resolution.split('x', 1)
+            if width.isdigit() and height.isdigit():
+                self.width, self.height = int(width), int(height)
+
+    def describe(self):
+        parts = []
+        if self.height:
+            parts.append(f"{self.width}x{self.height}")
+        parts.append(f"{self.bandwidth // 1000} kbps")
+        if self.codecs:
+            parts.append(self.codecs)
+        return ", ".join(parts)
+
+def is_master_playlist(content):
+    return '#EXT-X-STREAM-INF' in content
+
+def parse_master_playlist(content, base_url):
+    """解析主播放列表，返回 Variant 列表"""
+    variants = []
+    attributes = None
+    for line in content.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attribute_list(line[len('#EXT-X-STREAM-INF:'):])
+        elif line and not line.startswith('#') and attributes is not None:
+            # 标签后的第一个非注释行是该版本的媒体播放列表地址
+            variants.append(Variant(resolve_url(base_url, line), attributes))
+            attributes = None
+    return variants
+
+def select_variant(variants, policy='highest', target_height=0, max_bandwidth=0):
+    """按策略选择版本
+
+    - highest: 码率最高
+    - lowest: 码率最低
+    - resolution: 高度最接近 target_height（相同时选码率高的）
+    - bandwidth: 不超过 max_bandwidth（bit/s）的最高码率，都超过时选码率最低的
+    """
+    def by_quality(v):
+        return (v.bandwidth, v.height)
+    
+    if policy == 'lowest':
+        return min(variants, key=by_quality)
+    if policy == 'resolution' and target_height:
+        return min(variants, key=lambda v: (abs(v.height - target_height), -v.bandwidth))
+    if policy == 'bandwidth' and max_bandwidth:
+        allowed = [v for v in variants if v.bandwidth <= max_bandwidth]
+        if allowed:
+            return max(allowed, key=by_quality)
+        return min(variants, key=by_quality)
+    return max(variants, key=by_quality)
+
+class Key:
+    """EXT-X-KEY：加密方式、密钥地址和IV，之后的片段共享同一个对象直到下一个 EXT-X-KEY"""
+    __slots__ = ('method', 'url', 'iv', 'keyformat')
+
+    def __init__(self, method, url, iv, keyformat):
+        self.method = method
+        self.url = url
+        self.iv = iv  # 16字节的bytes，未指定时为None（按媒体序列号生成）
+        self.keyformat = keyformat
+
+class InitSection:
+    """EXT-X-MAP：片段的初始化数据（fMP4等格式）"""
+    __slots__ = ('url', 'byterange')
+
+    def __init__(self, url, byterange):
+        self.url = url
+        self.byterange = byterange
+
+class Segment:
+    """媒体播放列表中的一个片段"""
+    __slots__ = ('uri', 'resolve', 'duration', 'sequence', 'byterange', 'key', 'init_section', 'discontinuity')
+
+    def __init__(self, uri, resolve, duration, sequence, byterange, key, init_section, discontinuity):
+        self.uri = uri  # 播放列表中的原始地址
+        self.resolve = resolve  # 整个播放列表共享的地址解析函数，完整URL在用到时才生成
+        self.duration = duration  # EXTINF时长（秒）
+        self.sequence = sequence  # 媒体序列号
+        self.byterange = byterange  # (长度, 偏移) 或 None
+        self.key = key  # Key 或 None（未加密）
+        self.init_section = init_section  # InitSection 或 None
+        self.discontinuity = discontinuity  # 该片段前是否有 EXT-X-DISCONTINUITY
+
+    @property
+    def url(self):
+        """解析后的完整URL"""
+        return self.resolve(self.uri)
+
+    @property
+    def filename(self):
+        """原始文件名（不含查询参数和路径）"""
+        return self.uri.split('?', 1)[0].rsplit('/', 1)[-1]
+
+class MediaPlaylist:
+    """解析后的媒体播放列表"""
+    __slots__ = ('url', 'version', 'target_duration', 'media_sequence', 'playlist_type', 'end_list', 'segments', 'keys')
+
+    def __init__(self, url):
+        self.url = url
+        self.version = 1
+        self.target_duration = 0
+        self.media_sequence = 0
+        self.playlist_type = ''
+        self.end_list = False
+        self.segments = []
+        self.keys = []  # 播放列表中出现过的所有 Key
+
+    @property
+    def total_duration(self):
+        return sum(segment.duration for segment in self.segments)
+
+    @property
+    def has_discontinuity(self):
+        return any(segment.discontinuity for segment in self.segments)
+
+def _parse_byterange(value):
+    """解析 <长度>[@<偏移>]，偏移缺省时返回None"""
+    length, _, offset = value.partition('@')
+    return int(length), (int(offset) if offset else None)
+
+def _make_url_resolver(playlist_url):
+    """返回把片段地址解析为完整URL的函数（播放列表有几万个片段时避免逐个调用urljoin）"""
+    parsed_url = urlparse(playlist_url)
+    origin = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    
+    # 获取基础URL（不包含文件名和查询参数）
+    base_path = parsed_url.path
+    if '.m3u8' in base_path:
+        base_path = '/'.join(base_path.split('/')[:-1]) + '/'
+    base_url = f"{origin}{base_path}"
+    
+    # 保存查询参数，可能包含认证信息
+    query_params = parsed_url.query
+    
+    def resolve(uri):
+        if uri.startswith('http'):
+            # 绝对URL
+            url = uri
+        elif uri.startswith('/'):
+            # 从域名根路径开始的URL
+            url = f"{origin}{uri}"
+        elif './' in uri:
+            # 包含 ./ 或 ../ 的相对路径
+            url = urljoin(base_url, uri)
+        else:
+            # 相对URL
+            url = f"{base_url}{uri}"
         
-        # 使用会话对象发送请求
-        response = http_session.get(url, headers=headers, timeout=15)
+        # 如果原始URL有查询参数，且片段URL没有，添加这些参数
+        if query_params and '?' not in url:
+            url = f"{url}?{query_params}"
+        return url
+    
+    return resolve
+
+def parse_media_playlist(content, playlist_url):
+    """把媒体播放列表解析为 MediaPlaylist
+
+    保留 EXTINF 时长、EXT-X-MEDIA-SEQUENCE、DISCONTINUITY、MAP、KEY 和 BYTERANGE 信息。
+    """
+    resolve = _make_url_resolver(playlist_url)
+    playlist = MediaPlaylist(playlist_url)
+    segments = playlist.segments
+    
+    # 作用于下一个片段的标签
+    duration = 0.0
+    byterange = None
+    discontinuity = False
+    # 作用于之后所有片段的标签
+    key = None
+    init_section = None
+    sequence = None
+    # 同一资源上一个字节范围的结束位置，用于没有写偏移的 BYTERANGE
+    range_end = {}
+    
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
         
-        # 如果遇到403错误，尝试使用不同的请求头
-        if response.status_code == 403:
-            # 尝试使用更简单的请求头
-            simple_headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Accept': '*/*'
-            }
-            response = http_session.get(url, headers=simple_headers, timeout=15)
-            
-            # 如果仍然是403，尝试从URL中提取Referer
-            if response.status_code == 403:
-                parsed_url = urlparse(url)
-                path_parts = parsed_url.path.split('/')
-                if len(path_parts) > 2:
-                    # 使用路径的上一级目录作为Referer
-                    referer_path = '/'.join(path_parts[:-1])
-                    possible_referer = f"{parsed_url.scheme}://{parsed_url.netloc}{referer_path}/"
-                    
-                    custom_headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'Accept': '*/*',
-                        'Referer': possible_referer,
-                        'Origin': f"{parsed_url.scheme}://{parsed_url.netloc}"
-                    }
-                    
-                    response = http_session.get(url, headers=custom_headers, timeout=15)
+        if line[0] != '#':
+            if sequence is None:
+                sequence = playlist.media_sequence
+            if byterange is not None:
+                length, offset = byterange
+                if offset is None:
+                    offset = range_end.get(line, 0)
+                range_end[line] = offset + length
+                byterange = (length, offset)
+            segments.append(Segment(line, resolve, duration, sequence, byterange, key, init_section, discontinuity))
+            sequence += 1
+            duration = 0.0
+            byterange = None
+            discontinuity = False
+        elif line.startswith('#EXTINF:'):
+            comma = line.find(',')
+            try:
+                duration = float(line[8:comma] if comma > 0 else line[8:])
+            except ValueError:
+                duration = 0.0
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byterange = _parse_byterange(line[17:])
+        elif line.startswith('#EXT-X-KEY:'):
+            attributes = parse_attribute_list(line[11:])
+            method = attributes.get('METHOD', 'NONE')
+            if method == 'NONE':
+                key = None
+            else:
+                iv = attributes.get('IV')
+                if iv:
+                    iv = bytes.fromhex(iv[2:] if iv[:2] in ('0x', '0X') else iv).rjust(16, b'\0')
+                key = Key(method, resolve(attributes['URI']) if 'URI' in attributes else None,
+                          iv or None, attributes.get('KEYFORMAT', 'identity'))
+                playlist.keys.append(key)
+        elif line.startswith('#EXT-X-MAP:'):
+            attributes = parse_attribute_list(line[11:])
+            map_range = None
+            if 'BYTERANGE' in attributes:
+                length, offset = _parse_byterange(attributes['BYTERANGE'])
+                map_range = (length, offset or 0)
+            init_section = InitSection(resolve(attributes.get('URI', '')), map_range)
+        elif line == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            playlist.media_sequence = int(line[22:])
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            playlist.target_duration = int(float(line[22:]))
+        elif line == '#EXT-X-ENDLIST':
+            playlist.end_list = True
+        elif line.startswith('#EXT-X-PLAYLIST-TYPE:'):
+            playlist.playlist_type = line[21:]
+        elif line.startswith('#EXT-X-VERSION:'):
+            playlist.version = int(line[15:])
+    
+    return playlist
+
+def load_saved_playlist(save_path, playlist_url=''):
+    """读取并解析保存在任务目录中的 playlist.m3u8，文件不存在时返回None"""
+    playlist_path = os.path.join(save_path, 'playlist.m3u8')
+    if not os.path.exists(playlist_path):
+        return None
+    with open(playlist_path, 'r', encoding='utf-8', errors='ignore') as f:
+        return parse_media_playlist(f.read(), playlist_url)
+
+class SegmentDecryptor:
+    """AES-128-CBC 流式解密：对 iter_content 给出的每一块直接解密，结束时去掉PKCS7填充"""
+
+    def __init__(self, key, iv):
+        if aes_backend == 'cryptography':
+            self._decrypt = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor().update
+        else:
+            self._decrypt = AES.new(key, AES.MODE_CBC, iv).decrypt
+        self._pending = b''
+
+    def update(self, data):
+        """解密完整的16字节块；最后一个完整块留到 finalize 去填充"""
+        if self._pending:
+            data = self._pending + data
+        usable = len(data) - len(data) % 16
+        if usable == len(data):
+            usable -= 16
+        if usable <= 0:
+            self._pending = bytes(data)
+            return b''
+        view = memoryview(data)
+        self._pending = bytes(view[usable:])
+        return self._decrypt(view[:usable])
+
+    def finalize(self):
+        if len(self._pending) != 16:
+            raise ValueError("Encrypted segment length is not a multiple of 16 bytes")
+        block = self._decrypt(self._pending)
+        padding = block[-1]
+        if not 1 <= padding <= 16 or block[-padding:] != bytes([padding]) * padding:
+            raise ValueError("Invalid PKCS7 padding, wrong key or IV?")
+        return block[:-padding]
+
+class KeyCache:
+    """任务内的密钥缓存：每个密钥地址只请求一次，多个下载线程可以同时使用"""
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._url_locks = {}
+
+    def get(self, url):
+        key = self._keys.get(url)
+        if key is not None:
+            return key
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+        # 同一个密钥只由一个线程下载，其他线程等待结果
+        with url_lock:
+            key = self._keys.get(url)
+            if key is None:
+                response = _fetch_with_header_fallback(url)
+                if response.status_code != 200:
+                    raise IOError(f"Failed to download key {url}: HTTP {response.status_code}")
+                key = response.content
+                if len(key) != 16:
+                    raise ValueError(f"Key {url} is {len(key)} bytes, expected 16")
+                self._keys[url] = key
+        return key
+
+    def cipher_for(self, segment):
+        """返回片段的 (密钥, IV)；未加密或不是AES-128时返回None
+
+        没有显式IV时，按规范使用媒体序列号（大端128位整数）作为IV
+        """
+        key = segment.key
+        if key is None or key.method != 'AES-128':
+            return None
+        iv = key.iv or segment.sequence.to_bytes(16, 'big')
+        return self.get(key.url), iv
+
+def _fetch_with_header_fallback(url):
+    """请求播放列表、密钥等小文件，遇到403时依次尝试其他请求头方案（从该主机上次成功的方案开始）"""
+    # 路径只有一级时基于路径的Referer与完整浏览器头相同
+    short_path = len(urlparse(url).path.split('/')) <= 2
+    for profile in header_profiles.order(url):
+        if profile == 'referer' and short_path:
+            continue
+        response = http_session.get(url, headers=build_request_headers(url, profile), timeout=15)
+        if response.status_code != 403:
+            if response.status_code == 200:
+                header_profiles.remember(url, profile)
+            break
+    
+    return response
+
+def fetch_media_playlist(url, save_path, status_callback=None):
+    """请求播放列表，如果是主播放列表，按 variant_policy 设置选择一个版本再请求它的媒体播放列表
+
+    返回 (媒体播放列表的URL, 响应)；主播放列表保存为任务目录中的 master.m3u8
+    """
+    response = _fetch_with_header_fallback(url)
+    
+    # 主播放列表：选择一个版本，再下载它的媒体播放列表
+    for _ in range(3):
+        if response.status_code != 200 or not is_master_playlist(response.text):
+            break
+        variants = parse_master_playlist(response.text, url)
+        if not variants:
+            break
+        
+        with open(os.path.join(save_path, 'master.m3u8'), 'w', encoding='utf-8') as f:
+            f.write(response.text)
+        
+        variant = select_variant(
+            variants,
+            settings.get('variant_policy', 'highest'),
+            target_height=settings.get('variant_target_height', 720),
+            max_bandwidth=settings.get('variant_max_kbps', 0) * 1000
+        )
+        if status_callback:
+            status_callback(f"Master playlist with {len(variants)} variants: "
+                            + "; ".join(v.describe() for v in sorted(variants, key=lambda v: -v.bandwidth)))
+            status_callback(f"Selected variant ({settings.get('variant_policy', 'highest')}): {variant.describe()}")
+        url = variant.url
+        response = _fetch_with_header_fallback(url)
+    
+    return url, response
+
+def download_m3u8(url, save_path, status_callback=None):
+    """下载 .m3u8 文件
+
+    如果是主播放列表，按 variant_policy 设置选择一个版本，保存的是该版本的媒体播放列表。
+    成功时返回媒体播放列表的URL（片段地址以它为基准解析），失败返回False
+    """
+    try:
+        url, response = fetch_media_playlist(url, save_path, status_callback)
         
         if response.status_code == 200:
             # 检查内容是否看起来像m3u8文件
             content = response.text
             if not ('#EXTM3U' in content or '.ts' in content):
-                messagebox.showwarning("Warning", "Downloaded content doesn't look like a valid m3u8 file")
+                show_warning("Downloaded content doesn't look like a valid m3u8 file")
             
             # 检查是否已存在playlist.m3u8文件
             playlist_path = os.path.join(save_path, 'playlist.m3u8')
@@ -186,7 +910,7 @@ def download_m3u8(url, save_path):
                 try:
                     os.remove(playlist_path)
                 except Exception as e:
-                    messagebox.showerror("Error", f"Could not replace existing playlist file: {str(e)}")
+                    show_error(f"Could not replace existing playlist file: {str(e)}")
                     return False
             
             # 尝试检测编码并保存文件
@@ -212,249 +936,2428 @@ def download_m3u8(url, save_path):
                 with open(playlist_path, 'wb') as f:
                     f.write(response.content)
             
-            return True
+            return url
         elif response.status_code == 403:
-            messagebox.showerror("Error", "Access forbidden (HTTP 403). The server is blocking access to this resource. Try using a different URL or check if the site requires authentication.")
+            show_error("Access forbidden (HTTP 403). The server is blocking access to this resource. Try using a different URL or check if the site requires authentication.")
             return False
         elif response.status_code == 410:
             # 特别处理410错误
-            messagebox.showerror("Error", "The URL has expired (HTTP 410 Gone). Please get a fresh URL and try again.")
+            show_error("The URL has expired (HTTP 410 Gone). Please get a fresh URL and try again.")
             return False
         else:
-            messagebox.showerror("Error", f"Failed to download m3u8 file. Status code: {response.status_code}")
+            show_error(f"Failed to download m3u8 file. Status code: {response.status_code}")
             return False
     except Exception as e:
-        messagebox.showerror("Error", f"An error occurred: {str(e)}")
+        show_error(f"An error occurred: {str(e)}")
         return False
 
-def download_single_ts(ts_url, ts_file_path, max_retries=3, chunk_size=None):
-    """下载单个 .ts 文件，支持重试和断点续传"""
-    if chunk_size is None:
-        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
-        
-    # 添加更完整的浏览器样式的请求头
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': '*/*',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive',
-        'Referer': f"{urlparse(ts_url).scheme}://{urlparse(ts_url).netloc}/",
-        'Origin': f"{urlparse(ts_url).scheme}://{urlparse(ts_url).netloc}",
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-origin',
-        'Pragma': 'no-cache',
-        'Cache-Control': 'no-cache'
-    }
-    
-    # 检查文件是否已部分下载
-    file_size = 0
-    if os.path.exists(ts_file_path):
-        file_size = os.path.getsize(ts_file_path)
-        if file_size > 0:  # 文件已存在且有内容
-            # 尝试使用断点续传
-            for attempt in range(max_retries):
-                try:
-                    range_headers = headers.copy()
-                    range_headers['Range'] = f'bytes={file_size}-'
-                    response = http_session.get(ts_url, headers=range_headers, timeout=settings.get('timeout', 15), stream=True)
-                    
-                    # 如果服务器支持断点续传
-                    if response.status_code == 206:
-                        with open(ts_file_path, 'ab') as f:
-                            for chunk in response.iter_content(chunk_size=chunk_size):
-                                if chunk:
-                                    f.write(chunk)
-                        return True
-                    else:
-                        # 服务器不支持断点续传，删除现有文件重新下载
-                        os.remove(ts_file_path)
-                        file_size = 0
-                        break
-                except Exception:
-                    if attempt < max_retries - 1:
-                        time.sleep(1)
-                    else:
-                        return False
-    
-    # 如果文件不存在或断点续传失败，从头开始下载
-    if file_size == 0:
-        for attempt in range(max_retries):
+class TransferRecord:
+    """单个片段的下载记录：由下载函数填写，下载完成后写入续传日志"""
+    __slots__ = ('attempts', 'expected', 'size', 'digest', 'url', 'status')
+
+    def __init__(self, url=None):
+        self.attempts = 0
+        self.url = url  # 请求的地址（签名过期刷新后同一片段的地址会变）
+        self.status = None  # 最后一次请求的HTTP状态码，用于识别签名过期
+        self.expected = None  # 应写入的字节数：响应的 Content-Length，加密时收完后改为解密后的长度
+        self.size = 0  # 实际写入的字节数
+        self.digest = hashlib.sha1()  # 写入内容的SHA-1；断点续传或拆分下载时为None
+
+    def start(self, response=None, resume=False):
+        """开始一次新的写入（每次重试都重新开始）"""
+        self.attempts += 1
+        self.size = 0
+        self.digest = None if resume else hashlib.sha1()
+        self.expected = None
+        if response is not None and 'Content-Encoding' not in response.headers:
             try:
-                response = http_session.get(ts_url, headers=headers, timeout=settings.get('timeout', 15), stream=True)
-                
-                # 处理403错误 - 尝试使用不同的请求头
-                if response.status_code == 403 and attempt < max_retries - 1:
-                    # 尝试使用更简单的请求头
-                    simple_headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'Accept': '*/*'
-                    }
-                    response = http_session.get(ts_url, headers=simple_headers, timeout=settings.get('timeout', 15), stream=True)
-                
-                if response.status_code == 200:
-                    with open(ts_file_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=chunk_size):
-                            if chunk:
-                                f.write(chunk)
-                    return True
-                elif response.status_code == 403:
-                    # 如果仍然是403，尝试从URL中提取Referer
-                    parsed_url = urlparse(ts_url)
-                    possible_referer = f"{parsed_url.scheme}://{parsed_url.netloc}/"
-                    
-                    # 尝试从路径中构建更具体的Referer
-                    path_parts = parsed_url.path.split('/')
-                    if len(path_parts) > 2:
-                        # 使用路径的上一级目录作为Referer
-                        referer_path = '/'.join(path_parts[:-1])
-                        possible_referer = f"{parsed_url.scheme}://{parsed_url.netloc}{referer_path}/"
-                    
-                    custom_headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'Accept': '*/*',
-                        'Referer': possible_referer,
-                        'Origin': f"{parsed_url.scheme}://{parsed_url.netloc}"
-                    }
-                    
-                    response = http_session.get(ts_url, headers=custom_headers, timeout=settings.get('timeout', 15), stream=True)
-                    if response.status_code == 200:
-                        with open(ts_file_path, 'wb') as f:
-                            for chunk in response.iter_content(chunk_size=chunk_size):
-                                if chunk:
-                                    f.write(chunk)
-                        return True
-                
-                if attempt < max_retries - 1:
-                    time.sleep(1)
-                else:
-                    return False
-            except Exception:
-                if attempt < max_retries - 1:
-                    time.sleep(1)
-                else:
+                self.expected = int(response.headers['Content-Length'])
+            except (KeyError, ValueError):
+                pass
+
+    def update(self, data):
+        self.size += len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+
+    def verify(self, received, decrypted=False):
+        """检查收到的字节数等于 Content-Length，否则抛出异常；解密写入时预期字节数改为解密后的长度"""
+        if self.expected is None:
+            return
+        if received != self.expected:
+            raise IOError(f"Incomplete segment: received {received} of {self.expected} bytes")
+        if decrypted:
+            # 密文完整，PKCS7填充去掉后写入的内容比 Content-Length 短
+            self.expected = self.size
+
+    @property
+    def hash(self):
+        return self.digest.hexdigest() if self.digest is not None else None
+
+class BufferPool:
+    """预分配的可重复使用的读缓冲区
+
+    每个下载线程同一时间只借用一个缓冲区，池的大小等于最大并发数，之后不再分配新的内存，
+    无论下载多少个片段内存占用都保持不变。块大小（chunk_size）改变时丢弃旧的缓冲区。
+    """
+
+    def __init__(self):
+        self._free = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self.allocated = 0  # 累计分配的缓冲区数
+        self.reused = 0  # 直接从池中取出的次数
+
+    def acquire(self, size):
+        with self._lock:
+            if size != self._size:
+                self._free.clear()
+                self._size = size
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(buffer) == self._size:
+                self._free.append(buffer)
+
+buffer_pool = BufferPool()
+
+def memory_report():
+    """峰值内存和缓冲池的统计，用于下载完成后的状态信息"""
+    parts = []
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 以KB为单位，macOS 以字节为单位
+        peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+        parts.append(f"peak RSS {peak:.1f} MB")
+    if buffer_pool.allocated:
+        parts.append(f"{buffer_pool.allocated} read buffers of {buffer_pool._size // 1024} KB "
+                     f"allocated, reused {buffer_pool.reused} times")
+    return ', '.join(parts)
+
+def parse_byte_size(text):
+    """把 500K、2M、1.5G 或纯数字（字节）解析为字节数"""
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    factor = units.get(text[-1:], 1)
+    number = float(text[:-1] if text[-1:] in units else text)
+    if number < 0:
+        raise ValueError(f"Negative size: {text}")
+    return int(number * factor)
+
+class BandwidthLimiter:
+    """所有下载（所有任务、线程和异步请求）共用的令牌桶限速
+
+    读取每一块数据之前先从桶中取出相应的令牌，令牌不足时等待，数据留在连接里由TCP流量控制让服务器放慢，
+    总的下载速度不超过 rate，瞬时最多超出 burst。不限速时每块只多一次比较。
+    运行中可以通过 configure（GUI设置）或控制文件（命令行，见 CONTROL_FILE）修改上限，等待中的读取最迟
+    MAX_WAIT 秒后按新的上限计算。
+    """
+
+    CONTROL_FILE = 'bandwidth_limit.txt'
+    MAX_WAIT = 0.05
+
+    def __init__(self):
+        self.rate = 0  # 字节/秒，0表示不限速
+        self.burst = 0
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+        self.control_path = None  # 命令行模式下轮询的控制文件
+        self._control_mtime = None
+        self._control_checked = 0.0
+
+    def configure(self, rate, burst=0):
+        """设置上限（字节/秒）和桶容量（字节，0表示四分之一秒的量），rate 为0时不限速"""
+        with self._lock:
+            self.rate = max(0, int(rate))
+            self.burst = int(burst) if burst > 0 else max(self.rate // 4, 16 * 1024)
+            self._tokens = min(self._tokens, self.burst)
+            self._stamp = time.monotonic()
+
+    def configure_from_settings(self):
+        self.configure(settings.get('bandwidth_limit_kb', 0) * 1024, settings.get('bandwidth_burst_kb', 0) * 1024)
+
+    def watch(self, path):
+        """轮询控制文件，只有启动之后写入的新内容才生效"""
+        self.control_path = path
+        try:
+            self._control_mtime = os.path.getmtime(path)
+        except OSError:
+            self._control_mtime = None
+
+    def chunk_size(self, chunk_size):
+        """限速时每次读取桶容量的八分之一：等待的读取方只需要凑够一小份令牌，多个连接可以交替读取"""
+        return min(chunk_size, max(self.burst // 8, 4096)) if self.rate else chunk_size
+
+    def _check_control(self, now):
+        """控制文件内容为 "上限 [容量]"，如 "2M" 或 "500K 1M"，"0" 表示取消限速"""
+        self._control_checked = now
+        try:
+            mtime = os.path.getmtime(self.control_path)
+            if mtime == self._control_mtime:
+                return
+            self._control_mtime = mtime
+            with open(self.control_path, 'r') as f:
+                values = [parse_byte_size(value) for value in f.read().split()[:2]]
+        except (OSError, ValueError):
+            return
+        if values:
+            self.configure(*values)
+
+    def try_acquire(self, size):
+        """取出 size 字节的令牌：成功返回0；令牌不足时不取出，返回建议等待的秒数"""
+        if self.control_path is not None:
+            now = time.monotonic()
+            if now - self._control_checked >= 1:
+                self._check_control(now)
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            # 超过桶容量的请求按容量计算，否则永远取不到
+            size = min(size, self.burst)
+            if self._tokens >= size:
+                self._tokens -= size
+                return 0
+            return min((size - self._tokens) / self.rate, self.MAX_WAIT)
+
+    def acquire(self, size):
+        delay = self.try_acquire(size)
+        while delay:
+            time.sleep(delay)
+            delay = self.try_acquire(size)
+
+    def refund(self, size):
+        """退回预先取出但没有读到的令牌（响应体的最后一块通常不满）"""
+        if self.rate and size > 0:
+            with self._lock:
+                self._tokens = min(self.burst, self._tokens + size)
+
+bandwidth_limiter = BandwidthLimiter()
+
+class _Histogram:
+    """Prometheus 风格的累计直方图（线程安全由 DownloadMetrics 的锁保证）"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+                break
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': {str(bound): count for bound, count in cumulative},
+                'sum': round(self.sum, 6), 'count': self.count}
+
+class DownloadMetrics:
+    """下载引擎的指标：字节数、各状态的片段数、每个主机的状态码/重试/错误次数、
+    片段耗时和首字节时间直方图、当前并发数和合并耗时
+
+    所有任务共用一份（全局的 metrics），通过 snapshot() 取得JSON格式的快照，
+    prometheus() 输出 Prometheus 文本格式，start_metrics_server 在本地端口上提供这两种格式。
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+    MERGE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, float('inf'))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.downloaded_bytes = 0
+        self.segments = {'done': 0, 'failed': 0, 'skipped': 0}
+        self.segments_queued = 0
+        self.segments_in_flight = 0
+        self.responses = {}  # (主机, 状态码) -> 次数
+        self.retries = {}  # 主机 -> 次数
+        self.errors = {}  # (主机, 类型) -> 次数
+        self.segment_seconds = _Histogram(self.LATENCY_BUCKETS)
+        self.ttfb_seconds = _Histogram(self.LATENCY_BUCKETS)
+        self.merge_seconds = _Histogram(self.MERGE_BUCKETS)
+        self.merges = {}  # (方式, 结果) -> 次数
+        self.jobs_running = 0
+        self.jobs_finished = 0
+
+    @staticmethod
+    def _host(url):
+        return urlparse(url).netloc if url else 'unknown'
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.downloaded_bytes += size
+
+    def on_response(self, url, status, ttfb=None):
+        key = (self._host(url), status)
+        with self._lock:
+            self.responses[key] = self.responses.get(key, 0) + 1
+            if ttfb is not None:
+                self.ttfb_seconds.observe(ttfb)
+
+    def on_retry(self, url, count=1):
+        host = self._host(url)
+        with self._lock:
+            self.retries[host] = self.retries.get(host, 0) + count
+
+    def on_failure(self, url, kind):
+        key = (self._host(url), kind)
+        with self._lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def queue_segments(self, count):
+        with self._lock:
+            self.segments_queued += count
+
+    def segment_started(self):
+        """片段开始下载（已取得并发名额），返回开始时间"""
+        with self._lock:
+            self.segments_in_flight += 1
+        return time.time()
+
+    def segment_finished(self, started, success):
+        with self._lock:
+            self.segments_in_flight -= 1
+            if success:
+                self.segment_seconds.observe(time.time() - started)
+
+    def segment_result(self, state, count=1, queued=True):
+        """记录片段的最终状态：done、failed 或 skipped（已经下载过）"""
+        with self._lock:
+            self.segments[state] += count
+            if queued:
+                self.segments_queued -= count
+
+    def job_started(self):
+        with self._lock:
+            self.jobs_running += 1
+
+    def job_finished(self):
+        with self._lock:
+            self.jobs_running -= 1
+            self.jobs_finished += 1
+
+    def on_merge(self, mode, success, seconds):
+        key = (mode, 'ok' if success else 'failed')
+        with self._lock:
+            self.merges[key] = self.merges.get(key, 0) + 1
+            self.merge_seconds.observe(seconds)
+
+    def snapshot(self):
+        """当前所有指标的JSON快照"""
+        with self._lock:
+            responses = {}
+            for (host, status), count in self.responses.items():
+                responses.setdefault(host, {})[str(status)] = count
+            errors = {}
+            for (host, kind), count in self.errors.items():
+                errors.setdefault(host, {})[kind] = count
+            return {
+                'timestamp': time.time(),
+                'downloaded_bytes': self.downloaded_bytes,
+                'segments': dict(self.segments),
+                'segments_queued': self.segments_queued,
+                'segments_in_flight': self.segments_in_flight,
+                'bandwidth_limit_bytes': bandwidth_limiter.rate,
+                'responses': responses,
+                'retries': dict(self.retries),
+                'errors': errors,
+                'segment_duration_seconds': self.segment_seconds.snapshot(),
+                'ttfb_seconds': self.ttfb_seconds.snapshot(),
+                'merge_duration_seconds': self.merge_seconds.snapshot(),
+                'merges': {f"{mode}:{result}": count for (mode, result), count in self.merges.items()},
+                'jobs_running': self.jobs_running,
+                'jobs_finished': self.jobs_finished,
+            }
+
+    def prometheus(self):
+        """Prometheus 文本格式（0.0.4）"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP xxxhub_{name} {help_text}")
+            lines.append(f"# TYPE xxxhub_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label(val)}"' for key, val in labels)
+                lines.append(f"xxxhub_{name}{{{label_text}}} {value}" if label_text else f"xxxhub_{name} {value}")
+
+        def histogram(name, help_text, data):
+            metric(name, 'histogram', help_text, [])
+            for bound, count in data['buckets'].items():
+                lines.append(f'xxxhub_{name}_bucket{{le="{"+Inf" if bound == "inf" else bound}"}} {count}')
+            lines.append(f"xxxhub_{name}_sum {data['sum']}")
+            lines.append(f"xxxhub_{name}_count {data['count']}")
+
+        metric('downloaded_bytes_total', 'counter', 'Segment bytes received.',
+               [((), snapshot['downloaded_bytes'])])
+        metric('segments_total', 'counter', 'Segments by final state.',
+               [((('state', state),), count) for state, count in snapshot['segments'].items()])
+        metric('segments_queued', 'gauge', 'Segments waiting to be downloaded.',
+               [((), snapshot['segments_queued'])])
+        metric('segments_in_flight', 'gauge', 'Segments being downloaded right now (current concurrency).',
+               [((), snapshot['segments_in_flight'])])
+        metric('bandwidth_limit_bytes', 'gauge', 'Global bandwidth limit in bytes per second, 0 if unlimited.',
+               [((), snapshot['bandwidth_limit_bytes'])])
+        metric('http_responses_total', 'counter', 'HTTP responses by host and status code.',
+               [((('host', host), ('code', code)), count)
+                for host, codes in sorted(snapshot['responses'].items()) for code, count in sorted(codes.items())])
+        metric('retries_total', 'counter', 'Request retries by host.',
+               [((('host', host),), count) for host, count in sorted(snapshot['retries'].items())])
+        metric('request_errors_total', 'counter', 'Failed requests by host and kind (timeout, throttled, error, corrupt).',
+               [((('host', host), ('kind', kind)), count)
+                for host, kinds in sorted(snapshot['errors'].items()) for kind, count in sorted(kinds.items())])
+        histogram('segment_duration_seconds', 'Time to download a segment.', snapshot['segment_duration_seconds'])
+        histogram('ttfb_seconds', 'Time from sending a request to its response headers.', snapshot['ttfb_seconds'])
+        histogram('merge_duration_seconds', 'Time to merge a job.', snapshot['merge_duration_seconds'])
+        metric('merges_total', 'counter', 'Merges by mode and result.',
+               [((('mode', key.split(':')[0]), ('result', key.split(':')[1])), count)
+                for key, count in sorted(snapshot['merges'].items())])
+        metric('jobs_running', 'gauge', 'Jobs currently running.', [((), snapshot['jobs_running'])])
+        metric('jobs_finished_total', 'counter', 'Jobs finished.', [((), snapshot['jobs_finished'])])
+        return '\n'.join(lines) + '\n'
+
+metrics = DownloadMetrics()
+metrics_server = None
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics 返回 Prometheus 文本格式，/metrics.json 返回JSON快照"""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = metrics.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(metrics.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """在本地端口上提供指标接口（已经启动时先停止），port 为0时只停止；返回实际监听的端口或None"""
+    global metrics_server
+    stop_metrics_server()
+    if not port:
+        return None
+    metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    return metrics_server.server_address[1]
+
+def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        metrics_server = None
+
+def _urllib3_supports_readinto():
+    """urllib3 的响应是否有 readinto 需要的私有属性：_fp（底层的 http.client 响应）和
+    _fp_bytes_read（已经读取的字节数），urllib3 1.x 和 2.x 都有；以后的版本改变实现时只用 iter_content
+    """
+    try:
+        probe = Urllib3Response(body=io.BytesIO(), preload_content=False)
+    except Exception:
+        return False
+    return (hasattr(probe, '_fp') and isinstance(getattr(probe, '_fp_bytes_read', None), int)
+            and callable(getattr(probe, 'release_conn', None)))
+
+URLLIB3_READINTO = _urllib3_supports_readinto()
+
+def _readinto_source(response):
+    """返回可以直接 readinto 的底层 http.client 响应；压缩、HTTP/2、已经开始读取的响应或
+    urllib3 没有所需的私有属性（URLLIB3_READINTO）时返回None
+    """
+    if not URLLIB3_READINTO or not settings.get('readinto', True):
+        return None
+    raw = response.raw
+    if not isinstance(raw, Urllib3Response) or getattr(response, '_content_consumed', True):
+        return None
+    if response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None
+    source = getattr(raw, '_fp', None)
+    if not isinstance(source, http.client.HTTPResponse) or raw._fp_bytes_read or source.isclosed():
+        return None
+    return source
+
+def _iter_response(response, chunk_size):
+    """逐块给出响应体，尽量用 readinto 从连接直接读入缓冲池中的缓冲区，不为每块分配新的 bytes
+
+    给出的 memoryview 只在下一次迭代之前有效，需要保留的数据要先复制（写入文件、解密或追加到 bytearray）。
+    """
+    source = _readinto_source(response)
+    # 测速时限制每次读取的大小：一次读取要等到读满才返回，慢连接也要及时报告收到的字节
+    read_size = ThroughputMeter.READ_SIZE if _current_transfer.get() is not None else chunk_size
+    if source is None:
+        # iter_content 无法在读取前等待，读到之后再取令牌
+        for chunk in response.iter_content(chunk_size=bandwidth_limiter.chunk_size(min(chunk_size, read_size))):
+            bandwidth_limiter.acquire(len(chunk))
+            metrics.add_bytes(len(chunk))
+            _count_transfer(response, len(chunk))
+            yield chunk
+        return
+    buffer = buffer_pool.acquire(chunk_size)
+    view = memoryview(buffer)
+    try:
+        while True:
+            # 限速时先取得令牌再读取（上限可能在下载中途改变）
+            size = bandwidth_limiter.chunk_size(min(chunk_size, read_size))
+            if source.length is not None:
+                size = min(size, source.length)  # 不为响应体之外的字节取令牌
+            bandwidth_limiter.acquire(size)
+            try:
+                count = source.readinto(view[:size])
+            except (OSError, http.client.HTTPException) as e:
+                # 与 iter_content 一致：读取超时或连接中断按 ConnectionError 处理
+                raise requests.exceptions.ConnectionError(e)
+            bandwidth_limiter.refund(size - count)
+            if not count:
+                break
+            metrics.add_bytes(count)
+            _count_transfer(response, count)
+            yield view[:count]
+        # 响应体已读完，把连接还给连接池（iter_content 读完时 urllib3 也会这样做）
+        response.raw.release_conn()
+    finally:
+        buffer_pool.release(buffer)
+
+def _copy_response(response, f, chunk_size, cipher=None, record=None):
+    """将响应体按块写入文件对象，返回下载的字节数
+
+    cipher 为 (密钥, IV) 时，每块数据到达后立即解密再写入，不需要再读一遍文件
+    record 为 TransferRecord 时记录写入的字节数和SHA-1；下载的字节数少于 Content-Length 时抛出异常
+    """
+    decryptor = SegmentDecryptor(*cipher) if cipher else None
+    received = 0
+    for chunk in _iter_response(response, chunk_size):
+        if chunk:
+            received += len(chunk)
+            data = decryptor.update(chunk) if decryptor else chunk
+            f.write(data)
+            if record is not None:
+                record.update(data)
+    if decryptor:
+        data = decryptor.finalize()
+        f.write(data)
+        if record is not None:
+            record.update(data)
+    if record is not None:
+        record.verify(received, decryptor is not None)
+    return received
+
+def _write_response(response, ts_file_path, mode, chunk_size, cipher=None, record=None):
+    """将响应体按块写入文件，返回下载的字节数"""
+    with open(ts_file_path, mode) as f:
+        return _copy_response(response, f, chunk_size, cipher, record)
+
+def _get_segment_response(ts_url, allow_simple_headers, observer=None, byte_range=None, record=None):
+    """请求片段，遇到403时依次尝试其他请求头方案（从该主机上次成功的方案开始）；返回200的响应，否则返回None
+
+    byte_range 为 (起始, 结束)（含结束字节）时发送Range请求，206和200的响应都会返回
+    record 为 TransferRecord 时记录最后一次响应的状态码
+    """
+    timeout = settings.get('timeout', 15)
+    ok_status = (200, 206) if byte_range else (200,)
+    
+    def get(profile):
+        headers = build_request_headers(ts_url, profile)
+        if byte_range:
+            headers['Range'] = f'bytes={byte_range[0]}-{byte_range[1]}'
+        response = http_session.get(ts_url, headers=headers, timeout=timeout, stream=True)
+        _notify_response(observer, response)
+        if record is not None:
+            record.status = response.status_code
+        return response
+    
+    # 从该主机上次成功的请求头方案开始，遇到403时尝试其他方案
+    for profile in header_profiles.order(ts_url):
+        if profile == 'simple' and not allow_simple_headers:
+            continue
+        response = get(profile)
+        if response.status_code in ok_status:
+            header_profiles.remember(ts_url, profile)
+            return response
+        response.close()
+        if response.status_code != 403:
+            break
+    
+    return None
+
+def _notify_response(observer, response):
+    """向全局指标和观察者报告响应状态码和首字节时间，包括被重试策略自动重试掉的429/503"""
+    retries = getattr(response.raw, 'retries', None)
+    history = retries.history if retries is not None else ()
+    if history:
+        metrics.on_retry(response.url, len(history))
+    for entry in history:
+        if entry.status is not None:
+            metrics.on_response(response.url, entry.status)
+            if observer is not None:
+                observer.on_response(entry.status, None)
+    metrics.on_response(response.url, response.status_code, response.elapsed.total_seconds())
+    if observer is not None:
+        observer.on_response(response.status_code, response.elapsed.total_seconds())
+
+def _notify_failure(observer, error, url=None):
+    """向全局指标和观察者报告请求异常的类型：throttled（重试耗尽的429/503）、timeout（超时/连接中断）、
+    stalled（速度远低于其他连接）或 error"""
+    if isinstance(error, requests.exceptions.RetryError):
+        kind = 'throttled'
+    elif isinstance(error, TransferStalled):
+        kind = 'stalled'
+    elif isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        kind = 'timeout'
+    else:
+        kind = 'error'
+    metrics.on_failure(url, kind)
+    if observer is not None:
+        observer.on_failure(kind)
+
+def download_single_ts(ts_url, ts_file_path, max_retries=3, chunk_size=None, observer=None, cipher=None, record=None):
+    """下载单个 .ts 文件，支持重试和断点续传
+
+    observer 可选，用于接收响应状态、首字节时间和下载字节数（见 AdaptiveConcurrency）
+    cipher 为 (密钥, IV) 时边下载边解密（加密片段不能断点续传，会重新下载）
+    record 为 TransferRecord 时记录尝试次数、字节数和SHA-1，供续传日志使用
+    """
+    if chunk_size is None:
+        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
+        
+    # 续传请求使用该主机上次成功的请求头方案
+    headers = build_request_headers(ts_url, header_profiles.preferred(ts_url))
+    
+    # 检查文件是否已部分下载
+    file_size = 0
+    if os.path.exists(ts_file_path):
+        file_size = os.path.getsize(ts_file_path)
+        if file_size > 0 and cipher is not None:
+            # 已保存的是解密后的数据，无法从中间继续CBC解密，删除后重新下载
+            os.remove(ts_file_path)
+            file_size = 0
+        if file_size > 0:  # 文件已存在且有内容
+            # 尝试使用断点续传
+            for attempt in range(max_retries):
+                if attempt:
+                    metrics.on_retry(ts_url)
+                try:
+                    # 上一次续传中断时文件已经变长，从当前长度继续
+                    file_size = os.path.getsize(ts_file_path)
+                    range_headers = headers.copy()
+                    range_headers['Range'] = f'bytes={file_size}-'
+                    start_time = time.time()
+                    response = http_session.get(ts_url, headers=range_headers, timeout=settings.get('timeout', 15), stream=True)
+                    _notify_response(observer, response)
+                    if record is not None:
+                        record.status = response.status_code
+                    
+                    # 如果服务器支持断点续传
+                    if response.status_code == 206:
+                        if record is not None:
+                            record.start(response, resume=True)
+                        written = _write_response(response, ts_file_path, 'ab', chunk_size, record=record)
+                        if record is not None:
+                            record.size += file_size
+                            if record.expected is not None:
+                                record.expected += file_size
+                        if observer is not None:
+                            observer.on_success(written, time.time() - start_time)
+                        return True
+                    else:
+                        # 服务器不支持断点续传，删除现有文件重新下载
+                        os.remove(ts_file_path)
+                        file_size = 0
+                        break
+                except Exception as e:
+                    _notify_failure(observer, e, ts_url)
+                    if attempt < max_retries - 1:
+                        time.sleep(1)
+                    else:
+                        return False
+    
+    # 如果文件不存在或断点续传失败，从头开始下载
+    if file_size == 0:
+        for attempt in range(max_retries):
+            if attempt:
+                metrics.on_retry(ts_url)
+            try:
+                start_time = time.time()
+                response = _get_segment_response(ts_url, attempt < max_retries - 1, observer, record=record)
+                if record is not None:
+                    record.start(response)
+                if response is not None:
+                    written = _write_response(response, ts_file_path, 'wb', chunk_size, cipher, record)
+                    if observer is not None:
+                        observer.on_success(written, time.time() - start_time)
+                    return True
+                
+                # 410表示地址已失效，重试没有意义（由 TokenRefresher 换成新地址）
+                if attempt < max_retries - 1 and not (record is not None and record.status == 410):
+                    time.sleep(1)
+                else:
+                    return False
+            except Exception as e:
+                _notify_failure(observer, e, ts_url)
+                if attempt < max_retries - 1:
+                    time.sleep(1)
+                else:
+                    return False
+    
+    return False
+
+def download_segment_bytes(ts_url, max_retries=3, chunk_size=None, observer=None, cipher=None, record=None):
+    """把单个片段下载到内存中，返回内容；重试、请求头回退和解密与 download_single_ts 一致，失败返回None"""
+    if chunk_size is None:
+        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
+    
+    for attempt in range(max_retries):
+        if attempt:
+            metrics.on_retry(ts_url)
+        try:
+            start_time = time.time()
+            response = _get_segment_response(ts_url, attempt < max_retries - 1, observer, record=record)
+            if record is not None:
+                record.start(response)
+            if response is not None:
+                buffer = io.BytesIO()
+                written = _copy_response(response, buffer, chunk_size, cipher, record)
+                if observer is not None:
+                    observer.on_success(written, time.time() - start_time)
+                return buffer.getvalue()
+        except Exception as e:
+            _notify_failure(observer, e, ts_url)
+        
+        if record is not None and record.status == 410:
+            break
+        if attempt < max_retries - 1:
+            time.sleep(1)
+    
+    return None
+
+TS_PACKET_SIZE = 188
+
+def _check_ts_packets_numpy(data, count):
+    """用NumPy逐列检查所有TS包，返回 (第一个缺少同步字节的包序号或None, 连续计数器错误数)"""
+    packets = np.frombuffer(data, dtype=np.uint8, count=count * TS_PACKET_SIZE).reshape(count, TS_PACKET_SIZE)
+    sync_ok = packets[:, 0] == 0x47
+    if not sync_ok.all():
+        return int(np.argmin(sync_ok)), 0
+    
+    # 只检查带负载的包（空包 0x1FFF 除外），按PID分组后比较相邻两个包的计数器
+    flags = packets[:, 3]
+    pid = ((packets[:, 1].astype(np.uint16) & 0x1f) << 8) | packets[:, 2]
+    selected = ((flags & 0x10) != 0) & (pid != 0x1fff)
+    # 适配字段中的 discontinuity_indicator 允许计数器跳变
+    discontinuity = ((flags & 0x20) != 0) & (packets[:, 4] > 0) & ((packets[:, 5] & 0x80) != 0)
+    pid = pid[selected]
+    counter = flags[selected] & 0x0f
+    discontinuity = discontinuity[selected]
+    order = np.argsort(pid, kind='stable')
+    pid, counter, discontinuity = pid[order], counter[order], discontinuity[order]
+    step = (counter[1:] - counter[:-1]) & 0x0f
+    # 步长为0是允许的重复包
+    errors = (pid[1:] == pid[:-1]) & (step > 1) & ~discontinuity[1:]
+    return None, int(errors.sum())
+
+def _check_ts_packets_python(data, count):
+    """_check_ts_packets_numpy 的纯Python实现"""
+    view = memoryview(data)[:count * TS_PACKET_SIZE]
+    sync = bytes(view[::TS_PACKET_SIZE])
+    if sync != b'\x47' * count:
+        return len(sync) - len(sync.lstrip(b'\x47')) if sync[0] == 0x47 else 0, 0
+    
+    last = {}
+    errors = 0
+    columns = zip(view[1::TS_PACKET_SIZE], view[2::TS_PACKET_SIZE], view[3::TS_PACKET_SIZE],
+                  view[4::TS_PACKET_SIZE], view[5::TS_PACKET_SIZE])
+    for b1, b2, flags, adaptation_length, adaptation_flags in columns:
+        pid = ((b1 & 0x1f) << 8) | b2
+        if not flags & 0x10 or pid == 0x1fff:
+            continue
+        counter = flags & 0x0f
+        previous = last.get(pid)
+        if previous is not None and (counter - previous) & 0x0f > 1:
+            if not (flags & 0x20 and adaptation_length and adaptation_flags & 0x80):
+                errors += 1
+        last[pid] = counter
+    return None, errors
+
+# 不是MPEG-TS的片段（fMP4/CMAF、打包音频、字幕）的扩展名，这些片段不做TS校验
+NON_TS_EXTENSIONS = ('.m4s', '.mp4', '.m4v', '.m4a', '.cmfv', '.cmfa', '.aac', '.ac3', '.ec3', '.mp3', '.vtt', '.webvtt')
+# fMP4片段开头可能出现的box类型
+FMP4_BOXES = (b'ftyp', b'styp', b'moof', b'sidx', b'moov', b'emsg', b'prft')
+
+def is_ts_segment(segment):
+    """片段是否为MPEG-TS：有 EXT-X-MAP（fMP4/CMAF）或扩展名表明是其他格式时不是"""
+    if segment.init_section is not None:
+        return False
+    return not segment.filename.lower().endswith(NON_TS_EXTENSIONS)
+
+def looks_like_other_media(data):
+    """内容开头是fMP4的box、ID3标签（打包音频）或ADTS音频帧时返回True"""
+    head = bytes(data[:8])
+    if len(head) == 8 and head[4:8] in FMP4_BOXES:
+        return True
+    if head[:3] == b'ID3':
+        return True
+    return len(head) >= 2 and head[0] == 0xFF and head[1] & 0xF6 == 0xF0
+
+def validate_ts_data(data):
+    """检查片段内容是否为完整的MPEG-TS：返回 (问题描述或None, 连续计数器错误数)
+
+    问题包括空内容、HTML等文本页面、长度不是188字节的整数倍（被截断）和缺少0x47同步字节；
+    连续计数器错误只统计，不视为损坏（重新下载无法修复编码端的问题）。
+    内容是其他媒体格式（fMP4、打包音频）时不校验，视为没有问题
+    """
+    length = len(data)
+    if length == 0:
+        return "empty segment", 0
+    if data[0] != 0x47:
+        if looks_like_other_media(data):
+            return None, 0
+        head = bytes(data[:64]).lstrip()
+        if head[:1] == b'<' or head[:1] == b'{':
+            return "received a text/HTML page instead of MPEG-TS", 0
+        return "does not start with the MPEG-TS sync byte", 0
+    if length % TS_PACKET_SIZE:
+        return f"length {length} is not a multiple of {TS_PACKET_SIZE} bytes (truncated?)", 0
+    
+    check = _check_ts_packets_numpy if np is not None else _check_ts_packets_python
+    bad_packet, continuity_errors = check(data, length // TS_PACKET_SIZE)
+    if bad_packet is not None:
+        return f"sync byte missing at packet {bad_packet}", 0
+    return None, continuity_errors
+
+def validate_ts_file(path):
+    """用内存映射读取 .ts 文件并校验，返回值同 validate_ts_data"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return "empty segment", 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return validate_ts_data(view)
+            finally:
+                view.release()
+
+def probe_segment_size(ts_url):
+    """用HEAD请求获取片段大小；服务器不支持Range或没有返回长度时返回None"""
+    timeout = settings.get('timeout', 15)
+    for profile in header_profiles.order(ts_url):
+        headers = build_request_headers(ts_url, profile)
+        # 需要的是未压缩的实际字节数
+        headers['Accept-Encoding'] = 'identity'
+        try:
+            response = http_session.head(ts_url, headers=headers, timeout=timeout, allow_redirects=True)
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code == 403:
+            continue
+        if response.status_code != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return None
+        try:
+            return int(response.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+    return None
+
+def _download_part(ts_url, fd, start, end, max_retries, chunk_size, write_at):
+    """下载 [start, end] 字节范围并写入文件的对应位置，中断后从已写入的位置继续，返回是否成功"""
+    position = start
+    for attempt in range(max_retries):
+        if attempt:
+            metrics.on_retry(ts_url)
+        try:
+            headers = build_request_headers(ts_url, header_profiles.preferred(ts_url))
+            headers['Accept-Encoding'] = 'identity'
+            headers['Range'] = f'bytes={position}-{end}'
+            response = http_session.get(ts_url, headers=headers, timeout=settings.get('timeout', 15), stream=True)
+            _notify_response(None, response)
+            if response.status_code != 206:
+                response.close()
+                return False
+            for chunk in _iter_response(response, chunk_size):
+                if chunk:
+                    write_at(fd, chunk, position)
+                    position += len(chunk)
+            if position > end:
+                return True
+        except Exception as e:
+            _notify_failure(None, e, ts_url)
+        if attempt < max_retries - 1:
+            time.sleep(1)
+    return False
+
+def _pwrite(fd, data, offset):
+    """按位置写入，不移动共享的文件指针；没有 os.pwrite 的系统（Windows）加锁后 seek + write"""
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+_seek_write_lock = threading.Lock()
+
+def _seek_write(fd, data, offset):
+    with _seek_write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+def download_single_ts_split(ts_url, ts_file_path, size, connections, max_retries=3, chunk_size=None, observer=None, record=None):
+    """把一个大片段拆分为多个字节范围并行下载，按位置写入预先分配好大小的文件
+
+    先写入 <文件名>.part，全部完成后再改名，中断的下载不会被当成已完成的片段跳过。
+    """
+    if chunk_size is None:
+        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
+    
+    part_path = ts_file_path + '.part'
+    part_size = -(-size // connections)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    write_at = _pwrite if hasattr(os, 'pwrite') else _seek_write
+    
+    start_time = time.time()
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        # 预先分配文件大小，各连接直接写入自己的区域
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+        else:
+            os.ftruncate(fd, size)
+        # 每个部分在自己的线程中下载，测速时各自计为一个连接
+        parent = _current_transfer.get()
+        
+        def download_part(r):
+            if parent is None:
+                return _download_part(ts_url, fd, r[0], r[1], max_retries, chunk_size, write_at)
+            with parent.meter.transfer(f"{parent.label} bytes {r[0]}-{r[1]}", parent=parent):
+                return _download_part(ts_url, fd, r[0], r[1], max_retries, chunk_size, write_at)
+        
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            results = list(executor.map(download_part, ranges))
+    finally:
+        os.close(fd)
+    
+    if not all(results):
+        os.remove(part_path)
+        if observer is not None:
+            observer.on_failure('error')
+        return False
+    os.replace(part_path, ts_file_path)
+    if record is not None:
+        # 各部分并行写入，不计算整个片段的SHA-1
+        record.start(resume=True)
+        record.expected = record.size = size
+    if observer is not None:
+        observer.on_success(size, time.time() - start_time)
+    return True
+
+def plan_range_requests(download_tasks, segments, max_bytes):
+    """把同一资源上首尾相接的 BYTERANGE 片段合并为一组，每组只发一次Range请求
+
+    download_tasks 为按序号排列的 (序号, URL, 文件名)；没有字节范围的片段单独成组。
+    每组的总字节数不超过 max_bytes（单个片段超过时也单独成组）。
+    """
+    groups = []
+    group_start = group_end = None
+    for task in download_tasks:
+        byterange = segments[task[0]].byterange
+        if byterange is None:
+            groups.append([task])
+            group_end = None
+            continue
+        length, offset = byterange
+        previous = groups[-1] if groups else None
+        if (group_end is not None and offset == group_end and task[1] == previous[-1][1]
+                and offset + length - group_start <= max_bytes):
+            previous.append(task)
+        else:
+            groups.append([task])
+            group_start = offset
+        group_end = offset + length
+    return groups
+
+def download_range_group(ts_url, ranges, max_retries=3, chunk_size=None, observer=None, ciphers=None, record=None):
+    """用一次Range请求下载同一资源上首尾相接的多个字节范围，按范围拆分后返回每个片段的内容
+
+    ranges 为按偏移排列的 (长度, 偏移)；ciphers 为每个片段的 (密钥, IV) 或 None
+    （加密时每个片段单独加密，拆分后分别解密）。失败返回None，record 记录最后一次响应的状态码。
+    """
+    if chunk_size is None:
+        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
+    
+    start = ranges[0][1]
+    total = ranges[-1][1] + ranges[-1][0] - start
+    
+    for attempt in range(max_retries):
+        if attempt:
+            metrics.on_retry(ts_url)
+        try:
+            start_time = time.time()
+            response = _get_segment_response(ts_url, attempt < max_retries - 1, observer, (start, start + total - 1), record)
+            if response is not None:
+                # 服务器忽略Range返回整个文件时，跳过前面的字节
+                skip = start if response.status_code == 200 else 0
+                buffer = bytearray()
+                for chunk in _iter_response(response, chunk_size):
+                    buffer += chunk
+                    if len(buffer) >= skip + total:
+                        break
+                response.close()
+                if observer is not None:
+                    observer.on_success(len(buffer), time.time() - start_time)
+                
+                if len(buffer) >= skip + total:
+                    view = memoryview(buffer)
+                    results = []
+                    for n, (length, offset) in enumerate(ranges):
+                        part = view[skip + offset - start:skip + offset - start + length]
+                        cipher = ciphers[n] if ciphers else None
+                        if cipher:
+                            decryptor = SegmentDecryptor(*cipher)
+                            results.append(decryptor.update(part) + decryptor.finalize())
+                        else:
+                            results.append(bytes(part))
+                    return results
+        except Exception as e:
+            _notify_failure(observer, e, ts_url)
+        
+        if attempt < max_retries - 1:
+            time.sleep(1)
+    
+    return None
+
+async def _write_response_async(response, ts_file_path, mode, chunk_size, cipher=None, record=None):
+    """将异步响应体按块写入文件（需要时边下载边解密），返回下载的字节数；record 的用法同 _copy_response"""
+    decryptor = SegmentDecryptor(*cipher) if cipher else None
+    received = 0
+    with open(ts_file_path, mode) as f:
+        while True:
+            # 与 _iter_response 相同：限速时先取得令牌再读取
+            size = bandwidth_limiter.chunk_size(chunk_size)
+            delay = bandwidth_limiter.try_acquire(size)
+            while delay:
+                await asyncio.sleep(delay)
+                delay = bandwidth_limiter.try_acquire(size)
+            chunk = await response.content.read(size)
+            bandwidth_limiter.refund(size - len(chunk))
+            if not chunk:
+                break
+            metrics.add_bytes(len(chunk))
+            _count_transfer(response, len(chunk))
+            received += len(chunk)
+            data = decryptor.update(chunk) if decryptor else chunk
+            f.write(data)
+            if record is not None:
+                record.update(data)
+        if decryptor:
+            data = decryptor.finalize()
+            f.write(data)
+            if record is not None:
+                record.update(data)
+    if record is not None:
+        record.verify(received, decryptor is not None)
+    return received
+
+async def download_single_ts_async(session, ts_url, ts_file_path, max_retries=3, chunk_size=None, observer=None, cipher=None, record=None):
+    """异步下载单个 .ts 文件，断点续传、请求头回退、重试、解密和下载记录与 download_single_ts 一致"""
+    if chunk_size is None:
+        chunk_size = settings.get('chunk_size', 1024) * 1024  # 默认1MB
+    
+    # 续传请求使用该主机上次成功的请求头方案
+    headers = build_request_headers(ts_url, header_profiles.preferred(ts_url))
+    
+    # 检查文件是否已部分下载
+    file_size = 0
+    if os.path.exists(ts_file_path):
+        file_size = os.path.getsize(ts_file_path)
+        if file_size > 0 and cipher is not None:
+            # 已保存的是解密后的数据，无法从中间继续CBC解密，删除后重新下载
+            os.remove(ts_file_path)
+            file_size = 0
+        if file_size > 0:  # 文件已存在且有内容
+            # 尝试使用断点续传
+            for attempt in range(max_retries):
+                if attempt:
+                    metrics.on_retry(ts_url)
+                try:
+                    # 上一次续传中断时文件已经变长，从当前长度继续
+                    file_size = os.path.getsize(ts_file_path)
+                    range_headers = headers.copy()
+                    range_headers['Range'] = f'bytes={file_size}-'
+                    start_time = time.time()
+                    async with session.get(ts_url, headers=range_headers) as response:
+                        metrics.on_response(ts_url, response.status, time.time() - start_time)
+                        if observer is not None:
+                            observer.on_response(response.status, time.time() - start_time)
+                        if record is not None:
+                            record.status = response.status
+                        # 如果服务器支持断点续传
+                        if response.status == 206:
+                            if record is not None:
+                                record.start(response, resume=True)
+                            written = await _write_response_async(response, ts_file_path, 'ab', chunk_size, record=record)
+                            if record is not None:
+                                record.size += file_size
+                                if record.expected is not None:
+                                    record.expected += file_size
+                            if observer is not None:
+                                observer.on_success(written, time.time() - start_time)
+                            return True
+                    # 服务器不支持断点续传，删除现有文件重新下载
+                    os.remove(ts_file_path)
+                    file_size = 0
+                    break
+                except Exception as e:
+                    _notify_async_failure(observer, e, ts_url)
+                    if attempt < max_retries - 1:
+                        await asyncio.sleep(1)
+                    else:
+                        return False
+    
+    # 如果文件不存在或断点续传失败，从头开始下载
+    if file_size == 0:
+        for attempt in range(max_retries):
+            if attempt:
+                metrics.on_retry(ts_url)
+            try:
+                # 从该主机上次成功的请求头方案开始，遇到403时尝试其他方案
+                for profile in header_profiles.order(ts_url):
+                    start_time = time.time()
+                    async with session.get(ts_url, headers=build_request_headers(ts_url, profile)) as response:
+                        metrics.on_response(ts_url, response.status, time.time() - start_time)
+                        if observer is not None:
+                            observer.on_response(response.status, time.time() - start_time)
+                        if record is not None:
+                            record.status = response.status
+                        if response.status == 200:
+                            header_profiles.remember(ts_url, profile)
+                            if record is not None:
+                                record.start(response)
+                            written = await _write_response_async(response, ts_file_path, 'wb', chunk_size, cipher, record)
+                            if observer is not None:
+                                observer.on_success(written, time.time() - start_time)
+                            return True
+                        if response.status != 403:
+                            break
+            except Exception as e:
+                _notify_async_failure(observer, e, ts_url)
+            
+            if record is not None and record.status == 410:
+                break
+            if attempt < max_retries - 1:
+                await asyncio.sleep(1)
+    
+    return False
+
+def _notify_async_failure(observer, error, url=None):
+    """异步引擎版本的 _notify_failure"""
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        kind = 'timeout'
+    elif isinstance(error, TransferStalled):
+        kind = 'stalled'
+    else:
+        kind = 'error'
+    metrics.on_failure(url, kind)
+    if observer is not None:
+        observer.on_failure(kind)
+
+async def download_ts_files_async(download_tasks, save_path, result_callback, concurrency, controller=None,
+                                  cipher_for=None, check_segment=None, check_retries=0, share=None, url_for=None,
+                                  meter=None):
+    """在单个事件循环中并发下载所有片段，固定数量的协程从任务队列中取任务
+
+    提供 controller 时，同时进行中的请求数由它动态决定（不超过 concurrency）
+    提供 cipher_for 时按片段序号取得 (密钥, IV)，密钥请求在线程池中执行，不阻塞事件循环
+    提供 check_segment(序号, 路径, 次数) 时校验下载的文件，未通过时最多重新下载 check_retries 次
+    提供 share（JobScheduler 分配的配额）时每个请求还要取得全局连接名额，在事件循环中等待
+    提供 url_for 时开始下载前按序号取片段当前的地址（签名过期后地址会被 TokenRefresher 更新）
+    提供 meter（ThroughputMeter）时每个片段的字节数计入其中，被判定卡住的连接重新请求
+    """
+    if meter is None:
+        meter = ThroughputMeter(0)
+    loop = asyncio.get_running_loop()
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        sock_connect=settings.get('timeout', 15),
+        sock_read=settings.get('timeout', 15)
+    )
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    pending = iter(download_tasks)
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def worker():
+            # 所有协程共享同一个迭代器，在同一线程内不需要加锁
+            for i, ts_url, filename in pending:
+                if controller is not None:
+                    await controller.acquire_async()
+                if url_for is not None:
+                    ts_url = url_for(i)
+                record = TransferRecord(ts_url)
+                ts_file_path = os.path.join(save_path, filename)
+                try:
+                    cipher = None
+                    if cipher_for is not None:
+                        cipher = await loop.run_in_executor(None, cipher_for, i)
+                    for check in range(check_retries + 1):
+                        if share is not None:
+                            await share.acquire_async()
+                        started = metrics.segment_started()
+                        success = False
+                        try:
+                            with meter.transfer(i, record):
+                                success = await download_single_ts_async(
+                                    session, ts_url, ts_file_path, observer=controller, cipher=cipher, record=record
+                                )
+                        finally:
+                            metrics.segment_finished(started, success)
+                            if share is not None:
+                                share.release(record.size)
+                        if not success or check_segment is None or check_segment(i, ts_file_path, None, check):
+                            break
+                        success = False
+                except Exception:
+                    success = False
+                finally:
+                    if controller is not None:
+                        await controller.release_async()
+                result_callback(i, ts_url, filename, success, record)
+        
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(download_tasks)))))
+
+class TransferStalled(IOError):
+    """片段连接的速度远低于其他连接（ThroughputMeter 判定卡住），中断后重新请求"""
+
+# 当前线程/协程正在下载的片段（_TransferSlot），_iter_response 和异步写入把收到的字节数记在它上面
+_current_transfer = contextvars.ContextVar('current_transfer', default=None)
+
+class _TransferSlot:
+    """一个正在进行的片段下载：字节数只由下载它的线程/协程累加，测速线程只读取，不需要加锁"""
+    __slots__ = ('meter', 'label', 'record', 'parent', 'children', 'bytes', 'last_data', 'mark_time', 'mark_bytes',
+                 'speed', 'restart', '_token')
+
+    def __init__(self, meter, label, record, parent=None):
+        self.meter = meter
+        self.label = label  # 片段序号（拆分下载的各部分为说明文字）
+        self.record = record  # TransferRecord，用其中的 Content-Length 估算剩余字节数
+        self.parent = parent  # 拆分下载的一部分：所属片段的 _TransferSlot
+        self.children = 0  # 正在进行的拆分部分数，大于0时字节都计在各部分上，本身不是一个连接
+        self.bytes = 0
+        self.last_data = self.mark_time = time.monotonic()
+        self.mark_bytes = 0
+        self.speed = None  # 上一个检测窗口的速度
+        self.restart = False  # 由 ThroughputMeter.sample 设置，下一块数据到达时中断连接
+        self._token = None
+
+    def add(self, count):
+        """累加收到的字节数，需要重新连接时返回True"""
+        self.bytes += count
+        self.last_data = time.monotonic()
+        if self.restart:
+            self.restart = False
+            return True
+        return False
+
+    def __enter__(self):
+        with self.meter._lock:
+            self.meter._slots.add(self)
+            if self.parent is not None:
+                self.parent.children += 1
+        self._token = _current_transfer.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_transfer.reset(self._token)
+        with self.meter._lock:
+            self.meter._slots.discard(self)
+            self.meter._retired_bytes += self.bytes
+            if self.parent is not None:
+                self.parent.children -= 1
+
+def _count_transfer(response, count):
+    """把收到的字节数记到当前片段上；测速线程判定连接卡住时关闭响应并抛出 TransferStalled"""
+    slot = _current_transfer.get()
+    if slot is not None and slot.add(count):
+        response.close()
+        raise TransferStalled(f"Segment {slot.label} stalled, reconnecting")
+
+class ThroughputMeter:
+    """按实际收到的字节统计一个下载任务的速度和剩余时间，并找出卡住的连接
+
+    每个片段在 with meter.transfer(序号, record) 中下载，数据块到达时计入该片段自己的计数（不加锁）；
+    sample() 由测速线程每秒调用，汇总所有片段的字节数，计算瞬时速度和指数平滑速度。
+    剩余字节数：正在下载的片段用 Content-Length，其他片段用已完成片段每秒时长（EXTINF）的平均字节数估算。
+    一个连接在 stall_seconds 内的速度低于最近每个连接的典型速度的十分之一时要求它重新连接；
+    典型速度取每个连接平均速度的缓慢衰减的最大值，只剩下几个慢连接时平均速度不会被它们拉低。
+    拆分下载的片段由 meter.transfer(..., parent=片段) 的各部分计数，片段本身这时不算一个连接。
+    """
+    TAU = 5.0  # 平滑速度的时间常数（秒）
+    STALL_FRACTION = 0.1
+    READ_SIZE = 128 * 1024  # 线程引擎每次读取的最大字节数
+    REFERENCE_DECAY = 0.99  # 每次采样典型速度的衰减
+
+    def __init__(self, stall_seconds=10):
+        self._lock = threading.Lock()
+        self.stall_seconds = stall_seconds
+        self._slots = set()
+        self._retired_bytes = 0
+        self._remaining = {}  # 还没有完成的片段：序号 -> EXTINF时长
+        self._remaining_duration = 0.0
+        self._done_bytes = 0
+        self._done_duration = 0.0
+        self._done_count = 0
+        self._start = self._last_time = time.monotonic()
+        self._last_bytes = 0
+        self.rate = 0.0  # 最近一次采样的速度（字节/秒）
+        self.ewma = None  # 平滑后的速度
+        self.per_transfer = 0.0  # 每个连接的典型速度
+        self.stalls = 0
+
+    def transfer(self, label, record=None, parent=None):
+        return _TransferSlot(self, label, record, parent)
+
+    def expect(self, durations):
+        """登记需要下载的片段，durations 为 {序号: EXTINF时长}"""
+        with self._lock:
+            for i, duration in durations.items():
+                if i not in self._remaining:
+                    self._remaining[i] = duration
+                    self._remaining_duration += duration
+
+    def total_bytes(self):
+        """到现在为止收到的字节数（包括正在下载的片段）"""
+        with self._lock:
+            return self._retired_bytes + sum(slot.bytes for slot in self._slots)
+
+    def segment_done(self, i, nbytes):
+        """片段下载完成，用它的大小改进剩余字节数的估算"""
+        with self._lock:
+            duration = self._remaining.pop(i, None)
+            if duration is None:
+                return
+            self._remaining_duration -= duration
+            if nbytes:
+                self._done_bytes += nbytes
+                self._done_duration += duration
+                self._done_count += 1
+
+    def segment_failed(self, i):
+        with self._lock:
+            duration = self._remaining.pop(i, None)
+            if duration is not None:
+                self._remaining_duration -= duration
+
+    def remaining_bytes(self):
+        """估算的剩余字节数，还没有完成的片段可供估算时返回None"""
+        with self._lock:
+            if not self._remaining:
+                return 0
+            if not self._done_count:
+                return None
+            if self._done_duration > 0:
+                per_second = self._done_bytes / self._done_duration
+                estimate = self._remaining_duration * per_second
+            else:
+                per_second = None
+                estimate = len(self._remaining) * self._done_bytes / self._done_count
+            # 拆分下载的片段：已收到的字节是各部分之和
+            split_bytes = {}
+            for slot in self._slots:
+                if slot.parent is not None:
+                    split_bytes[slot.parent] = split_bytes.get(slot.parent, 0) + slot.bytes
+            for slot in self._slots:
+                if slot.parent is not None or slot.label not in self._remaining:
+                    continue
+                guess = (self._remaining[slot.label] * per_second if per_second is not None
+                         else self._done_bytes / self._done_count)
+                expected = slot.record.expected if slot.record is not None else None
+                # 正在下载的片段：用 Content-Length 代替估算值，减去已经收到的部分
+                size = expected or guess
+                estimate += size - guess - min(slot.bytes + split_bytes.get(slot, 0), size)
+            return max(0, estimate)
+
+    def eta(self):
+        remaining = self.remaining_bytes()
+        if remaining is None or not self.ewma:
+            return None
+        return remaining / self.ewma
+
+    def sample(self):
+        """更新速度，返回这次新发现的卡住的片段（已要求它们重新连接）"""
+        now = time.monotonic()
+        with self._lock:
+            slots = list(self._slots)
+            total = self._retired_bytes + sum(slot.bytes for slot in slots)
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            self.rate = (total - self._last_bytes) / elapsed
+            alpha = 1 - math.exp(-elapsed / self.TAU)
+            self.ewma = self.rate if self.ewma is None else self.ewma + alpha * (self.rate - self.ewma)
+        self._last_time, self._last_bytes = now, total
+        
+        stalled = []
+        # 正在拆分下载的片段不是一个连接：不计入每个连接的速度，检测窗口从各部分结束时开始
+        connections = []
+        for slot in slots:
+            if slot.children:
+                slot.mark_time, slot.mark_bytes = now, slot.bytes
+            else:
+                connections.append(slot)
+        if connections and self.ewma:
+            self.per_transfer = max(self.ewma / len(connections), self.per_transfer * self.REFERENCE_DECAY)
+        if not self.stall_seconds or not self.per_transfer:
+            return stalled
+        for slot in connections:
+            window = now - slot.mark_time
+            if window < self.stall_seconds:
+                continue
+            slot.speed = (slot.bytes - slot.mark_bytes) / window
+            if slot.speed < self.per_transfer * self.STALL_FRACTION and not slot.restart:
+                slot.restart = True
+                self.stalls += 1
+                stalled.append(slot)
+            slot.mark_time, slot.mark_bytes = now, slot.bytes
+        return stalled
+
+    def summary(self):
+        """任务结束时的汇总信息"""
+        total = self.total_bytes()
+        elapsed = time.monotonic() - self._start
+        text = (f"Received {total / 1024 / 1024:.1f} MB in {format_duration(elapsed)}, "
+                f"average {format_rate(total / elapsed if elapsed > 0 else 0)}")
+        if self.stalls:
+            text += f", {self.stalls} stalled connections restarted"
+        return text
+
+    def describe(self):
+        """状态日志中的速度说明"""
+        text = f"Speed: {format_rate(self.rate)} (avg {format_rate(self.ewma or 0)})"
+        eta = self.eta()
+        if eta is not None:
+            text += f", ETA {format_duration(eta)}"
+        return text
+
+def format_rate(rate):
+    """字节/秒 -> 便于阅读的速度"""
+    if rate >= 1024 * 1024:
+        return f"{rate / 1024 / 1024:.2f} MB/s"
+    return f"{rate / 1024:.2f} KB/s"
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class AdaptiveConcurrency:
+    """按TCP拥塞控制的思路动态调整同时下载的片段数
+
+    - 慢启动：每成功一个片段并发数+1，直到达到阈值或吞吐量不再明显增长
+    - 拥塞避免：每成功一个片段并发数+1/当前并发数
+    - 遇到429/503或超时：并发数减半（冷却时间内只减一次）
+    - 首字节时间明显高于最小值时（服务器排队）暂停增长
+    """
+
+    # 被视为限流的状态码
+    THROTTLE_STATUS = (429, 503)
+    # 统计聚合吞吐量的时间窗口（秒）
+    WINDOW = 2.0
+
+    def __init__(self, max_limit, initial_limit=4, status_callback=None, meter=None):
+        self.max_limit = max(1, max_limit)
+        self.status_callback = status_callback
+        self.meter = meter  # ThroughputMeter：按实际收到的字节计算窗口吞吐量，而不是只算完成的片段
+        self._limit = float(min(initial_limit, self.max_limit))
+        self._ssthresh = float(self.max_limit)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_cond = None
+        
+        # 测量数据
+        self._ttfb_ewma = None
+        self._ttfb_min = None
+        self._segment_rate_ewma = None  # 单个片段的下载速度（字节/秒）
+        self._throttled = 0
+        self._timeouts = 0
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_meter_bytes = meter.total_bytes() if meter is not None else 0
+        self._window_limit = self._limit
+        self._throughput = None  # 上一个窗口的聚合吞吐量（字节/秒）
+        self._last_decrease = 0.0
+        self._last_logged_limit = self.limit
+        self._last_log_time = 0.0
+        
+        # 并发数随时间的变化记录：(时间戳, 并发数)，以及出现过的最小/最大并发数
+        self.history = [(time.time(), self.limit)]
+        self._min_seen = self._max_seen = self.limit
+
+    @property
+    def limit(self):
+        return max(1, int(self._limit))
+
+    # ---- 并发闸门 ----
+    def acquire(self):
+        """线程引擎：等待直到进行中的请求数小于当前并发数"""
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def try_acquire(self):
+        """不等待：进行中的请求数小于当前并发数时占用一个并返回True（拆分下载的其他部分）"""
+        with self._cond:
+            if self._in_flight >= self.limit:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    async def acquire_async(self):
+        """异步引擎：与 acquire 相同，但在事件循环中等待"""
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        async with self._async_cond:
+            await self._async_cond.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def release_async(self):
+        async with self._async_cond:
+            self._in_flight -= 1
+            self._async_cond.notify(max(1, self.limit - self._in_flight))
+
+    # ---- 观察者接口（由下载函数调用）----
+    def on_response(self, status_code, ttfb):
+        if status_code in self.THROTTLE_STATUS:
+            self._congestion(f"HTTP {status_code}")
+            return
+        if ttfb is None:
+            return
+        with self._lock:
+            self._ttfb_min = ttfb if self._ttfb_min is None else min(self._ttfb_min, ttfb)
+            self._ttfb_ewma = ttfb if self._ttfb_ewma is None else 0.8 * self._ttfb_ewma + 0.2 * ttfb
+
+    def on_success(self, nbytes, elapsed):
+        reason = None
+        with self._lock:
+            self._window_bytes += nbytes
+            if elapsed > 0:
+                rate = nbytes / elapsed
+                self._segment_rate_ewma = rate if self._segment_rate_ewma is None else 0.8 * self._segment_rate_ewma + 0.2 * rate
+            
+            if self._delay_inflated():
+                # 服务器开始排队，退出慢启动并保持当前并发数
+                self._ssthresh = min(self._ssthresh, self._limit)
+            elif self._limit < self._ssthresh:
+                self._limit = min(self._limit + 1, self._ssthresh, self.max_limit)
+                reason = "slow start"
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+                reason = "congestion avoidance"
+            
+            self._end_window()
+            self._cond.notify_all()
+        if reason:
+            self._log_change(reason)
+
+    def on_failure(self, kind):
+        if kind == 'throttled':
+            self._congestion("rate limited")
+        elif kind == 'timeout':
+            self._congestion("timeout")
+
+    # ---- 内部实现 ----
+    def _delay_inflated(self):
+        """首字节时间的平滑值明显高于最小值时，认为服务器在排队"""
+        if self._ttfb_ewma is None or self._ttfb_min is None:
+            return False
+        return self._ttfb_ewma > 2 * self._ttfb_min + 0.05
+
+    def _end_window(self):
+        """每个时间窗口结束时计算聚合吞吐量；慢启动中并发数增加但吞吐量没有增长时退出慢启动"""
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.WINDOW:
+            return
+        if self.meter is not None:
+            # 包括还没有完成的片段已经收到的字节，大片段时窗口内可能一个片段都没有完成
+            meter_bytes = self.meter.total_bytes()
+            throughput = (meter_bytes - self._window_meter_bytes) / elapsed
+            self._window_meter_bytes = meter_bytes
+        else:
+            throughput = self._window_bytes / elapsed
+        if (self._throughput is not None and self._limit < self._ssthresh
+                and self._limit >= self._window_limit * 1.25
+                and throughput < self._throughput * 1.1):
+            self._ssthresh = self._limit
+        self._throughput = throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_limit = self._limit
+
+    def _congestion(self, reason):
+        """乘性减小：并发数减半，冷却时间内的重复信号只计数"""
+        with self._lock:
+            if reason == "timeout":
+                self._timeouts += 1
+            else:
+                self._throttled += 1
+            now = time.time()
+            cooldown = max(1.0, 2 * (self._ttfb_ewma or 0))
+            if now - self._last_decrease < cooldown:
+                return
+            self._last_decrease = now
+            self._ssthresh = max(self._limit / 2, 1.0)
+            self._limit = self._ssthresh
+        self._log_change(f"back off: {reason}")
+
+    def _log_change(self, reason):
+        """并发数变化时写入状态日志；增加时每秒最多一条，减小时总是记录"""
+        with self._lock:
+            limit = self.limit
+            now = time.time()
+            self._min_seen = min(self._min_seen, limit)
+            self._max_seen = max(self._max_seen, limit)
+            if limit == self._last_logged_limit:
+                return
+            if limit > self._last_logged_limit and now - self._last_log_time < 1:
+                return
+            old_limit = self._last_logged_limit
+            self._last_logged_limit = limit
+            self._last_log_time = now
+            self.history.append((now, limit))
+            message = f"Concurrency {old_limit} -> {limit} ({reason}): {self._describe()}"
+        if self.status_callback:
+            self.status_callback(message)
+
+    def _describe(self):
+        parts = []
+        if self._throughput is not None:
+            parts.append(f"{self._throughput / 1024 / 1024:.2f} MB/s total")
+        if self._segment_rate_ewma is not None:
+            parts.append(f"{self._segment_rate_ewma / 1024 / 1024:.2f} MB/s per segment")
+        if self._ttfb_ewma is not None:
+            parts.append(f"TTFB {self._ttfb_ewma * 1000:.0f} ms")
+        parts.append(f"{self._throttled} throttled, {self._timeouts} timeouts")
+        return ", ".join(parts)
+
+    def summary(self):
+        """任务结束时的汇总信息"""
+        with self._lock:
+            return (f"Adaptive concurrency: min {self._min_seen}, max {self._max_seen}, final {self.limit}; "
+                    f"{self._describe()}")
+
+class StreamingOutput:
+    """边下载边输出：把完成的片段按播放列表顺序写入追加的 .ts 文件或常驻ffmpeg进程的标准输入
+
+    乱序完成的片段暂存在有界的重排缓冲区中。下载线程在开始下载前调用 wait_for_slot，
+    只有片段序号落在 [下一个待写序号, 下一个待写序号 + window) 内且缓冲区未超过
+    max_buffer_bytes 时才允许开始，因此即使前面的片段卡住，内存占用也有上限。
+    """
+
+    def __init__(self, output_file, total, window, max_buffer_bytes, status_callback):
+        self.output_file = output_file
+        self.total = total
+        self.window = max(1, window)
+        self.max_buffer_bytes = max_buffer_bytes
+        self.status_callback = status_callback
+        self.missing = []  # 下载失败、在输出中被跳过的片段序号
+        self.error = None
+        self.closed = False  # finish() 或 abort() 已关闭输出
+        
+        self._aborted = False
+        self._next = 0
+        self._buffer = {}  # 序号 -> 片段内容（bytes）、本地文件路径（str）或None（失败）
+        self._buffered_bytes = 0
+        self._cond = threading.Condition()
+        self._process = None
+        self._out = None
+        self._writer = None
+
+    def start(self):
+        """打开输出并启动按顺序写入的后台线程"""
+        if self.output_file.lower().endswith('.ts'):
+            self._out = open(self.output_file, 'wb')
+        else:
+            # 常驻的ffmpeg进程从标准输入读取MPEG-TS流并直接封装为目标格式
+            cmd = [
+                'ffmpeg',
+                '-hide_banner',
+                '-loglevel', 'error',
+                '-f', 'mpegts',
+                '-i', 'pipe:0',
+                '-c', 'copy',
+                '-y',  # 覆盖输出文件（如果存在）
+                self.output_file
+            ]
+            self._process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=False
+            )
+            self._out = self._process.stdin
+            threading.Thread(target=self._read_ffmpeg_errors, daemon=True).start()
+        self._writer = threading.Thread(target=self._write_in_order, daemon=True)
+        self._writer.start()
+
+    def _read_ffmpeg_errors(self):
+        for line in self._process.stderr:
+            self.status_callback(line.decode('utf-8', errors='replace').rstrip())
+
+    def add_local(self, index, path):
+        """之前已下载到磁盘的片段：轮到它时直接从文件复制"""
+        with self._cond:
+            self._buffer[index] = path
+            self._cond.notify_all()
+
+    def wait_for_slot(self, index):
+        """下载片段前调用，等待重排缓冲区有空间；输出出错时返回False"""
+        with self._cond:
+            while self.error is None and not (
+                index < self._next + self.window
+                and (self._buffered_bytes < self.max_buffer_bytes or index == self._next)
+            ):
+                self._cond.wait()
+            return self.error is None
+
+    def submit(self, index, data):
+        """提交下载完成的片段内容"""
+        with self._cond:
+            self._buffer[index] = data
+            self._buffered_bytes += len(data)
+            self._cond.notify_all()
+
+    def skip(self, index):
+        """片段下载失败，输出中跳过它，避免后面的片段一直等待"""
+        with self._cond:
+            self._buffer[index] = None
+            self._cond.notify_all()
+
+    def _write_in_order(self):
+        while True:
+            with self._cond:
+                while self._next < self.total and self._next not in self._buffer and not self._aborted:
+                    self._cond.wait()
+                if self._next >= self.total or self._aborted:
+                    return
+                item = self._buffer.pop(self._next)
+            
+            try:
+                if item is None:
+                    self.missing.append(self._next)
+                elif isinstance(item, str):
+                    with open(item, 'rb') as f:
+                        shutil.copyfileobj(f, self._out)
+                else:
+                    self._out.write(item)
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                return
+            
+            with self._cond:
+                if isinstance(item, (bytes, bytearray)):
+                    self._buffered_bytes -= len(item)
+                self._next += 1
+                self._cond.notify_all()
+
+    def finish(self):
+        """等待所有片段写完并关闭输出，返回输出是否完整"""
+        self.closed = True
+        self._writer.join()
+        try:
+            self._out.close()
+        except Exception as e:
+            self.error = self.error or e
+        if self._process is not None:
+            self._process.wait()
+            if self._process.returncode != 0 and self.error is None:
+                self.error = RuntimeError(f"ffmpeg exited with code {self._process.returncode}")
+        return self.error is None and not self.missing
+
+    def abort(self):
+        """下载中途出错或提前返回时调用：停止写入线程和ffmpeg进程，删除写了一半的输出文件"""
+        with self._cond:
+            self.closed = self._aborted = True
+            self.error = self.error or RuntimeError("streaming output aborted")
+            self._cond.notify_all()
+        if self._process is not None:
+            # 先结束ffmpeg，写入线程阻塞在管道上时会因管道关闭而返回
+            self._process.kill()
+        if self._writer is not None:
+            self._writer.join()
+        try:
+            if self._out is not None:
+                self._out.close()
+        except OSError:
+            pass
+        if self._process is not None:
+            self._process.wait()
+        try:
+            os.remove(self.output_file)
+        except OSError:
+            pass
+
+class SegmentJournal:
+    """任务目录中的续传日志（SQLite），记录每个片段的序号、地址、状态、字节数、尝试次数和SHA-1
+
+    只有完整写入的片段才会被标记为 done，中断的下载在重新运行时一定会重新下载；
+    重新运行时用一次查询得到所有已完成的片段，不需要扫描目录和猜测文件名。
+    状态更新先放入队列，按批次在一个事务中写入。
+    """
+
+    FILENAME = 'journal.sqlite3'
+    # 队列中的更新达到该数量或距离上次写入超过该时间（秒）时写入数据库
+    FLUSH_BATCH = 500
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, save_path):
+        self.path = os.path.join(save_path, self.FILENAME)
+        self.created = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.time()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS segments ('
+                ' idx INTEGER PRIMARY KEY,'
+                ' url TEXT NOT NULL,'
+                ' filename TEXT,'
+                " state TEXT NOT NULL DEFAULT 'pending',"
+                ' expected_bytes INTEGER,'
+                ' actual_bytes INTEGER,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' sha1 TEXT,'
+                ' updated REAL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS segments_state ON segments (state)')
+            # playlist: 上次登记的播放列表的SHA-1
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    # 去掉查询参数后的地址（SQL表达式），签名参数变化时仍视为同一个片段
+    _RESOURCE_SQL = "CASE WHEN instr({0}, '?') THEN substr({0}, 1, instr({0}, '?') - 1) ELSE {0} END"
+
+    def sync(self, segments):
+        """登记播放列表中的片段，返回已完成片段的 {序号: 文件名}
+
+        序号对应的片段地址变了（播放列表内容不同）或文件已不存在时，该片段重新标记为未完成。
+        播放列表与上次相同时只按 state 索引查询已完成的片段，不同时放入临时表由SQLite比较；
+        只检查已完成片段的文件是否存在，不扫描目录。
+        """
+        playlist_hash = hashlib.sha1('\n'.join(segment.url for segment in segments).encode()).hexdigest()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'playlist'").fetchone()
+            if row is None or row[0] != playlist_hash:
+                self._reconcile(segments)
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('playlist', ?)", (playlist_hash,))
+            done = dict(self._db.execute("SELECT idx, filename FROM segments WHERE state = 'done'"))
+            # 文件已被删除的片段重新标记为未完成，重新运行时会再次下载
+            directory = os.path.dirname(self.path)
+            lost = [i for i, filename in done.items()
+                    if not filename or not os.path.exists(os.path.join(directory, filename))]
+            if lost:
+                self._db.executemany("UPDATE segments SET state = 'pending' WHERE idx = ?", [(i,) for i in lost])
+                for i in lost:
+                    del done[i]
+            return done
+
+    def _reconcile(self, segments):
+        """在事务内把日志中的片段与播放列表对齐：登记新片段、重置地址变了的片段、删除多出的片段"""
+        old_resource = self._RESOURCE_SQL.format('url')
+        new_resource = self._RESOURCE_SQL.format('(SELECT n.url FROM incoming n WHERE n.idx = segments.idx)')
+        self._db.execute('CREATE TEMP TABLE IF NOT EXISTS incoming (idx INTEGER PRIMARY KEY, url TEXT NOT NULL)')
+        self._db.execute('DELETE FROM incoming')
+        self._db.executemany('INSERT INTO incoming (idx, url) VALUES (?, ?)',
+                             ((i, segment.url) for i, segment in enumerate(segments)))
+        self._db.execute('INSERT OR IGNORE INTO segments (idx, url) SELECT idx, url FROM incoming')
+        # 地址变了的片段：只有查询参数不同（签名更新）时保留状态，否则重新下载
+        self._db.execute(
+            f"UPDATE segments SET state = CASE WHEN {old_resource} = {new_resource} THEN state ELSE 'pending' END,"
+            " url = (SELECT n.url FROM incoming n WHERE n.idx = segments.idx)"
+            " WHERE idx IN (SELECT n.idx FROM incoming n JOIN segments s ON s.idx = n.idx WHERE s.url != n.url)"
+        )
+        self._db.execute('DELETE FROM segments WHERE idx >= ?', (len(segments),))
+        self._db.execute('DELETE FROM incoming')
+
+    def import_existing(self, done, segments, validate=True):
+        """登记没有续传日志时就已存在的片段文件（旧版本下载的目录），done 为 [(序号, 文件路径)]
+
+        旧版本不区分中断的下载，只登记非空、并且（validate 为真时）通过MPEG-TS校验的文件，
+        其余片段保持未完成，会重新下载；返回登记的 {序号: 文件名}
+        """
+        now = time.time()
+        rows = []
+        for i, path in done:
+            try:
+                size = os.path.getsize(path)
+                if not size:
+                    continue
+                if validate and is_ts_segment(segments[i]) and validate_ts_file(path)[0] is not None:
+                    continue
+            except OSError:
+                continue
+            rows.append((os.path.basename(path), size, now, i))
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE segments SET state = 'done', filename = ?, actual_bytes = ?, updated = ? WHERE idx = ?",
+                rows
+            )
+        return {i: filename for filename, _, _, i in rows}
+
+    def record(self, index, state, filename=None, record=None):
+        """记录片段的下载结果：done（已写入文件）、streamed（已写入流式输出）或 failed"""
+        if record is not None:
+            row = (state, filename, record.expected, record.size, record.attempts, record.hash, time.time(), index)
+        else:
+            row = (state, filename, None, None, 1, None, time.time(), index)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.FLUSH_BATCH or time.time() - self._last_flush >= self.FLUSH_INTERVAL:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self._pending:
+            with self._db:
+                self._db.executemany(
+                    'UPDATE segments SET state = ?, filename = ?, expected_bytes = ?, actual_bytes = ?,'
+                    ' attempts = attempts + ?, sha1 = ?, updated = ? WHERE idx = ?',
+                    self._pending
+                )
+            self._pending = []
+        self._last_flush = time.time()
+
+    def done_files(self):
+        """已完整下载的片段的 {序号: 文件名}"""
+        with self._lock:
+            self._flush_locked()
+            return dict(self._db.execute("SELECT idx, filename FROM segments WHERE state = 'done'"))
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._db.close()
+
+# 签名/令牌过期时CDN返回的状态码
+EXPIRED_STATUS = (401, 403, 410)
+
+class TokenRefresher:
+    """片段地址的签名过期后自动恢复
+
+    多个片段连续因401/403/410失败时重新获取播放列表，把片段换成新的地址（新旧播放列表中的片段
+    按文件名和字节范围对应，文件名不唯一时按媒体序列号对应），之后的请求使用新地址，已完成的片段
+    不受影响。任务目录中的 refresh_url.txt 写入新的播放列表地址时，下一次刷新使用该地址。
+    同一时间只有一次刷新；下载过程中的刷新在后台线程中进行，获取播放列表时不持有锁。
+    """
+
+    CONTROL_FILE = 'refresh_url.txt'
+
+    def __init__(self, playlist_url, save_path, playlist, status_callback,
+                 threshold=3, max_refreshes=5, wait_seconds=0):
+        self.playlist_url = playlist_url
+        self.save_path = save_path
+        self.playlist = playlist
+        self.status_callback = status_callback
+        self.threshold = threshold
+        self.max_refreshes = max_refreshes
+        self.wait_seconds = wait_seconds
+        self.refreshes = 0
+        self._pass_refreshes = 0  # 本轮下载中已经做过的刷新次数
+        self._streak = set()  # 最近一次成功之后因过期失败的片段
+        self._expired = set()  # 本轮因过期失败、刷新后需要重新下载的片段
+        self._stuck = False  # 上一次刷新失败：不再自动重试，等待新地址
+        self._lock = threading.Lock()
+        self._idle = threading.Event()  # 没有正在进行的刷新时置位
+        self._idle.set()
+
+    @classmethod
+    def hand_over(cls, save_path, url):
+        """把新的播放列表地址交给正在运行的任务（写入控制文件）"""
+        path = os.path.join(save_path, cls.CONTROL_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(url + '\n')
+        os.replace(path + '.tmp', path)
+
+    def _control_url(self):
+        try:
+            with open(os.path.join(self.save_path, self.CONTROL_FILE), 'r', encoding='utf-8') as f:
+                url = f.read().strip()
+        except OSError:
+            return None
+        return url or None
+
+    def url(self, i):
+        """片段当前的地址"""
+        return self.playlist.segments[i].url
+
+    def report(self, i, success, status, url=None):
+        """记录片段的下载结果，连续过期的片段达到阈值（或已经提供了新地址）时立即刷新
+
+        url 为下载时使用的地址；刷新前就已经开始的请求用的是旧地址，它们的失败不再触发刷新。
+        刷新在后台线程中进行，不阻塞调用方（异步引擎在事件循环中调用）；已经在刷新时不再重复刷新
+        """
+        with self._lock:
+            if success:
+                self._streak.clear()
+                return
+            if status not in EXPIRED_STATUS:
+                return
+            self._expired.add(i)
+            if url is not None and url != self.url(i):
+                return
+            self._streak.add(i)
+            if self._control_url() is None and (len(self._streak) < self.threshold or self._stuck):
+                return
+            if not self._idle.is_set():
+                return
+            self._idle.clear()
+        threading.Thread(target=self._refresh, args=(status, True), daemon=True).start()
+
+    def retry_indices(self):
+        """一轮下载结束后返回需要用新地址重新下载的片段序号
+
+        本轮没有刷新过时先刷新；刷新失败时最多等待 wait_seconds 秒，直到控制文件中出现新地址。
+        """
+        # 等待下载过程中开始的后台刷新结束
+        self._idle.wait()
+        with self._lock:
+            expired = sorted(self._expired)
+            self._expired.clear()
+            self._streak.clear()
+            if not expired:
+                return []
+            refreshed = self._pass_refreshes > 0
+            stuck = self._stuck
+        if not refreshed and not stuck:
+            refreshed = self._refresh(None)
+        if not refreshed and self.wait_seconds > 0 and self.refreshes < self.max_refreshes:
+            control_path = os.path.join(self.save_path, self.CONTROL_FILE)
+            self.status_callback(f"Waiting up to {self.wait_seconds} s for a fresh playlist URL "
+                                 f"(paste it with the same save path, or write it to {control_path})")
+            deadline = time.time() + self.wait_seconds
+            while time.time() < deadline:
+                if self._control_url() is not None:
+                    refreshed = self._refresh(None)
+                    break
+                time.sleep(1)
+        with self._lock:
+            self._pass_refreshes = 0
+        return expired if refreshed else []
+
+    def _claim(self):
+        """等待正在进行的刷新结束并占用刷新"""
+        while True:
+            self._idle.wait()
+            with self._lock:
+                if self._idle.is_set():
+                    self._idle.clear()
+                    return
+
+    def _refresh(self, status, claimed=False):
+        """重新获取播放列表并更新片段地址，返回是否成功（调用方不能持有锁）
+
+        claimed 表示调用方已经占用了刷新（report 中清除了 _idle），否则先等待正在进行的刷新结束
+        """
+        if not claimed:
+            self._claim()
+        try:
+            with self._lock:
+                if self.refreshes >= self.max_refreshes:
                     return False
-    
-    return False
+                self.refreshes += 1
+                self._streak.clear()
+                url = self.playlist_url
+                control_url = self._control_url()
+                if control_url is not None:
+                    os.remove(os.path.join(self.save_path, self.CONTROL_FILE))
+                    url = normalize_m3u8_url(control_url) or control_url
+                self._stuck = True
+                refreshes = self.refreshes
+            
+            reason = f" (HTTP {status})" if status else ""
+            source = "the new URL" if control_url else "the playlist"
+            self.status_callback(f"Segment URLs appear to have expired{reason}, re-fetching {source} "
+                                 f"({refreshes}/{self.max_refreshes})")
+            try:
+                media_url, response = fetch_media_playlist(url, self.save_path, self.status_callback)
+            except requests.exceptions.RequestException as e:
+                self.status_callback(f"Playlist refresh failed: {e}")
+                return False
+            if response.status_code != 200:
+                self.status_callback(f"Playlist refresh failed (HTTP {response.status_code})")
+                return False
+            new_playlist = parse_media_playlist(response.text, media_url)
+            
+            with self._lock:
+                mapped, missing = self._remap(new_playlist)
+                if mapped:
+                    self._stuck = False
+                    self.playlist_url = media_url
+                    self._pass_refreshes += 1
+        finally:
+            self._idle.set()
+        if not mapped:
+            self.status_callback("The refreshed playlist does not contain the segments of this job")
+            return False
+        message = f"Playlist refreshed, {mapped} segment URLs updated"
+        if missing:
+            message += f", {missing} segments not found in the new playlist"
+        self.status_callback(message)
+        return True
 
-def check_network_speed():
-    """简单检测网络下载速度"""
-    try:
-        start_time = time.time()
-        response = requests.get("https://www.google.com", timeout=5)
-        end_time = time.time()
+    def _remap(self, new_playlist):
+        """用新播放列表中对应的片段替换当前片段，返回 (对应上的数量, 找不到的数量)"""
+        by_name = {}
+        duplicates = set()
+        for segment in new_playlist.segments:
+            key = (segment.filename, segment.byterange)
+            if key in by_name:
+                duplicates.add(key)
+            by_name[key] = segment
+        by_sequence = {segment.sequence: segment for segment in new_playlist.segments}
         
-        if response.status_code == 200:
-            # 计算响应时间（毫秒）
-            response_time = (end_time - start_time) * 1000
-            
-            # 根据响应时间估算网络状况
-            if response_time < 100:
-                return "fast"  # 快速网络
-            elif response_time < 500:
-                return "medium"  # 中等网络
-            else:
-                return "slow"  # 慢速网络
-    except:
-        pass
-    
-    return "unknown"  # 未知网络状况
+        segments = self.playlist.segments
+        mapped = missing = 0
+        for i, segment in enumerate(segments):
+            key = (segment.filename, segment.byterange)
+            new_segment = by_name.get(key) if key not in duplicates else None
+            if new_segment is None:
+                new_segment = by_sequence.get(segment.sequence)
+            if new_segment is None:
+                missing += 1
+                continue
+            segments[i] = new_segment
+            mapped += 1
+        return mapped, missing
+
+class JobShare:
+    """调度器分配给单个任务的连接配额，下载函数每次请求片段前 acquire，完成后 release"""
+
+    # 还不知道片段大小时，每次请求预估的字节数
+    DEFAULT_REQUEST_BYTES = 1024 * 1024
+
+    def __init__(self, scheduler, name, weight, priority):
+        self.scheduler = scheduler
+        self.name = name
+        self.weight = max(weight, 0.01)
+        self.priority = priority
+        self.vtime = 0.0  # 虚拟时间：已分配的字节数 / 权重
+        self.charges = deque()  # 进行中的请求在 acquire 时按预估字节数计入虚拟时间的值
+        self.waiting = 0
+        self.active = 0
+        self.bytes = 0
+        self.requests = 0
+        self.started = None
+        self.finished = None
+
+    def _estimate(self):
+        """每次请求预估的字节数（按已完成请求的平均值）"""
+        return self.bytes / self.requests if self.requests else self.DEFAULT_REQUEST_BYTES
+
+    # 异步引擎轮询名额的最长间隔（秒）
+    POLL_INTERVAL = 0.02
+
+    def acquire(self):
+        self.scheduler._acquire(self)
+
+    async def acquire_async(self):
+        """异步引擎：在事件循环中轮询名额，不占用线程池的线程（密钥请求等也在线程池中执行）"""
+        self.scheduler._wait(self)
+        delay = 0.001
+        try:
+            while not self.scheduler._try_acquire(self):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.POLL_INTERVAL)
+        except BaseException:
+            # 等待中被取消
+            self.scheduler._stop_waiting(self)
+            raise
+
+    def release(self, nbytes=0):
+        self.scheduler._release(self, nbytes)
+
+    def try_acquire_extra(self):
+        """不等待地多占一个连接（拆分下载的其他部分），字节数计在主请求上；没有空闲连接时返回False"""
+        return self.scheduler._try_acquire_extra(self)
+
+    def release_extra(self):
+        self.scheduler._release_extra(self)
 
-def download_ts_files(m3u8_url, save_path, progress_callback, status_callback):
+class JobScheduler:
+    """多个下载任务同时运行、共用一组连接的调度器
+
+    - 同时运行的任务数不超过 max_jobs，排队的任务按优先级（大的先）和提交顺序启动
+    - 所有任务的片段请求共用 max_connections 个连接；有连接空出时交给优先级最高的等待中的任务，
+      优先级相同时交给虚拟时间（已下载字节数 / 权重）最小的，按权重公平分配带宽，
+      片段很大或很多的任务也不会占满所有连接；优先级高的任务只占用它自己的线程数，其余连接仍分给其他任务
+    - 新启动的任务从当前最小的虚拟时间开始计算，不会因为之前没有下载而暂时独占连接
+    """
+
+    def __init__(self, max_connections, max_jobs, status_callback=None):
+        self.max_connections = max(1, max_connections)
+        self.max_jobs = max(1, max_jobs)
+        self.status_callback = status_callback
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._running = []  # 正在运行的任务的 JobShare
+        self._queue = []  # 等待启动的 (-优先级, 提交序号, JobShare, 任务函数)
+        self._submitted = 0
+        self._threads = []
+
+    def submit(self, func, name, weight=1.0, priority=0):
+        """提交任务：func(share) 在独立线程中运行，返回 JobShare"""
+        share = JobShare(self, name, weight, priority)
+        with self._cond:
+            self._submitted += 1
+            self._queue.append((-priority, self._submitted, share, func))
+            self._queue.sort(key=lambda item: item[:2])
+            self._start_ready()
+        return share
+
+    def _start_ready(self):
+        """在锁内启动排队的任务，直到运行中的任务数达到上限"""
+        while self._queue and len(self._running) < self.max_jobs:
+            _, _, share, func = self._queue.pop(0)
+            share.vtime = min((s.vtime for s in self._running), default=0.0)
+            share.started = time.time()
+            self._running.append(share)
+            thread = threading.Thread(target=self._run, args=(share, func), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self, share, func):
+        metrics.job_started()
+        try:
+            func(share)
+        finally:
+            metrics.job_finished()
+            share.finished = time.time()
+            if self.status_callback is not None:
+                self.status_callback(
+                    f"{share.name}: {share.bytes / 1024 / 1024:.1f} MB in {share.requests} requests, "
+                    f"{share.finished - share.started:.1f} s"
+                )
+            with self._cond:
+                self._running.remove(share)
+                self._start_ready()
+                self._cond.notify_all()
+
+    def _next_share(self):
+        """等待中的任务里优先级最高、其次虚拟时间最小的一个"""
+        best = None
+        for share in self._running:
+            if share.waiting and (best is None or (-share.priority, share.vtime) < (-best.priority, best.vtime)):
+                best = share
+        return best
+
+    def _acquire(self, share):
+        with self._cond:
+            share.waiting += 1
+            while self._in_use >= self.max_connections or self._next_share() is not share:
+                self._cond.wait()
+            self._grant(share)
+
+    def _wait(self, share):
+        """异步引擎：登记为等待中的请求，之后用 _try_acquire 轮询"""
+        with self._cond:
+            share.waiting += 1
+
+    def _stop_waiting(self, share):
+        with self._cond:
+            share.waiting -= 1
+            self._cond.notify_all()
+
+    def _try_acquire(self, share):
+        with self._cond:
+            if self._in_use >= self.max_connections or self._next_share() is not share:
+                return False
+            self._grant(share)
+            return True
+
+    def _grant(self, share):
+        """在锁内把一个连接分给等待中的 share"""
+        share.waiting -= 1
+        share.active += 1
+        self._in_use += 1
+        # 先按预估的字节数计入虚拟时间，完成后减去同样的值、加上实际字节数
+        charge = share._estimate() / share.weight
+        share.charges.append(charge)
+        share.vtime += charge
+        self._cond.notify_all()
+
+    def _release(self, share, nbytes):
+        with self._cond:
+            share.vtime += nbytes / share.weight - share.charges.popleft()
+            share.bytes += nbytes
+            share.requests += 1
+            share.active -= 1
+            self._in_use -= 1
+            self._cond.notify_all()
+
+    def _try_acquire_extra(self, share):
+        with self._cond:
+            # 其他任务在等待连接时不多占
+            if self._in_use >= self.max_connections or self._next_share() not in (None, share):
+                return False
+            share.active += 1
+            self._in_use += 1
+            return True
+
+    def _release_extra(self, share):
+        with self._cond:
+            share.active -= 1
+            self._in_use -= 1
+            self._cond.notify_all()
+
+    def resize(self, max_connections, max_jobs):
+        """修改连接数和同时运行的任务数，立即生效"""
+        with self._cond:
+            self.max_connections = max(1, max_connections)
+            self.max_jobs = max(1, max_jobs)
+            self._start_ready()
+            self._cond.notify_all()
+
+    @property
+    def queued(self):
+        """等待启动的任务数"""
+        with self._cond:
+            return len(self._queue)
+
+    def wait(self):
+        """等待所有已提交的任务完成"""
+        with self._cond:
+            while self._queue or self._running:
+                self._cond.wait()
+
+def download_ts_files(m3u8_url, save_path, progress_callback, status_callback, share=None):
     """多线程下载 .ts 文件"""
+    journal = None
+    speed_stop = None
+    stream = None
     try:
-        # 解析URL，保留查询参数
-        parsed_url = urlparse(m3u8_url)
-        
-        # 获取基础URL（不包含文件名和查询参数）
-        base_path = parsed_url.path
-        if 'index.m3u8' in base_path or '.m3u8' in base_path:
-            base_path = '/'.join(base_path.split('/')[:-1]) + '/'
-        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}{base_path}"
-        
-        # 保存查询参数，可能包含认证信息
-        query_params = parsed_url.query
-        
-        # 添加浏览器样式的请求头
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Referer': f"{parsed_url.scheme}://{parsed_url.netloc}/",
-            'Origin': f"{parsed_url.scheme}://{parsed_url.netloc}"
-        }
-        
         # 获取playlist.m3u8文件内容
-        playlist_path = os.path.join(save_path, 'playlist.m3u8')
-        if not os.path.exists(playlist_path):
+        playlist = load_saved_playlist(save_path, m3u8_url)
+        if playlist is None:
             status_callback("playlist.m3u8 file not found. Please download the m3u8 file first.")
             return False
-            
-        with open(playlist_path, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()
-        
-        # 处理ts文件URL，确保保留查询参数
-        ts_urls = []
-        ts_filenames = []  # 存储原始文件名（不含查询参数）
+
+        # fMP4/CMAF 片段需要 EXT-X-MAP 的初始化数据才能播放，下载和合并只支持 MPEG-TS
+        if any(segment.init_section is not None for segment in playlist.segments):
+            status_callback("The playlist uses fMP4/CMAF segments (EXT-X-MAP), which are not supported: "
+                            "only MPEG-TS playlists can be downloaded and merged.")
+            return False
+
+        # 没有 EXT-X-ENDLIST 的直播/事件播放列表
+        if not playlist.end_list and playlist.playlist_type != 'VOD':
+            if settings.get('live_record'):
+                return record_live(m3u8_url, save_path, progress_callback, status_callback, share)
+            status_callback("The playlist has no EXT-X-ENDLIST (live stream): only the segments listed right now "
+                            "are downloaded. Enable live recording to capture the stream.")
         
-        # 改进的M3U8解析逻辑
-        for i, line in enumerate(lines):
-            line = line.strip()
-            # 跳过注释行和空行
-            if line.startswith('#') or not line:
-                continue
-                
-            # 处理不同类型的URL
-            if line.startswith('http'):
-                # 绝对URL
-                ts_url = line
-            elif line.startswith('/'):
-                # 从域名根路径开始的URL
-                ts_url = f"{parsed_url.scheme}://{parsed_url.netloc}{line}"
-            else:
-                # 相对URL
-                ts_url = f"{base_url}{line}"
-            
-            # 如果原始URL有查询参数，且ts_url没有，添加这些参数
-            # 注意：如果ts_url已经有自己的查询参数，则不添加m3u8的查询参数
-            if query_params and '?' not in ts_url:
-                ts_url = f"{ts_url}?{query_params}"
-            
-            # 提取原始文件名（不含查询参数）
-            if '?' in line:
-                original_filename = line.split('?')[0]
-            else:
-                original_filename = line
-            
-            # 如果文件名包含路径，只保留文件名部分
-            if '/' in original_filename:
-                original_filename = original_filename.split('/')[-1]
-            
-            ts_filenames.append(original_filename)
-            ts_urls.append(ts_url)
+        # 片段URL（保留查询参数）和原始文件名（不含查询参数）
+        ts_urls = [segment.url for segment in playlist.segments]
+        ts_filenames = [segment.filename for segment in playlist.segments]
         
         if not ts_urls:
             status_callback("No TS files found in the m3u8 playlist.")
             return False
 
+        # 加密的流：AES-128 边下载边解密，其他加密方式（如SAMPLE-AES）无法处理，按原样保存
+        methods = {key.method for key in playlist.keys if key.method != 'NONE'}
+        cipher_for = None
+        if 'AES-128' in methods:
+            if aes_backend is None:
+                status_callback("The stream is AES-128 encrypted. Install 'cryptography' or 'pycryptodome' to decrypt it.")
+                return False
+            key_cache = KeyCache()
+            segments = playlist.segments
+            cipher_for = lambda i: key_cache.cipher_for(segments[i])
+            key_count = len({key.url for key in playlist.keys if key.method == 'AES-128'})
+            status_callback(f"Stream is AES-128 encrypted with {key_count} key(s), decrypting while downloading")
+        unsupported = methods - {'AES-128'}
+        if unsupported:
+            status_callback(f"Unsupported encryption {', '.join(sorted(unsupported))}, segments will be saved without decryption")
+
         total_files = len(ts_urls)
         success_files = []
         failed_files = []
 
-        # 检查已下载的文件，跳过已存在的文件
-        existing_files = set(os.listdir(save_path))
+        # BYTERANGE 片段共用同一个资源文件名，只能按序号保存
+        has_byterange = any(segment.byterange for segment in playlist.segments)
+        if has_byterange:
+            ts_filenames = [f"{i:04d}.ts" if segment.byterange else segment.filename
+                            for i, segment in enumerate(playlist.segments)]
+        
+        # 从续传日志中一次查询出已完整下载的片段（与当时使用的文件名无关）
+        journal = SegmentJournal(save_path)
+        completed = journal.sync(playlist.segments)
+        if journal.created:
+            # 没有续传日志的旧任务目录：按文件名识别已存在的片段并登记到日志中
+            existing_files = set(os.listdir(save_path))
+            legacy = []
+            for i, original_filename in enumerate(ts_filenames):
+                for name in (f"{i:04d}.ts", original_filename):
+                    if name in existing_files:
+                        legacy.append((i, os.path.join(save_path, name)))
+                        break
+            if legacy:
+                completed = journal.import_existing(legacy, playlist.segments, settings.get('validate_segments', True))
+                status_callback(f"Imported {len(completed)} existing segment files into the resume journal")
+                if len(completed) < len(legacy):
+                    status_callback(f"{len(legacy) - len(completed)} existing segment files are empty or damaged "
+                                    "and will be downloaded again")
         
         # 过滤出需要下载的文件
         filtered_ts_urls = []
         for i, (ts_url, original_filename) in enumerate(zip(ts_urls, ts_filenames)):
-            # 检查是否已下载（两种可能的文件名）
-            numbered_filename = f"{i:04d}.ts"
-            if original_filename in existing_files or numbered_filename in existing_files:
-                # 文件已存在，跳过
-                success_files.append((i, ts_url, original_filename))
+            if i in completed:
+                # 已完整下载，跳过
+                success_files.append((i, ts_url, completed[i]))
                 continue
             filtered_ts_urls.append((i, ts_url, original_filename))
+        metrics.segment_result('skipped', len(success_files), queued=False)
 
         # 已下载文件的数量
         completed_files = len(success_files)
@@ -463,90 +3366,403 @@ def download_ts_files(m3u8_url, save_path, progress_callback, status_callback):
         status_callback(f"Total TS files: {total_files}, Already downloaded: {completed_files}, Need to download: {len(filtered_ts_urls)}")
         progress_callback(completed_files, total_files)  # 初始化进度条
 
-        if not filtered_ts_urls:
+        # 边下载边输出模式：'ts' 追加写入 output.ts，'mp4' 通过ffmpeg标准输入封装为 output.mp4
+        streaming_output = settings.get('streaming_output', '')
+        
+        if not filtered_ts_urls and not streaming_output:
             status_callback("All files already downloaded. You can merge them now.")
             return True
 
-        # 确定最佳线程数
-        # 根据网络条件和文件数量动态调整线程数
-        network_speed = check_network_speed()
+        # 根据设置决定使用原始文件名还是序号文件名
+        use_original_filenames = settings.get('use_original_filenames', False)
+        
+        download_tasks = []
+        for i, ts_url, original_filename in filtered_ts_urls:
+            if use_original_filenames:
+                # 使用原始文件名
+                target_filename = original_filename
+            else:
+                # 使用序号文件名
+                target_filename = f"{i:04d}.ts"
+            download_tasks.append((i, ts_url, target_filename))
+        
+        # 按实际收到的字节统计速度和剩余时间，找出卡住的连接
+        meter = ThroughputMeter(settings.get('stall_seconds', 10))
+        
+        # 片段地址的签名过期时重新获取播放列表，更新 playlist.segments 中片段的地址
+        refresher = None
+        if settings.get('token_refresh', True):
+            refresher = TokenRefresher(
+                m3u8_url, save_path, playlist, status_callback,
+                threshold=settings.get('token_refresh_failures', 3),
+                max_refreshes=settings.get('token_refresh_limit', 5),
+                wait_seconds=settings.get('token_refresh_wait', 120)
+            )
+        
+        def record_result(i, ts_url, filename, success, record=None):
+            """记录单个片段的下载结果并更新进度和续传日志（两种下载引擎共用）"""
+            if refresher is not None:
+                if record is not None:
+                    refresher.report(i, success, record.status, record.url)
+                else:
+                    refresher.report(i, success, None)
+            metrics.segment_result('done' if success else 'failed')
+            if success:
+                success_files.append((i, ts_url, filename))
+                # 流式输出模式下片段没有单独的文件，重新运行时仍需下载
+                journal.record(i, 'streamed' if stream is not None else 'done', filename, record)
+                
+                meter.segment_done(i, record.size if record is not None else 0)
+                
+                # 更新下载进度
+                progress_callback(len(success_files), total_files)
+            else:
+                meter.segment_failed(i)
+                failed_files.append((i, ts_url, filename))
+                journal.record(i, 'failed', filename, record)
+                status_callback(f"Failed to download: {filename}")
+        
+        # 下载后校验片段的MPEG-TS结构（HTML错误页、截断、空内容等），损坏的片段重新下载；
+        # fMP4/CMAF和打包音频的片段不校验
+        validate = settings.get('validate_segments', True)
+        check_retries = settings.get('validate_retries', 2) if validate else 0
+        validation = {'checked': 0, 'corrupt': 0, 'continuity': 0}
+        validation_lock = threading.Lock()
+        
+        def check_segment(i, path, data, attempt):
+            """校验下载的片段（文件或内存中的内容），未通过时删除文件并返回False"""
+            if not validate or not is_ts_segment(playlist.segments[i]):
+                return True
+            problem, continuity_errors = validate_ts_file(path) if path is not None else validate_ts_data(data)
+            with validation_lock:
+                validation['checked'] += 1
+                if continuity_errors and problem is None:
+                    validation['continuity'] += 1
+                if problem is not None:
+                    validation['corrupt'] += 1
+            if problem is None:
+                return True
+            action = "downloading it again" if attempt < check_retries else "giving up"
+            status_callback(f"Segment {i} is corrupt ({problem}), {action}")
+            metrics.on_failure(segment_url(i), 'corrupt')
+            if attempt < check_retries:
+                metrics.on_retry(segment_url(i))
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            return False
         
-        if network_speed == "fast":
-            optimal_threads = settings['max_threads']
-        elif network_speed == "medium":
-            optimal_threads = min(20, settings['max_threads'])
-        elif network_speed == "slow":
-            optimal_threads = min(10, settings['max_threads'])
+        # 根据设置选择下载引擎
+        engine = settings.get('download_engine', 'thread')
+        if engine == 'async' and aiohttp is None:
+            status_callback("aiohttp is not installed, falling back to the thread engine.")
+            engine = 'thread'
+        if engine == 'async' and streaming_output:
+            status_callback("Streaming output uses the thread engine.")
+            engine = 'thread'
+        if engine == 'async' and has_byterange:
+            status_callback("Byte-range playlists use the thread engine.")
+            engine = 'thread'
+        if settings.get('http2') and urlparse(ts_urls[0]).scheme == 'https':
+            if httpx is None:
+                status_callback("HTTP/2 needs 'httpx' with HTTP/2 support (pip install httpx[http2]), using HTTP/1.1.")
+            elif engine == 'async':
+                # aiohttp 只支持HTTP/1.1，HTTP/2 的多路复用在线程引擎中使用
+                status_callback("HTTP/2 uses the thread engine.")
+                engine = 'thread'
+        
+        # 片段很大时（只有少数几个片段），每个片段拆分为多个Range请求并行下载，
+        # 避免CDN按连接限速时线程池大部分时间空闲；用第一个待下载片段的大小判断
+        split_connections = settings.get('split_connections', 4)
+        split_threshold = settings.get('split_threshold_mb', 32) * 1024 * 1024
+        split_large = False
+        probed_sizes = {}  # 片段地址 -> HEAD得到的大小，重试时不再重复请求
+        if (split_connections > 1 and download_tasks and not streaming_output
+                and not has_byterange and cipher_for is None):
+            first_size = probed_sizes[download_tasks[0][1]] = probe_segment_size(download_tasks[0][1])
+            split_large = first_size is not None and first_size >= split_threshold
+            if split_large:
+                status_callback(f"Large segments ({first_size / 1024 / 1024:.1f} MB), "
+                                f"downloading each with up to {split_connections} connections")
+                if engine == 'async':
+                    status_callback("Split segment downloads use the thread engine.")
+                    engine = 'thread'
+        
+        # 并发数上限：线程引擎为线程数，异步引擎为并发请求数
+        if engine == 'async':
+            max_workers = settings.get('async_concurrency', 100)
         else:
-            optimal_threads = settings['max_threads']
+            max_workers = settings['max_threads']
+        
+        # 根据下载过程中的实际吞吐量、首字节时间和限流情况动态调整并发数
+        controller = None
+        if settings.get('adaptive_concurrency', True):
+            controller = AdaptiveConcurrency(max_workers, status_callback=status_callback, meter=meter)
+            status_callback(f"Adaptive concurrency enabled: starting at {controller.limit}, up to {max_workers}")
+        
+        stream = None
+        if streaming_output:
+            output_file = os.path.join(save_path, f"output.{streaming_output}")
+            stream = StreamingOutput(
+                output_file,
+                total_files,
+                window=max_workers * 4,
+                max_buffer_bytes=settings.get('stream_buffer_mb', 256) * 1024 * 1024,
+                status_callback=status_callback
+            )
+            # 之前已下载到磁盘的片段直接从文件写入输出
+            for i, ts_url, filename in success_files:
+                stream.add_local(i, os.path.join(save_path, filename))
+            stream.start()
+            status_callback(f"Streaming segments into {output_file}")
         
-        status_callback(f"Network condition: {network_speed}, using {optimal_threads} download threads")
+        # 片段当前的地址（签名过期刷新后会变）
+        segment_url = lambda i: playlist.segments[i].url
         
-        # 使用优化后的线程数
-        with ThreadPoolExecutor(max_workers=optimal_threads) as executor:
-            future_to_url = {}
+        if engine == 'async':
+            status_callback(f"Using async download engine with up to {max_workers} concurrent requests")
+        else:
+            status_callback(f"Using up to {max_workers} download threads")
             
-            # 根据设置决定使用原始文件名还是序号文件名
-            use_original_filenames = settings.get('use_original_filenames', False)
+            def download_task(i, ts_url, ts_file_path):
+                """下载单个片段，返回 (是否成功, TransferRecord)"""
+                ts_url = segment_url(i)
+                record = TransferRecord(ts_url)
+                return download_segment(i, ts_url, ts_file_path, record), record
             
-            for i, ts_url, original_filename in filtered_ts_urls:
-                if use_original_filenames:
-                    # 使用原始文件名
-                    target_filename = original_filename
-                else:
-                    # 使用序号文件名
-                    target_filename = f"{i:04d}.ts"
-                
-                future = executor.submit(
-                    download_single_ts, 
-                    ts_url, 
-                    os.path.join(save_path, target_filename)
-                )
-                future_to_url[future] = (i, ts_url, target_filename)
+            def download_split(ts_url, ts_file_path, size, record):
+                """拆分下载一个大片段：除了已占用的一个连接，每个部分再向并发控制和调度器各占一个连接，
+                只用能立即得到的（等待可能与其他片段互相占着连接而卡住），一个都没有时返回False"""
+                extra = 0
+                while extra < split_connections - 1:
+                    if controller is not None and not controller.try_acquire():
+                        break
+                    if share is not None and not share.try_acquire_extra():
+                        if controller is not None:
+                            controller.release()
+                        break
+                    extra += 1
+                if not extra:
+                    return False
+                try:
+                    return download_single_ts_split(ts_url, ts_file_path, size, extra + 1, observer=controller,
+                                                    record=record)
+                finally:
+                    for _ in range(extra):
+                        if share is not None:
+                            share.release_extra()
+                        if controller is not None:
+                            controller.release()
             
-            # 用于计算下载速度
-            start_time = time.time()
-            downloaded_bytes = 0
-            last_update_time = start_time
+            def download_segment(i, ts_url, ts_file_path, record):
+                if stream is not None and not stream.wait_for_slot(i):
+                    return False
+                try:
+                    # 密钥在第一次使用时下载，之后从缓存中取
+                    cipher = cipher_for(i) if cipher_for is not None else None
+                except Exception as e:
+                    status_callback(f"Failed to get key for segment {i}: {e}")
+                    if stream is not None:
+                        stream.skip(i)
+                    return False
+                # 校验未通过时重新下载
+                for check in range(check_retries + 1):
+                    data = None
+                    if controller is not None:
+                        controller.acquire()
+                    if share is not None:
+                        share.acquire()
+                    started = metrics.segment_started()
+                    success = False
+                    try:
+                        with meter.transfer(i, record):
+                            if stream is None:
+                                if split_large:
+                                    if ts_url not in probed_sizes:
+                                        probed_sizes[ts_url] = probe_segment_size(ts_url)
+                                    size = probed_sizes[ts_url]
+                                    if size is not None and size >= split_threshold:
+                                        # 拆分下载失败（例如服务器实际不支持Range）时改为普通下载
+                                        success = download_split(ts_url, ts_file_path, size, record)
+                                if not success:
+                                    success = download_single_ts(ts_url, ts_file_path, observer=controller,
+                                                                 cipher=cipher, record=record)
+                            else:
+                                data = download_segment_bytes(ts_url, observer=controller, cipher=cipher, record=record)
+                                success = data is not None
+                    finally:
+                        metrics.segment_finished(started, success)
+                        if share is not None:
+                            share.release(record.size)
+                        if controller is not None:
+                            controller.release()
+                    if not success or check_segment(i, ts_file_path if stream is None else None, data, check):
+                        break
+                    success = False
+                
+                if stream is None:
+                    return success
+                # 片段内容直接进入重排缓冲区，不写入单独的 .ts 文件
+                if not success:
+                    stream.skip(i)
+                    return False
+                stream.submit(i, data)
+                return True
             
-            # 处理完成的任务
-            for future in as_completed(future_to_url):
-                i, ts_url, filename = future_to_url[future]
+            def download_range_task(group):
+                """一次Range请求下载一组首尾相接的片段，返回每个片段的 (是否成功, TransferRecord)"""
+                first = group[0][0]
+                if stream is not None and not stream.wait_for_slot(first):
+                    return [(False, None)] * len(group)
                 try:
-                    success = future.result()
-                    if success:
-                        success_files.append((i, ts_url, filename))
-                        
-                        # 更新下载进度
-                        progress_callback(len(success_files), total_files)
-                        
-                        # 计算下载速度
-                        if settings.get('show_speed', True):
-                            current_time = time.time()
-                            if current_time - last_update_time >= 1:  # 每秒更新一次
-                                try:
-                                    file_size = os.path.getsize(os.path.join(save_path, filename))
-                                    downloaded_bytes += file_size
-                                    elapsed_time = current_time - start_time
-                                    speed = downloaded_bytes / elapsed_time / 1024  # KB/s
-                                    
-                                    if speed > 1024:
-                                        speed_str = f"{speed/1024:.2f} MB/s"
-                                    else:
-                                        speed_str = f"{speed:.2f} KB/s"
-                                        
-                                    status_callback(f"Downloaded: {len(success_files)}/{total_files}, Speed: {speed_str}")
-                                    last_update_time = current_time
-                                except:
-                                    pass
-                    else:
-                        failed_files.append((i, ts_url, filename))
-                        status_callback(f"Failed to download: {filename}")
+                    ciphers = [cipher_for(i) for i, _, _ in group] if cipher_for is not None else None
                 except Exception as e:
-                    failed_files.append((i, ts_url, filename))
-                    status_callback(f"Error downloading {filename}: {str(e)}")
+                    status_callback(f"Failed to get key for segment {first}: {e}")
+                    ciphers = False
+                
+                parts = None
+                group_record = TransferRecord(segment_url(first))
+                if ciphers is not False:
+                    ranges = [playlist.segments[i].byterange for i, _, _ in group]
+                    # 有片段校验未通过时重新下载整组
+                    for check in range(check_retries + 1):
+                        if controller is not None:
+                            controller.acquire()
+                        if share is not None:
+                            share.acquire()
+                        started = metrics.segment_started()
+                        try:
+                            with meter.transfer(first):
+                                parts = download_range_group(group_record.url, ranges, observer=controller,
+                                                             ciphers=ciphers, record=group_record)
+                        finally:
+                            metrics.segment_finished(started, parts is not None)
+                            if share is not None:
+                                share.release(sum(map(len, parts)) if parts else 0)
+                            if controller is not None:
+                                controller.release()
+                        if parts is None or all([check_segment(i, None, part, check)
+                                                 for (i, _, _), part in zip(group, parts)]):
+                            break
+                        parts = None
+                
+                results = []
+                for n, (i, _, filename) in enumerate(group):
+                    if parts is None:
+                        if stream is not None:
+                            stream.skip(i)
+                        results.append((False, group_record))
+                        continue
+                    record = TransferRecord()
+                    record.start()
+                    record.update(parts[n])
+                    # 字节范围的长度（密文）已在 download_range_group 中检查，写入的是解密后的内容
+                    record.expected = len(parts[n]) if ciphers and ciphers[n] else playlist.segments[i].byterange[0]
+                    if stream is not None:
+                        stream.submit(i, parts[n])
+                    else:
+                        with open(os.path.join(save_path, filename), 'wb') as f:
+                            f.write(parts[n])
+                    results.append((True, record))
+                return results
+            
+        def run_pass(download_tasks):
+            """用选定的引擎下载一批片段，结果通过 record_result 记录"""
+            metrics.queue_segments(len(download_tasks))
+            meter.expect({i: playlist.segments[i].duration for i, _, _ in download_tasks})
+            if engine == 'async':
+                asyncio.run(download_ts_files_async(download_tasks, save_path, record_result, max_workers, controller,
+                                                    cipher_for, check_segment, check_retries, share, segment_url,
+                                                    meter))
+                return
+            
+            # BYTERANGE 片段按组下载，其他片段每个一个任务；
+            # 每组不超过设置的上限，同时保证分出的组足够让所有线程都有事做
+            range_bytes = sum(playlist.segments[i].byterange[0] for i, _, _ in download_tasks
+                              if playlist.segments[i].byterange)
+            max_group_bytes = min(settings.get('range_merge_mb', 16) * 1024 * 1024,
+                                  max(1, -(-range_bytes // max_workers)))
+            task_groups = plan_range_requests(download_tasks, playlist.segments, max_group_bytes)
+            if has_byterange:
+                range_groups = [group for group in task_groups if playlist.segments[group[0][0]].byterange]
+                status_callback(f"{sum(map(len, range_groups))} byte-range segments in {len(range_groups)} requests")
+            
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                future_to_url = {}
+                
+                for group in task_groups:
+                    i, ts_url, target_filename = group[0]
+                    if playlist.segments[i].byterange is not None:
+                        future = executor.submit(download_range_task, group)
+                    else:
+                        future = executor.submit(
+                            download_task, 
+                            i,
+                            ts_url, 
+                            os.path.join(save_path, target_filename)
+                        )
+                    future_to_url[future] = group
+                
+                # 处理完成的任务
+                for future in as_completed(future_to_url):
+                    group = future_to_url[future]
+                    try:
+                        result = future.result()
+                        if not isinstance(result, list):
+                            result = [result]
+                        for (i, ts_url, filename), (success, record) in zip(group, result):
+                            record_result(i, ts_url, filename, success, record)
+                    except Exception as e:
+                        metrics.segment_result('failed', len(group))
+                        for i, ts_url, filename in group:
+                            failed_files.append((i, ts_url, filename))
+                            status_callback(f"Error downloading {filename}: {str(e)}")
+        
+        # 测速线程：每秒更新速度，要求卡住的连接重新连接，并在状态日志中显示速度和剩余时间
+        def report_speed():
+            while not speed_stop.wait(1):
+                for slot in meter.sample():
+                    status_callback(f"Segment {slot.label} is stalled ({format_rate(slot.speed)}), reconnecting")
+                if settings.get('show_speed', True):
+                    status_callback(f"Downloaded: {len(success_files)}/{total_files}, {meter.describe()}")
+        
+        speed_stop = threading.Event()
+        threading.Thread(target=report_speed, daemon=True).start()
+        
+        run_pass(download_tasks)
+        # 因签名过期失败的片段在刷新播放列表后用新地址重新下载
+        # （流式输出中失败的片段已经被跳过，不再重新下载）
+        while refresher is not None and stream is None:
+            expired = set(refresher.retry_indices())
+            if not expired:
+                break
+            retry_tasks = [(i, segment_url(i), filename) for i, _, filename in failed_files if i in expired]
+            failed_files[:] = [entry for entry in failed_files if entry[0] not in expired]
+            status_callback(f"Downloading {len(retry_tasks)} expired segments again with the refreshed URLs")
+            run_pass(retry_tasks)
+        
+        speed_stop.set()
+        status_callback(meter.summary())
+        if controller is not None:
+            status_callback(controller.summary())
+        if validate and validation['checked']:
+            message = f"Validated {validation['checked']} downloads, {validation['corrupt']} corrupt"
+            if validation['continuity']:
+                message += f", {validation['continuity']} with continuity counter gaps"
+            status_callback(message)
+        
+        if stream is not None:
+            if stream.finish():
+                status_callback(f"Streaming output completed: {stream.output_file}")
+            elif stream.error is not None:
+                status_callback(f"Streaming output failed: {stream.error}")
+                return False
+            else:
+                status_callback(f"Streaming output is missing {len(stream.missing)} segments: {stream.output_file}")
         
         # 下载完成后的统计
+        report = memory_report()
+        if report:
+            status_callback(f"Memory: {report}")
         if failed_files:
             status_callback(f"Download completed with errors. {len(success_files)} succeeded, {len(failed_files)} failed.")
             return False
@@ -556,6 +3772,216 @@ def download_ts_files(m3u8_url, save_path, progress_callback, status_callback):
     except Exception as e:
         status_callback(f"An error occurred: {str(e)}")
         return False
+    finally:
+        if speed_stop is not None:
+            speed_stop.set()
+        if stream is not None and not stream.closed:
+            stream.abort()
+        if journal is not None:
+            journal.close()
+
+# 正在进行的直播录制（停止事件），stop_live_recordings() 让它们在当前片段完成后结束
+live_recordings = set()
+live_recordings_lock = threading.Lock()
+
+def stop_live_recordings():
+    """停止所有正在进行的直播录制，已经开始的片段下载完成后写入播放列表"""
+    with live_recordings_lock:
+        for stop in live_recordings:
+            stop.set()
+
+def _write_recorded_playlist(save_path, entries, target_duration):
+    """把录制到的片段写入 playlist.m3u8（本地文件名，带 ENDLIST），丢失片段的位置标记为不连续"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target_duration}',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for segment, filename, gap_before in entries:
+        if segment.discontinuity or gap_before:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f'#EXTINF:{segment.duration:.3f},')
+        lines.append(filename)
+    lines.append('#EXT-X-ENDLIST')
+    path = os.path.join(save_path, 'playlist.m3u8')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+def record_live(m3u8_url, save_path, progress_callback, status_callback, share=None):
+    """录制直播/事件播放列表：按目标时长轮询媒体播放列表，只下载新出现的片段
+
+    按媒体序列号判断新片段，滑动窗口中来不及下载就被移出的片段记为丢失（合并时按不连续处理）。
+    遇到 EXT-X-ENDLIST、达到 live_max_minutes/live_max_mb 上限或调用 stop_live_recordings() 时停止。
+    片段保存为 live-<编号>.ts，录制到的片段写入 playlist.m3u8，可以直接合并；
+    统计每个片段从出现在播放列表中到写入磁盘的延迟。
+    """
+    max_seconds = settings.get('live_max_minutes', 0) * 60
+    max_bytes = settings.get('live_max_mb', 0) * 1024 * 1024
+    validate = settings.get('validate_segments', True)
+    check_retries = settings.get('validate_retries', 2) if validate else 0
+    if settings.get('streaming_output'):
+        status_callback("Streaming output is not used for live recording, segments are saved as files.")
+    
+    key_cache = KeyCache()
+    lock = threading.Lock()
+    entries = {}  # 本地编号 -> (Segment, 文件名, 前面是否有丢失的片段)
+    latencies = []
+    totals = {'seen': 0, 'bytes': 0, 'failed': 0, 'missed': 0}
+    
+    def download(number, segment, gap_before, seen_at):
+        filename = f"live-{number}.ts"
+        path = os.path.join(save_path, filename)
+        success = False
+        try:
+            cipher = key_cache.cipher_for(segment)
+            for check in range(check_retries + 1):
+                record = TransferRecord(segment.url)
+                if share is not None:
+                    share.acquire()
+                started = metrics.segment_started()
+                success = False
+                try:
+                    if segment.byterange:
+                        parts = download_range_group(segment.url, [segment.byterange],
+                                                     ciphers=[cipher] if cipher else None, record=record)
+                        success = parts is not None
+                        if success:
+                            with open(path, 'wb') as f:
+                                f.write(parts[0])
+                            record.size = len(parts[0])
+                    else:
+                        success = download_single_ts(segment.url, path, cipher=cipher, record=record)
+                finally:
+                    metrics.segment_finished(started, success)
+                    if share is not None:
+                        share.release(record.size)
+                if not success or not validate or not is_ts_segment(segment):
+                    break
+                problem = validate_ts_file(path)[0]
+                if problem is None:
+                    break
+                action = "downloading it again" if check < check_retries else "giving up"
+                status_callback(f"Segment {segment.sequence} is corrupt ({problem}), {action}")
+                os.remove(path)
+                success = False
+        except Exception as e:
+            status_callback(f"Failed to download segment {segment.sequence}: {e}")
+            success = False
+        
+        done_at = time.time()
+        metrics.segment_result('done' if success else 'failed', queued=False)
+        with lock:
+            if success:
+                entries[number] = (segment, filename, gap_before)
+                latencies.append(done_at - seen_at)
+                totals['bytes'] += os.path.getsize(path)
+            else:
+                totals['failed'] += 1
+                status_callback(f"Failed to download: {filename}")
+            progress_callback(len(entries), totals['seen'])
+    
+    stop = threading.Event()
+    with live_recordings_lock:
+        live_recordings.add(stop)
+    
+    status_callback("Live playlist: recording new segments as they appear")
+    executor = ThreadPoolExecutor(max_workers=settings['max_threads'])
+    started = time.time()
+    last_sequence = None  # 已经处理过的最大媒体序列号
+    offset = 0  # 媒体序列号重新开始时，本地编号继续递增
+    last_number = -1
+    gap_pending = False
+    target_duration = 6
+    failing_since = None
+    last_report = started
+    stop_reason = None
+    try:
+        while True:
+            poll_started = time.time()
+            new_segments = []
+            try:
+                response = _fetch_with_header_fallback(m3u8_url)
+                status = response.status_code
+            except requests.exceptions.RequestException as e:
+                response, status = None, str(e)
+            
+            if response is not None and status == 200:
+                seen_at = time.time()
+                failing_since = None
+                playlist = parse_media_playlist(response.text, m3u8_url)
+                target_duration = playlist.target_duration or target_duration
+                segments = playlist.segments
+                if last_sequence is not None and segments and segments[-1].sequence + len(segments) < last_sequence:
+                    # 编码器重启等原因导致媒体序列号重新开始
+                    status_callback(f"Media sequence restarted at {segments[0].sequence}, continuing the recording")
+                    offset = last_number + 1 - segments[0].sequence
+                    last_sequence = None
+                    gap_pending = True
+                new_segments = [segment for segment in segments
+                                if last_sequence is None or segment.sequence > last_sequence]
+                if new_segments and last_sequence is not None and new_segments[0].sequence > last_sequence + 1:
+                    # 滑动窗口已经移过了这些片段
+                    missed = new_segments[0].sequence - last_sequence - 1
+                    totals['missed'] += missed
+                    gap_pending = True
+                    status_callback(f"{missed} segments left the playlist window before they could be fetched")
+                for segment in new_segments:
+                    number = segment.sequence + offset
+                    last_number = max(last_number, number)
+                    with lock:
+                        totals['seen'] += 1
+                    executor.submit(download, number, segment, gap_pending, seen_at)
+                    gap_pending = False
+                if new_segments:
+                    last_sequence = new_segments[-1].sequence
+                if playlist.end_list:
+                    stop_reason = "end of stream (EXT-X-ENDLIST)"
+                    break
+            else:
+                # 播放列表暂时取不到时继续轮询，持续失败超过一段时间后结束录制
+                failing_since = failing_since or poll_started
+                if time.time() - failing_since > max(30, target_duration * 6):
+                    stop_reason = f"playlist unavailable ({status})"
+                    break
+            
+            now = time.time()
+            if stop.is_set():
+                stop_reason = "stopped"
+                break
+            if max_seconds and now - started >= max_seconds:
+                stop_reason = f"time limit of {max_seconds // 60} minutes"
+                break
+            if max_bytes and totals['bytes'] >= max_bytes:
+                stop_reason = f"size limit of {max_bytes // 1024 // 1024} MB"
+                break
+            if now - last_report >= 10:
+                last_report = now
+                with lock:
+                    recent = latencies[-10:]
+                    message = f"Recorded {len(entries)} segments, {totals['bytes'] / 1024 / 1024:.1f} MB"
+                    if recent:
+                        message += f", latency {sum(recent) / len(recent):.2f} s"
+                status_callback(message)
+            
+            # 播放列表有变化时等待一个目标时长，没有变化时等待一半（HLS规范的建议）
+            interval = target_duration if new_segments else target_duration / 2
+            stop.wait(max(0.0, interval - (time.time() - poll_started)))
+    finally:
+        # 已经开始的片段下载完成后再写播放列表
+        executor.shutdown(wait=True)
+        with live_recordings_lock:
+            live_recordings.discard(stop)
+    
+    ordered = [entries[number] for number in sorted(entries)]
+    _write_recorded_playlist(save_path, ordered, target_duration)
+    duration = sum(segment.duration for segment, _, _ in ordered)
+    status_callback(f"Recording finished: {stop_reason}. {len(ordered)} segments, "
+                    f"{duration:.0f} s of video, {totals['bytes'] / 1024 / 1024:.1f} MB, "
+                    f"{totals['missed']} missed, {totals['failed']} failed")
+    if latencies:
+        latencies.sort()
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+        status_callback(f"Segment latency (listed in playlist -> on disk): mean {sum(latencies) / len(latencies):.2f} s, "
+                        f"p50 {percentile(0.5):.2f} s, p95 {percentile(0.95):.2f} s, max {latencies[-1]:.2f} s")
+    return bool(ordered) and not totals['failed']
 
 def suggest_directory_name(url):
     """根据URL或当前时间生成建议的目录名"""
@@ -565,7 +3991,7 @@ def suggest_directory_name(url):
         path_parts = parsed.path.split('/')
         
         # 过滤掉空字符串和常见的无意义部分
-        filtered_parts = [p for p in path_parts if p and p not in ('index.m3u8', 'playlist.m3u8', 'video')]
+        filtered_parts = [p for p in path_parts if p and p not in ('index.m3u8', 'playlist.m3u8', 'master.m3u8', 'video')]
         
         if filtered_parts:
             # 使用最后一个有意义的部分
@@ -580,6 +4006,124 @@ def suggest_directory_name(url):
     # 如果无法从URL提取，使用时间戳
     return f"video_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
+# 图形界面中的下载任务都交给同一个调度器，可以同时下载多个视频
+job_scheduler = None
+job_progress = {}  # 任务名 -> (已完成片段数, 片段总数)
+active_save_paths = set()  # 正在下载（或排队）的任务目录
+ui_updates = None  # UiUpdateQueue，在 build_gui 中创建
+
+class UiUpdateQueue:
+    """下载线程到界面的更新队列
+
+    下载和合并线程只把进度和状态消息放进队列（每个任务的进度只保留最新的一次），界面线程按固定频率
+    一次取出全部更新并刷新控件，片段再多Tk的事件队列里也只有一个定时器。等待显示的消息最多保留
+    max_lines 行，所有消息同时写入日志文件。
+    """
+    MAX_LOG_BYTES = 10 * 1024 * 1024  # 日志文件超过该大小时改名为 .1 后重新开始
+
+    def __init__(self, max_lines=1000, log_path=''):
+        self._lock = threading.Lock()
+        self.max_lines = max(1, max_lines)
+        self._messages = deque(maxlen=self.max_lines)
+        self._progress = {}
+        self._calls = []
+        self.dropped = 0  # 显示之前就被新消息挤出队列的行数
+        self.log_path = log_path
+        self._log = None
+
+    def post_status(self, message):
+        with self._lock:
+            if len(self._messages) == self.max_lines:
+                self.dropped += 1
+            self._messages.append(message)
+            self._write_log(message)
+
+    def post_progress(self, key, done, total):
+        with self._lock:
+            self._progress[key] = (done, total)
+
+    def call_soon(self, func):
+        """在界面线程中执行 func（下一次刷新时）"""
+        with self._lock:
+            self._calls.append(func)
+
+    def _write_log(self, message):
+        if not self.log_path:
+            return
+        try:
+            if self._log is None:
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+            elif self._log.tell() > self.MAX_LOG_BYTES:
+                self._log.close()
+                os.replace(self.log_path, self.log_path + '.1')
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+            self._log.write(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {message}\n")
+        except OSError as e:
+            print(f"Warning: could not write the status log {self.log_path}: {e}", file=sys.stderr)
+            self.log_path = ''
+
+    def drain(self):
+        """取出所有等待的更新，返回 (消息列表, 被挤掉的行数, {键: (完成数, 总数)}, 函数列表)"""
+        with self._lock:
+            messages, self._messages = list(self._messages), deque(maxlen=self.max_lines)
+            dropped, self.dropped = self.dropped, 0
+            progress, self._progress = self._progress, {}
+            calls, self._calls = self._calls, []
+            if self._log is not None:
+                self._log.flush()
+        return messages, dropped, progress, calls
+
+    def start(self, widget, hz, show_status, show_progress):
+        """在 widget 所在的Tk主循环中每秒刷新 hz 次"""
+        interval = max(10, int(1000 / max(hz, 1)))
+
+        def tick():
+            try:
+                messages, dropped, progress, calls = self.drain()
+                if dropped:
+                    note = f", see {self.log_path}" if self.log_path else ""
+                    messages.insert(0, f"... {dropped} earlier messages not shown{note}")
+                if messages:
+                    show_status(messages)
+                if progress:
+                    show_progress(progress)
+                for func in calls:
+                    func()
+            finally:
+                widget.after(interval, tick)
+
+        widget.after(interval, tick)
+
+def append_status_lines(lines):
+    """在状态日志控件末尾添加多行，只保留最近的 status_log_lines 行"""
+    status_text.config(state=tk.NORMAL)
+    status_text.insert(tk.END, '\n'.join(lines) + '\n')
+    max_lines = settings.get('status_log_lines', 1000)
+    line_count = int(status_text.index('end-1c').split('.')[0]) - 1
+    if line_count > max_lines:
+        status_text.delete('1.0', f'{line_count - max_lines + 1}.0')
+    status_text.see(tk.END)  # 自动滚动到底部
+    status_text.config(state=tk.DISABLED)
+
+def show_job_progress(progress):
+    """进度条显示所有任务的总进度，progress 为 {任务名: (已完成片段数, 片段总数)}"""
+    for job_name, counts in progress.items():
+        if job_name in job_progress:
+            job_progress[job_name] = counts
+    done = sum(counts[0] for counts in job_progress.values())
+    total = sum(counts[1] for counts in job_progress.values())
+    progress_bar['value'] = done / total * 100 if total else 0
+    label = f"{done}/{total}"
+    if len(job_progress) > 1:
+        label += f" ({len(job_progress)} jobs)"
+    progress_label.config(text=label)
+
+def get_job_scheduler():
+    global job_scheduler
+    if job_scheduler is None:
+        job_scheduler = JobScheduler(settings.get('max_connections', 20), settings.get('max_jobs', 3))
+    return job_scheduler
+
 def start_download():
     url = entry_url.get().strip()
     save_path = entry_save_path.get().strip()
@@ -593,6 +4137,13 @@ def start_download():
         messagebox.showwarning("Warning", "Please enter a valid URL starting with http:// or https://")
         return
 
+    # 该目录的任务正在下载：把新地址交给它，签名过期时用新地址继续，不重新开始任务
+    if os.path.normpath(save_path) in active_save_paths:
+        TokenRefresher.hand_over(save_path, url)
+        messagebox.showinfo("URL Updated", "This directory is already being downloaded.\n"
+                                           "The new URL will be used as soon as the current segment URLs expire.")
+        return
+
     # 检查目录是否已包含之前下载的文件
     if os.path.exists(save_path) and os.path.exists(os.path.join(save_path, 'playlist.m3u8')):
         # 询问用户是否要清理目录或使用新目录
@@ -630,70 +4181,67 @@ def start_download():
         messagebox.showerror("Error", f"Failed to create directory: {str(e)}")
         return
 
-    # 重置进度条和状态
-    progress_bar['value'] = 0
-    progress_label.config(text="0/0")
-    status_text.config(state=tk.NORMAL)
-    status_text.delete(1.0, tk.END)
-    status_text.config(state=tk.DISABLED)
-
-    # 禁用开始下载按钮，防止重复点击
-    button_start.config(state=tk.DISABLED)
+    # 没有其他任务在下载时重置进度条和状态；开始按钮保持可用，可以继续添加任务
+    job_name = os.path.basename(os.path.normpath(save_path))
+    if not job_progress:
+        progress_bar['value'] = 0
+        progress_label.config(text="0/0")
+        status_text.config(state=tk.NORMAL)
+        status_text.delete(1.0, tk.END)
+        status_text.config(state=tk.DISABLED)
+    job_progress[job_name] = (0, 0)
     
+    # 进度和状态放入更新队列，由界面线程定时刷新
     def update_progress(success_count, total_count):
-        # 使用 after 方法在主线程中更新 UI
-        root.after(0, lambda: _update_progress_ui(success_count, total_count))
-    
-    def _update_progress_ui(success_count, total_count):
-        progress_bar['value'] = success_count / total_count * 100
-        progress_label.config(text=f"{success_count}/{total_count}")
-        root.update_idletasks()
+        ui_updates.post_progress(job_name, success_count, total_count)
 
     def update_status(message):
-        # 使用 after 方法在主线程中更新 UI
-        root.after(0, lambda: _update_status_ui(message))
-    
-    def _update_status_ui(message):
-        status_text.config(state=tk.NORMAL)
-        status_text.insert(tk.END, message + "\n")
-        status_text.see(tk.END)  # 自动滚动到底部
-        status_text.config(state=tk.DISABLED)
+        ui_updates.post_status(f"[{job_name}] {message}")
 
     # 检查URL是否包含查询参数，这可能表示它是一个临时URL
     if '?' in url and ('t=' in url or 'token=' in url or 'expire=' in url):
         if not messagebox.askyesno("URL Check", 
                                   "The URL appears to contain authentication tokens which may expire.\n"
-                                  "If the download fails, you may need to get a fresh URL.\n\n"
+                                  "Expired segment URLs are refreshed from the playlist automatically; if that fails, "
+                                  "paste a fresh URL with the same Save Path while the download is running.\n\n"
                                   "Continue with download?"):
+            job_progress.pop(job_name, None)
             return
     
     # 标准化 .m3u8 URL
     normalized_url = normalize_m3u8_url(url)
     if not normalized_url:
         messagebox.showwarning("Warning", "Invalid URL format.")
-        button_start.config(state=tk.NORMAL)  # 重新启用按钮
+        job_progress.pop(job_name, None)
         return
-        
-    update_status(f"Downloading playlist from: {normalized_url}")
+    
+    scheduler = get_job_scheduler()
 
-    # 创建一个新线程来执行下载操作
-    def download_thread():
+    # 在调度器的任务线程中执行下载操作
+    def download_thread(share):
         try:
-            if download_m3u8(normalized_url, save_path):
+            update_status(f"Downloading playlist from: {normalized_url}")
+            media_url = download_m3u8(normalized_url, save_path, update_status)
+            if media_url:
                 update_status("Playlist downloaded. Starting TS file download...")
-                download_result = download_ts_files(normalized_url, save_path, update_progress, update_status)
-                if download_result:
+                download_result = download_ts_files(media_url, save_path, update_progress, update_status, share)
+                if download_result and settings.get('streaming_output'):
+                    update_status("Download completed.")
+                elif download_result:
                     update_status("Download completed. You can now merge the files.")
                 else:
                     update_status("Download failed or was interrupted.")
             else:
                 update_status("Failed to download playlist.")
         finally:
-            # 无论下载成功还是失败，都重新启用按钮
-            root.after(0, lambda: button_start.config(state=tk.NORMAL))
+            # 任务结束后不再计入总进度
+            ui_updates.call_soon(lambda: job_progress.pop(job_name, None))
+            ui_updates.call_soon(lambda: active_save_paths.discard(os.path.normpath(save_path)))
     
-    # 启动下载线程
-    threading.Thread(target=download_thread, daemon=True).start()
+    active_save_paths.add(os.path.normpath(save_path))
+    scheduler.submit(download_thread, job_name)
+    if scheduler.queued:
+        update_status("Queued, waiting for a running download to finish.")
 
 def browse_save_path():
     # 使用上次的目录作为起点
@@ -720,14 +4268,402 @@ def new_download():
     status_text.delete(1.0, tk.END)
     status_text.config(state=tk.DISABLED)
     
-    # 提示用户
-    status_text.config(state=tk.NORMAL)
-    status_text.insert(tk.END, "Ready for new download. Please enter a URL and select a save path.\n")
-    status_text.config(state=tk.DISABLED)
+    # 提示用户
+    status_text.config(state=tk.NORMAL)
+    status_text.insert(tk.END, "Ready for new download. Please enter a URL and select a save path.\n")
+    status_text.config(state=tk.DISABLED)
+    
+    # 可选：询问用户是否要选择新的保存路径
+    if messagebox.askyesno("New Download", "Would you like to select a new save directory?"):
+        browse_save_path()
+
+# 没有播放列表时从片段文件名中提取序号的模式，按顺序尝试，取第一个匹配
+SEQUENCE_PATTERNS = [
+    # seg-数字-其他.ts 格式
+    re.compile(r'seg-(\d+)'),
+    # segment数字.ts 格式
+    re.compile(r'segment(\d+)'),
+    # index数字.ts 格式
+    re.compile(r'index(\d+)'),
+    # 处理类似 "index2.ts" 这样的格式 - 字母后面直接跟数字
+    re.compile(r'[a-zA-Z](\d+)\.ts$'),
+    # 处理类似 "720P_4000K_441496441_2.ts"、"video_2.ts" 这样的格式 - 下划线后跟数字.ts
+    re.compile(r'_(\d+)\.ts$'),
+    # 处理类似 "part-2.ts" 这样的格式 - 字母-数字.ts
+    re.compile(r'[a-zA-Z]-(\d+)\.ts$'),
+]
+_LEADING_DIGITS_RE = re.compile(r'\d{4,}')
+_DIGITS_RE = re.compile(r'\d+')
+
+def extract_sequence_number(filename):
+    """从文件名中提取序列号（只用于没有播放列表的目录，见 merge_file_list）"""
+    # 首先检查是否是以序号开头的格式（如0000.ts、12345.ts、0001_abc.ts），取开头的全部数字
+    match = _LEADING_DIGITS_RE.match(filename)
+    if match:
+        return int(match.group())
+
+    # 检查常见的分段格式
+    for pattern in SEQUENCE_PATTERNS:
+        match = pattern.search(filename)
+        if match:
+            return int(match.group(1))
+
+    # 文件名中的第一个数字序列
+    match = _DIGITS_RE.search(filename)
+    if match:
+        return int(match.group())
+
+    # 如果没有找到任何数字，返回文件名本身
+    # 这样至少会按字母顺序排序
+    return filename
+
+def list_ts_files(save_path, exclude=()):
+    """列出目录中的 .ts 文件（排除 exclude 中的文件名，如合并输出的 output.ts），并按序列号排序"""
+    ts_files = [f for f in os.listdir(save_path) if f.endswith('.ts') and f not in exclude]
+    
+    def sort_key(name):
+        number = extract_sequence_number(name)
+        # 没有数字的文件名排在最后，按字母顺序
+        return (0, number, name) if isinstance(number, int) else (1, 0, name)
+    
+    ts_files.sort(key=sort_key)
+    return ts_files
+
+def merge_file_list(save_path, exclude=()):
+    """合并用的片段文件列表，返回 (文件名列表, 缺失的片段序号列表)
+
+    有保存的播放列表时按播放列表的顺序：有续传日志时只使用日志中已完成的片段和记录的文件名
+    （失败或未完成的片段即使留有文件也记为缺失）；没有续传日志的旧任务目录依次尝试 0000.ts
+    格式的序号文件名和原始文件名，都不存在的片段记为缺失。目录中不属于播放列表的 .ts 文件不参与合并。
+    没有播放列表的目录按文件名中的序号排序（list_ts_files），缺失列表为None。
+    """
+    try:
+        playlist = load_saved_playlist(save_path)
+    except (OSError, ValueError):
+        playlist = None
+    if playlist is None or not playlist.segments:
+        return list_ts_files(save_path, exclude), None
+    
+    existing = set(os.listdir(save_path)) - set(exclude)
+    journaled = None
+    if os.path.exists(os.path.join(save_path, SegmentJournal.FILENAME)):
+        try:
+            journal = SegmentJournal(save_path)
+            try:
+                journaled = journal.done_files()
+            finally:
+                journal.close()
+        except sqlite3.Error:
+            journaled = None
+    
+    ts_files = []
+    missing = []
+    for i, segment in enumerate(playlist.segments):
+        if journaled is not None:
+            name = journaled.get(i)
+            if name in existing:
+                ts_files.append(name)
+            else:
+                missing.append(i)
+            continue
+        name = f"{i:04d}.ts"
+        if name not in existing:
+            name = segment.filename
+            if name not in existing:
+                missing.append(i)
+                continue
+        ts_files.append(name)
+    return ts_files, missing
+
+def describe_missing(missing, total):
+    """缺失片段的说明，最多列出前10个序号"""
+    shown = ', '.join(f"#{i}" for i in missing[:10])
+    if len(missing) > 10:
+        shown += ', ...'
+    return f"{len(missing)} of {total} segments are missing ({shown})"
+
+def run_ffmpeg(cmd, status_callback):
+    """运行ffmpeg命令，把输出逐行转给状态回调，返回是否成功"""
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    
+    # 读取输出并更新状态
+    for line in process.stderr:
+        status_callback(line.rstrip('\n'))
+    
+    process.wait()
+    return process.returncode == 0
+
+def playlist_has_discontinuity(save_path):
+    """检查保存的播放列表中是否有 EXT-X-DISCONTINUITY 标记（时间戳可能在此处重置）"""
+    try:
+        playlist = load_saved_playlist(save_path)
+    except (OSError, ValueError):
+        return False
+    return playlist is not None and playlist.has_discontinuity
+
+def _copy_fd(in_fd, out_fd, count):
+    """在内核中把 in_fd 的 count 字节追加到 out_fd，优先 copy_file_range，其次 sendfile"""
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < count:
+                copied = os.copy_file_range(in_fd, out_fd, count - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return offset
+        except OSError:
+            # 旧内核或跨文件系统时不支持，继续尝试 sendfile
+            pass
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        while offset < count:
+            sent = os.sendfile(out_fd, in_fd, offset, count - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+    
+    # 其他平台退回到普通的缓冲区拷贝
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    with open(in_fd, 'rb', closefd=False) as src, open(out_fd, 'wb', closefd=False) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return count
+
+def concat_files_native(paths, output_file):
+    """把文件按顺序拼接到输出文件，数据只在内核中拷贝，返回总字节数"""
+    total = 0
+    with open(output_file, 'wb') as out:
+        out_fd = out.fileno()
+        for path in paths:
+            with open(path, 'rb') as src:
+                size = os.fstat(src.fileno()).st_size
+                copied = _copy_fd(src.fileno(), out_fd, size)
+                if copied != size:
+                    raise IOError(f"Short copy from {path}: {copied} of {size} bytes")
+                total += copied
+    return total
+
+def merge_ts_native(save_path, ts_files, output_file, status_callback):
+    """直接拼接MPEG-TS片段；输出不是 .ts 时再用ffmpeg对拼接结果做一次转封装"""
+    paths = [os.path.join(save_path, f) for f in ts_files]
+    ts_output = output_file if output_file.lower().endswith('.ts') else output_file + '.part.ts'
+    
+    start_time = time.time()
+    try:
+        total = concat_files_native(paths, ts_output)
+        status_callback(f"Concatenated {len(paths)} segments ({total / 1024 / 1024:.1f} MB) in {time.time() - start_time:.2f}s")
+        if ts_output == output_file:
+            return True
+        
+        # 容器格式变化，需要ffmpeg转封装（单个输入，不需要concat demuxer）
+        status_callback(f"Remuxing to {output_file}...")
+        return run_ffmpeg(['ffmpeg', '-i', ts_output, '-c', 'copy', '-y', output_file], status_callback)
+    except OSError as e:
+        status_callback(f"Native merge failed: {str(e)}")
+        return False
+    finally:
+        if ts_output != output_file:
+            try:
+                os.remove(ts_output)
+            except OSError:
+                pass
+
+def merge_ts_ffmpeg(save_path, ts_files, output_file, status_callback):
+    """使用ffmpeg的concat demuxer合并 .ts 文件"""
+    # 创建文件列表
+    file_list_path = os.path.join(save_path, 'filelist.txt')
+    with open(file_list_path, 'w', encoding='utf-8') as f:
+        for ts_file in ts_files:
+            f.write(f"file '{ts_file}'\n")
+    
+    try:
+        # 使用ffmpeg合并文件
+        cmd = [
+            'ffmpeg',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', file_list_path,
+            '-c', 'copy',
+            '-y',  # 覆盖输出文件（如果存在）
+            output_file
+        ]
+        return run_ffmpeg(cmd, status_callback)
+    finally:
+        # 删除临时文件列表
+        try:
+            os.remove(file_list_path)
+        except:
+            pass
+
+def discontinuity_positions(save_path, ts_files):
+    """ts_files 中按保存的播放列表前面有 EXT-X-DISCONTINUITY 的片段位置"""
+    try:
+        playlist = load_saved_playlist(save_path)
+    except (OSError, ValueError):
+        return set()
+    if playlist is None:
+        return set()
+    names = set()
+    for i, segment in enumerate(playlist.segments):
+        if segment.discontinuity:
+            names.update((f"{i:04d}.ts", segment.filename))
+    return {n for n, name in enumerate(ts_files) if name in names}
+
+def ts_start_time(path, limit=1024 * 1024):
+    """片段开头 limit 字节内音视频PES的最小PTS（秒），找不到时返回None"""
+    with open(path, 'rb') as f:
+        data = f.read(limit)
+    start_pts = None
+    for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        # 需要同步字节、payload_unit_start_indicator 和负载
+        if packet[0] != 0x47 or not packet[1] & 0x40 or not packet[3] & 0x10:
+            continue
+        start = 4 + (1 + packet[4] if packet[3] & 0x20 else 0)
+        pes = packet[start:start + 14]
+        # PES头：起始码、音视频或私有流1的stream_id、带PTS
+        if len(pes) < 14 or pes[:3] != b'\x00\x00\x01' or not (pes[3] == 0xBD or 0xC0 <= pes[3] <= 0xEF):
+            continue
+        if not pes[7] & 0x80:
+            continue
+        p = pes[9:14]
+        pts = ((p[0] >> 1) & 0x07) << 30 | p[1] << 22 | (p[2] >> 1) << 15 | p[3] << 7 | p[4] >> 1
+        start_pts = pts if start_pts is None else min(start_pts, pts)
+    return None if start_pts is None else start_pts / 90000
+
+def plan_merge_groups(sizes, breaks, count):
+    """把排好序的片段分成首尾相接的组，返回 [(起始位置, 结束位置)]（不含结束位置）
+
+    组不跨越 breaks 中的位置（不连续点，时间戳可能在此重置），因此组内的片段可以直接拼接；
+    不连续点之间的部分再按字节数分成若干组，每组接近总字节数的 1/count。
+    """
+    target = max(1, sum(sizes) / max(1, count))
+    bounds = sorted({0, len(sizes)} | {b for b in breaks if 0 < b < len(sizes)})
+    groups = []
+    for start, end in zip(bounds, bounds[1:]):
+        section = sum(sizes[start:end])
+        parts = max(1, min(end - start, round(section / target)))
+        cuts = [section / parts * k for k in range(1, parts)]
+        group_start = start
+        total = 0
+        for i in range(start, end - 1):
+            total += sizes[i]
+            if cuts and total >= cuts[0]:
+                groups.append((group_start, i + 1))
+                group_start = i + 1
+                cuts.pop(0)
+        groups.append((group_start, end))
+    return groups
+
+def merge_ts_parallel(save_path, ts_files, output_file, status_callback):
+    """分组并行合并：每组片段在内核中直接拼接，再由各自的ffmpeg进程转封装为输出格式，
+    最后用concat demuxer把各组的结果连接起来（只复制数据包，按各部分的时长修正时间戳）
+
+    组不跨越不连续点；只有一组时与 native 合并相同。连续的相邻两组之间，concat demuxer
+    按下一组与本组开头PTS的差值偏移时间戳，与逐个片段合并的时间线一致。
+    """
+    workers = settings.get('merge_workers', 0) or os.cpu_count() or 1
+    paths = [os.path.join(save_path, f) for f in ts_files]
+    try:
+        sizes = [os.path.getsize(path) for path in paths]
+    except OSError as e:
+        status_callback(f"Parallel merge failed: {str(e)}")
+        return False
+    extension = os.path.splitext(output_file)[1] or '.ts'
+    # 输出为 .ts 时不需要转封装，只在不连续点分组
+    count = 1 if extension.lower() == '.ts' else workers
+    breaks = discontinuity_positions(save_path, ts_files)
+    groups = plan_merge_groups(sizes, breaks, count)
+    if len(groups) <= 1:
+        return merge_ts_native(save_path, ts_files, output_file, status_callback)
+    
+    parts_dir = os.path.join(save_path, 'merge_parts')
+    os.makedirs(parts_dir, exist_ok=True)
+    status_callback(f"Merging {len(paths)} segments as {len(groups)} parts with {min(workers, len(groups))} ffmpeg processes...")
+    start_time = time.time()
     
-    # 可选：询问用户是否要选择新的保存路径
-    if messagebox.askyesno("New Download", "Would you like to select a new save directory?"):
-        browse_save_path()
+    def build_part(k):
+        start, end = groups[k]
+        ts_part = os.path.join(parts_dir, f"{k:05d}.ts")
+        concat_files_native(paths[start:end], ts_part)
+        if extension.lower() == '.ts':
+            return ts_part
+        part = os.path.join(parts_dir, f"{k:05d}{extension}")
+        try:
+            ok = run_ffmpeg(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', ts_part, '-c', 'copy', '-y', part],
+                            status_callback)
+        finally:
+            os.remove(ts_part)
+        if not ok:
+            raise RuntimeError(f"ffmpeg failed on part {k + 1}")
+        return part
+    
+    file_list_path = os.path.join(parts_dir, 'parts.txt')
+    try:
+        parts = [None] * len(groups)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(build_part, k): k for k in range(len(groups))}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    parts[futures[future]] = future.result()
+                    status_callback(f"Part {done}/{len(groups)} ready")
+            except (OSError, RuntimeError):
+                # 一组失败后不再开始其余的组
+                for future in futures:
+                    future.cancel()
+                raise
+        status_callback(f"Parts ready in {time.time() - start_time:.2f}s, joining them...")
+        
+        # 每组的时长不能取转封装结果的时长：它从最早的数据包算到最后一帧的结束，
+        # 其他流的起始延迟会在每个连接处重复计入
+        starts = [ts_start_time(paths[start]) for start, _ in groups]
+        with open(file_list_path, 'w', encoding='utf-8') as f:
+            for k, part in enumerate(parts):
+                f.write(f"file '{os.path.basename(part)}'\n")
+                if k + 1 < len(groups) and groups[k + 1][0] not in breaks \
+                        and None not in (starts[k], starts[k + 1]) and starts[k + 1] > starts[k]:
+                    f.write(f"duration {starts[k + 1] - starts[k]:.6f}\n")
+        return run_ffmpeg(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', file_list_path, '-c', 'copy', '-y', output_file],
+                          status_callback)
+    except (OSError, RuntimeError) as e:
+        status_callback(f"Parallel merge failed: {str(e)}")
+        return False
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+def merge_ts_files(save_path, ts_files, output_file, status_callback):
+    """将排好序的 .ts 文件合并为输出文件，返回是否成功
+
+    merge_mode 为 native 时直接拼接片段，只在必要时调用ffmpeg：
+    输出为其他容器时转封装一次，播放列表有不连续标记时改用concat demuxer；
+    为 parallel 时分组后由多个ffmpeg进程并行转封装（见 merge_ts_parallel）
+    """
+    # 输出文件本身也是 .ts 时不能把它当作输入
+    output_path = os.path.abspath(output_file)
+    ts_files = [f for f in ts_files if os.path.abspath(os.path.join(save_path, f)) != output_path]
+    
+    start_time = time.time()
+    mode = 'ffmpeg'
+    if settings.get('merge_mode', 'ffmpeg') == 'parallel':
+        mode = 'parallel'
+    elif settings.get('merge_mode', 'ffmpeg') == 'native':
+        if not playlist_has_discontinuity(save_path):
+            mode = 'native'
+        else:
+            status_callback("Playlist contains discontinuities, merging with ffmpeg concat instead.")
+    if mode == 'native':
+        success = merge_ts_native(save_path, ts_files, output_file, status_callback)
+    elif mode == 'parallel':
+        success = merge_ts_parallel(save_path, ts_files, output_file, status_callback)
+    else:
+        success = merge_ts_ffmpeg(save_path, ts_files, output_file, status_callback)
+    metrics.on_merge(mode, success, time.time() - start_time)
+    return success
 
 def merge_to_mp4():
     """将下载的 .ts 文件合并为 .mp4 文件"""
@@ -736,90 +4672,20 @@ def merge_to_mp4():
         messagebox.showwarning("Warning", "Please select a valid save path.")
         return
     
-    # 检查是否有 .ts 文件
-    ts_files = [f for f in os.listdir(save_path) if f.endswith('.ts')]
+    # 设置输出文件名
+    merge_format = settings.get('merge_format', 'mp4')
+    output_file = os.path.join(save_path, f"output.{merge_format}")
+    
+    # 按播放列表的顺序列出片段文件（没有播放列表时按文件名中的序列号排序），合并前检查缺失的片段
+    ts_files, missing = merge_file_list(save_path, exclude=(os.path.basename(output_file),))
     if not ts_files:
         messagebox.showwarning("Warning", "No .ts files found in the selected directory.")
         return
-    
-    # 更智能地确定文件命名方式和排序
-    def extract_sequence_number(filename):
-        """从文件名中提取序列号"""
-        # 首先检查是否是标准的数字格式（如0000.ts）
-        if filename[:4].isdigit() and len(filename) >= 8:
-            return int(filename[:4])
-        
-        # 检查常见的分段格式
-        patterns = [
-            # seg-数字-其他.ts 格式
-            r'seg-(\d+)',
-            # segment数字.ts 格式
-            r'segment(\d+)',
-            # index数字.ts 格式
-            r'index(\d+)',
-            # 处理类似 "index2.ts" 这样的格式 - 字母后面直接跟数字
-            r'([a-zA-Z]+)(\d+)\.ts$',
-            # 处理类似 "720P_4000K_441496441_2.ts" 这样的格式 - 下划线后跟数字.ts
-            r'_(\d+)\.ts$',
-            # 处理类似 "video_2.ts" 这样的格式 - 字母_数字.ts
-            r'[a-zA-Z]+_(\d+)\.ts$',
-            # 处理类似 "part-2.ts" 这样的格式 - 字母-数字.ts
-            r'[a-zA-Z]+-(\d+)\.ts$',
-            # 文件名中的任何数字序列
-            r'(\d+)',
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, filename)
-            if matches:
-                # 根据模式的不同处理匹配结果
-                if pattern == r'([a-zA-Z]+)(\d+)\.ts$':
-                    # 对于 "index2.ts" 这样的格式，第二个捕获组是数字
-                    return int(matches[0][1])
-                elif isinstance(matches[0], tuple):
-                    # 如果匹配结果是元组，取最后一个元素（通常是数字部分）
-                    return int(matches[0][-1])
-                else:
-                    # 对于简单模式，直接取第一个匹配
-                    return int(matches[0])
-        
-        # 尝试更复杂的分析 - 查找文件名中的所有数字序列
-        all_numbers = re.findall(r'\d+', filename)
-        if all_numbers:
-            # 启发式规则：如果有多个数字，优先选择：
-            # 1. 如果文件名以数字开头，选择第一个数字
-            if filename[0].isdigit():
-                return int(all_numbers[0])
-            # 2. 如果文件名以字母开头且包含数字，选择第一个数字
-            elif filename[0].isalpha():
-                # 查找第一个数字的位置
-                for i, char in enumerate(filename):
-                    if char.isdigit():
-                        # 找到数字开始的位置
-                        start_pos = i
-                        # 找到数字结束的位置
-                        end_pos = start_pos
-                        while end_pos < len(filename) and filename[end_pos].isdigit():
-                            end_pos += 1
-                        return int(filename[start_pos:end_pos])
-            # 3. 否则，选择最后一个数字（通常是序列号）
-            return int(all_numbers[-1])
-        
-        # 如果没有找到任何数字，返回文件名本身
-        # 这样至少会按字母顺序排序
-        return filename
-    
-    # 按提取的序列号排序
-    ts_files.sort(key=extract_sequence_number)
-    
-    # 创建文件列表
-    file_list_path = os.path.join(save_path, 'filelist.txt')
-    with open(file_list_path, 'w', encoding='utf-8') as f:
-        for ts_file in ts_files:
-            f.write(f"file '{ts_file}'\n")
-    
-    # 设置输出文件名
-    output_file = os.path.join(save_path, 'output.mp4')
+    if missing:
+        if not messagebox.askyesno("Missing Segments",
+                                   f"{describe_missing(missing, len(ts_files) + len(missing))}. "
+                                   "Download the job again to fetch them.\n\nMerge the remaining segments anyway?"):
+            return
     
     # 如果输出文件已存在，询问是否覆盖
     if os.path.exists(output_file):
@@ -828,8 +4694,8 @@ def merge_to_mp4():
             new_output_file = filedialog.asksaveasfilename(
                 initialdir=save_path,
                 title="Save As",
-                filetypes=(("MP4 files", "*.mp4"), ("All files", "*.*")),
-                defaultextension=".mp4"
+                filetypes=((f"{merge_format.upper()} files", f"*.{merge_format}"), ("All files", "*.*")),
+                defaultextension=f".{merge_format}"
             )
             if not new_output_file:
                 return  # 用户取消了操作
@@ -838,15 +4704,14 @@ def merge_to_mp4():
     # 禁用合并按钮，防止重复点击
     button_merge.config(state=tk.DISABLED)
     
-    # 更新状态
-    def update_merge_status(message):
-        status_text.config(state=tk.NORMAL)
-        status_text.insert(tk.END, message + "\n")
-        status_text.see(tk.END)  # 自动滚动到底部
-        status_text.config(state=tk.DISABLED)
+    # 更新状态（ffmpeg 的每一行输出也经过更新队列）
+    update_merge_status = ui_updates.post_status
     
     # 显示排序信息
-    update_merge_status(f"Found {len(ts_files)} TS files. Sorting by sequence number...")
+    if missing is None:
+        update_merge_status(f"Found {len(ts_files)} TS files. No playlist.m3u8, sorting by sequence number...")
+    else:
+        update_merge_status(f"Found {len(ts_files)} TS files in playlist order.")
     
     # 显示前几个文件的排序结果，帮助用户确认排序是否正确
     if len(ts_files) > 0:
@@ -865,129 +4730,32 @@ def merge_to_mp4():
     # 创建一个新线程来执行合并操作
     def merge_thread():
         try:
-            # 使用ffmpeg合并文件
-            cmd = [
-                'ffmpeg',
-                '-f', 'concat',
-                '-safe', '0',
-                '-i', file_list_path,
-                '-c', 'copy',
-                '-y',  # 覆盖输出文件（如果存在）
-                output_file
-            ]
-            
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-            
-            # 读取输出并更新状态
-            for line in process.stderr:
-                # 使用 after 方法在主线程中更新 UI
-                root.after(0, lambda l=line: update_merge_status(l))
+            merged = merge_ts_files(save_path, ts_files, output_file, update_merge_status)
             
-            process.wait()
-            
-            if process.returncode == 0:
+            if merged:
                 # 合并成功
-                root.after(0, lambda: update_merge_status("Merge completed successfully."))
+                update_merge_status("Merge completed successfully.")
                 # 询问是否打开文件
                 if messagebox.askyesno("Merge Complete", "Merge completed successfully. Open the file?"):
                     open_file(output_file)
             else:
                 # 合并失败
-                root.after(0, lambda: update_merge_status("Merge failed."))
+                update_merge_status("Merge failed.")
         finally:
             # 无论合并成功还是失败，都重新启用按钮
-            root.after(0, lambda: button_merge.config(state=tk.NORMAL))
-            # 删除临时文件列表
-            try:
-                os.remove(file_list_path)
-            except:
-                pass
+            ui_updates.call_soon(lambda: button_merge.config(state=tk.NORMAL))
     
     # 启动合并线程
     threading.Thread(target=merge_thread, daemon=True).start()
 
-# GUI setup
-root = tk.Tk()
-root.title("TS to MP4 Downloader")
-
-frame = tk.Frame(root)
-frame.pack(padx=10, pady=10)
-
-label_url = tk.Label(frame, text="M3U8 URL:")
-label_url.grid(row=0, column=0, sticky=tk.W)
-
-entry_url = tk.Entry(frame, width=50)
-entry_url.grid(row=0, column=1)
-
-label_save_path = tk.Label(frame, text="Save Path:")
-label_save_path.grid(row=1, column=0, sticky=tk.W)
-
-entry_save_path = tk.Entry(frame, width=50)
-entry_save_path.grid(row=1, column=1)
-
-button_browse = tk.Button(frame, text="Browse", command=browse_save_path)
-button_browse.grid(row=1, column=2)
-
-button_start = tk.Button(frame, text="Start Download", command=start_download)
-button_start.grid(row=2, column=1, pady=10)
-
-button_merge = tk.Button(frame, text="Merge to MP4", command=merge_to_mp4)
-button_merge.grid(row=2, column=2, pady=10)
-
-# Progress Bar
-progress_bar = ttk.Progressbar(frame, orient="horizontal", length=300, mode="determinate")
-progress_bar.grid(row=3, column=0, columnspan=3, pady=10)
-
-# Progress Label
-progress_label = tk.Label(frame, text="0/0")
-progress_label.grid(row=3, column=3, pady=10)
-
-# Status Text Area
-status_label = tk.Label(frame, text="Status Log:")
-status_label.grid(row=4, column=0, sticky=tk.W)
-
-status_text = scrolledtext.ScrolledText(frame, width=80, height=10, state=tk.DISABLED)
-status_text.grid(row=5, column=0, columnspan=4, pady=10)
-
-# 添加设置变量
-settings = {
-    'last_directory': '',
-    'max_threads': 10,
-    'delete_ts_after_merge': False,
-    'chunk_size': 1024,
-    'show_speed': True,
-    'use_original_filenames': False
-}
-
-# 加载上次使用的目录
-def load_settings():
-    try:
-        if os.path.exists('settings.json'):
-            with open('settings.json', 'r') as f:
-                loaded_settings = json.load(f)
-                settings.update(loaded_settings)
-    except:
-        pass  # 如果加载失败，使用默认设置
-
-# 保存设置
-def save_settings():
-    try:
-        with open('settings.json', 'w') as f:
-            json.dump(settings, f)
-    except:
-        pass
-
 # 创建菜单
 def create_menu():
     menu_bar = tk.Menu(root)
     
     # 文件菜单
     file_menu = tk.Menu(menu_bar, tearoff=0)
+    file_menu.add_command(label="Stop Live Recording", command=stop_live_recordings)
+    file_menu.add_separator()
     file_menu.add_command(label="Exit", command=root.quit)
     menu_bar.add_cascade(label="File", menu=file_menu)
     
@@ -996,6 +4764,15 @@ def create_menu():
     settings_menu.add_command(label="Thread Count", command=set_thread_count)
     settings_menu.add_command(label="Chunk Size", command=set_chunk_size)
     settings_menu.add_command(label="Connection Timeout", command=set_timeout)
+    settings_menu.add_command(label="Download Engine", command=set_download_engine)
+    settings_menu.add_command(label="Streaming Output", command=set_streaming_output)
+    settings_menu.add_command(label="Merge Mode", command=set_merge_mode)
+    settings_menu.add_command(label="Variant Selection", command=set_variant_policy)
+    settings_menu.add_command(label="Large Segment Split", command=set_split_download)
+    settings_menu.add_command(label="Parallel Jobs", command=set_parallel_jobs)
+    settings_menu.add_command(label="Live Recording", command=set_live_recording)
+    settings_menu.add_command(label="Bandwidth Limit", command=set_bandwidth_limit)
+    settings_menu.add_command(label="Metrics Endpoint", command=set_metrics_port)
     settings_menu.add_separator()
     settings_menu.add_checkbutton(label="Use Original Filenames", 
                                  variable=tk.BooleanVar(value=settings.get('use_original_filenames', False)),
@@ -1003,6 +4780,15 @@ def create_menu():
     settings_menu.add_checkbutton(label="Enable Speed Monitor", 
                                  variable=tk.BooleanVar(value=settings.get('show_speed', True)),
                                  command=lambda: toggle_setting('show_speed'))
+    settings_menu.add_checkbutton(label="Adaptive Concurrency", 
+                                 variable=tk.BooleanVar(value=settings.get('adaptive_concurrency', True)),
+                                 command=lambda: toggle_setting('adaptive_concurrency'))
+    settings_menu.add_checkbutton(label="Validate Segments", 
+                                 variable=tk.BooleanVar(value=settings.get('validate_segments', True)),
+                                 command=lambda: toggle_setting('validate_segments'))
+    settings_menu.add_checkbutton(label="HTTP/2 (httpx)", 
+                                 variable=tk.BooleanVar(value=settings.get('http2', False)),
+                                 command=lambda: toggle_setting('http2'))
     menu_bar.add_cascade(label="Settings", menu=settings_menu)
     
     # 帮助菜单
@@ -1094,6 +4880,312 @@ def set_timeout():
     
     tk.Button(timeout_dialog, text="Save", command=save_timeout).pack(pady=5)
 
+def set_download_engine():
+    # 创建下载引擎设置对话框
+    engine_dialog = tk.Toplevel(root)
+    engine_dialog.title("Set Download Engine")
+    engine_dialog.geometry("320x200")
+    engine_dialog.resizable(False, False)
+    
+    engine_var = tk.StringVar(value=settings.get('download_engine', 'thread'))
+    tk.Radiobutton(engine_dialog, text="Thread pool (requests)", variable=engine_var, value='thread').pack(anchor=tk.W, padx=10)
+    tk.Radiobutton(engine_dialog, text="Async (asyncio + aiohttp)", variable=engine_var, value='async').pack(anchor=tk.W, padx=10)
+    
+    tk.Label(engine_dialog, text="Async concurrent requests (1-1000):").pack(pady=5)
+    
+    concurrency_var = tk.StringVar(value=str(settings.get('async_concurrency', 100)))
+    concurrency_entry = tk.Entry(engine_dialog, textvariable=concurrency_var, width=6)
+    concurrency_entry.pack(pady=5)
+    
+    def save_download_engine():
+        try:
+            concurrency = int(concurrency_var.get())
+            if not 1 <= concurrency <= 1000:
+                messagebox.showwarning("Invalid Value", "Please enter a number between 1 and 1000.")
+                return
+            if engine_var.get() == 'async' and aiohttp is None:
+                messagebox.showwarning("Missing Dependency", "The async engine requires aiohttp (pip install aiohttp).")
+                return
+            settings['download_engine'] = engine_var.get()
+            settings['async_concurrency'] = concurrency
+            save_settings()
+            engine_dialog.destroy()
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(engine_dialog, text="Save", command=save_download_engine).pack(pady=5)
+
+def set_streaming_output():
+    # 创建边下载边输出设置对话框
+    stream_dialog = tk.Toplevel(root)
+    stream_dialog.title("Set Streaming Output")
+    stream_dialog.geometry("360x210")
+    stream_dialog.resizable(False, False)
+    
+    mode_var = tk.StringVar(value=settings.get('streaming_output', ''))
+    tk.Radiobutton(stream_dialog, text="Off (save .ts files, merge afterwards)", variable=mode_var, value='').pack(anchor=tk.W, padx=10)
+    tk.Radiobutton(stream_dialog, text="Append to output.ts while downloading", variable=mode_var, value='ts').pack(anchor=tk.W, padx=10)
+    tk.Radiobutton(stream_dialog, text="Remux to output.mp4 while downloading", variable=mode_var, value='mp4').pack(anchor=tk.W, padx=10)
+    
+    tk.Label(stream_dialog, text="Reorder buffer limit in MB (16-4096):").pack(pady=5)
+    
+    buffer_var = tk.StringVar(value=str(settings.get('stream_buffer_mb', 256)))
+    buffer_entry = tk.Entry(stream_dialog, textvariable=buffer_var, width=6)
+    buffer_entry.pack(pady=5)
+    
+    def save_streaming_output():
+        try:
+            size = int(buffer_var.get())
+            if 16 <= size <= 4096:
+                settings['streaming_output'] = mode_var.get()
+                settings['stream_buffer_mb'] = size
+                save_settings()
+                stream_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Please enter a number between 16 and 4096.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(stream_dialog, text="Save", command=save_streaming_output).pack(pady=5)
+
+def set_merge_mode():
+    # 创建合并方式设置对话框
+    merge_dialog = tk.Toplevel(root)
+    merge_dialog.title("Set Merge Mode")
+    merge_dialog.geometry("360x320")
+    merge_dialog.resizable(False, False)
+    
+    mode_var = tk.StringVar(value=settings.get('merge_mode', 'ffmpeg'))
+    tk.Label(merge_dialog, text="Merge method:").pack(anchor=tk.W, padx=10)
+    tk.Radiobutton(merge_dialog, text="ffmpeg concat", variable=mode_var, value='ffmpeg').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(merge_dialog, text="Native concatenation (plain MPEG-TS)", variable=mode_var, value='native').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(merge_dialog, text="Parallel remux (several ffmpeg processes)", variable=mode_var, value='parallel').pack(anchor=tk.W, padx=20)
+    
+    tk.Label(merge_dialog, text="Parallel ffmpeg processes (0 = CPU count):").pack(anchor=tk.W, padx=10)
+    workers_var = tk.StringVar(value=str(settings.get('merge_workers', 0)))
+    workers_entry = tk.Entry(merge_dialog, textvariable=workers_var, width=6)
+    workers_entry.pack(anchor=tk.W, padx=20)
+    
+    format_var = tk.StringVar(value=settings.get('merge_format', 'mp4'))
+    tk.Label(merge_dialog, text="Output format:").pack(anchor=tk.W, padx=10)
+    tk.Radiobutton(merge_dialog, text="MP4", variable=format_var, value='mp4').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(merge_dialog, text="TS", variable=format_var, value='ts').pack(anchor=tk.W, padx=20)
+    
+    def save_merge_mode():
+        try:
+            workers = int(workers_var.get())
+            if 0 <= workers <= 64:
+                settings['merge_mode'] = mode_var.get()
+                settings['merge_workers'] = workers
+                settings['merge_format'] = format_var.get()
+                save_settings()
+                merge_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Please enter a number between 0 and 64.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(merge_dialog, text="Save", command=save_merge_mode).pack(pady=5)
+
+def set_variant_policy():
+    # 创建主播放列表版本选择设置对话框
+    variant_dialog = tk.Toplevel(root)
+    variant_dialog.title("Set Variant Selection")
+    variant_dialog.geometry("360x280")
+    variant_dialog.resizable(False, False)
+    
+    tk.Label(variant_dialog, text="For master playlists, download:").pack(anchor=tk.W, padx=10)
+    policy_var = tk.StringVar(value=settings.get('variant_policy', 'highest'))
+    tk.Radiobutton(variant_dialog, text="Highest bitrate", variable=policy_var, value='highest').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(variant_dialog, text="Lowest bitrate", variable=policy_var, value='lowest').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(variant_dialog, text="Closest to target height", variable=policy_var, value='resolution').pack(anchor=tk.W, padx=20)
+    tk.Radiobutton(variant_dialog, text="Best under bitrate cap", variable=policy_var, value='bandwidth').pack(anchor=tk.W, padx=20)
+    
+    tk.Label(variant_dialog, text="Target height in pixels (e.g. 720):").pack(pady=2)
+    height_var = tk.StringVar(value=str(settings.get('variant_target_height', 720)))
+    tk.Entry(variant_dialog, textvariable=height_var, width=6).pack()
+    
+    tk.Label(variant_dialog, text="Bitrate cap in kbps:").pack(pady=2)
+    kbps_var = tk.StringVar(value=str(settings.get('variant_max_kbps', 0)))
+    tk.Entry(variant_dialog, textvariable=kbps_var, width=8).pack()
+    
+    def save_variant_policy():
+        try:
+            height = int(height_var.get())
+            kbps = int(kbps_var.get())
+            if height < 0 or kbps < 0:
+                messagebox.showwarning("Invalid Value", "Please enter positive numbers.")
+                return
+            settings['variant_policy'] = policy_var.get()
+            settings['variant_target_height'] = height
+            settings['variant_max_kbps'] = kbps
+            save_settings()
+            variant_dialog.destroy()
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(variant_dialog, text="Save", command=save_variant_policy).pack(pady=5)
+
+def set_parallel_jobs():
+    # 创建同时下载任务数设置对话框
+    jobs_dialog = tk.Toplevel(root)
+    jobs_dialog.title("Set Parallel Jobs")
+    jobs_dialog.geometry("340x180")
+    jobs_dialog.resizable(False, False)
+    
+    tk.Label(jobs_dialog, text="Videos downloaded at the same time (1-10):").pack(pady=2)
+    jobs_var = tk.StringVar(value=str(settings.get('max_jobs', 3)))
+    tk.Entry(jobs_dialog, textvariable=jobs_var, width=6).pack()
+    
+    tk.Label(jobs_dialog, text="Connections shared by all downloads (1-200):").pack(pady=2)
+    connections_var = tk.StringVar(value=str(settings.get('max_connections', 20)))
+    tk.Entry(jobs_dialog, textvariable=connections_var, width=6).pack()
+    
+    def save_parallel_jobs():
+        try:
+            jobs = int(jobs_var.get())
+            connections = int(connections_var.get())
+            if 1 <= jobs <= 10 and 1 <= connections <= 200:
+                settings['max_jobs'] = jobs
+                settings['max_connections'] = connections
+                save_settings()
+                # 已经创建的调度器立即使用新的设置
+                if job_scheduler is not None:
+                    job_scheduler.resize(connections, jobs)
+                jobs_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Please enter values within the allowed ranges.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(jobs_dialog, text="Save", command=save_parallel_jobs).pack(pady=5)
+
+def set_split_download():
+    # 创建大片段拆分下载设置对话框
+    split_dialog = tk.Toplevel(root)
+    split_dialog.title("Set Large Segment Split")
+    split_dialog.geometry("340x180")
+    split_dialog.resizable(False, False)
+    
+    tk.Label(split_dialog, text="Connections per large segment (1 = off):").pack(pady=2)
+    connections_var = tk.StringVar(value=str(settings.get('split_connections', 4)))
+    tk.Entry(split_dialog, textvariable=connections_var, width=6).pack()
+    
+    tk.Label(split_dialog, text="Split segments larger than (MB):").pack(pady=2)
+    threshold_var = tk.StringVar(value=str(settings.get('split_threshold_mb', 32)))
+    tk.Entry(split_dialog, textvariable=threshold_var, width=6).pack()
+    
+    def save_split_download():
+        try:
+            connections = int(connections_var.get())
+            threshold = int(threshold_var.get())
+            if 1 <= connections <= 16 and threshold >= 1:
+                settings['split_connections'] = connections
+                settings['split_threshold_mb'] = threshold
+                save_settings()
+                split_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Connections must be between 1 and 16, threshold at least 1 MB.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(split_dialog, text="Save", command=save_split_download).pack(pady=5)
+
+def set_live_recording():
+    # 创建直播录制设置对话框
+    live_dialog = tk.Toplevel(root)
+    live_dialog.title("Set Live Recording")
+    live_dialog.geometry("340x200")
+    live_dialog.resizable(False, False)
+    
+    record_var = tk.BooleanVar(value=settings.get('live_record', False))
+    tk.Checkbutton(live_dialog, text="Record live playlists (no EXT-X-ENDLIST)", variable=record_var).pack(pady=2)
+    
+    tk.Label(live_dialog, text="Stop after minutes (0 = until the stream ends):").pack(pady=2)
+    minutes_var = tk.StringVar(value=str(settings.get('live_max_minutes', 0)))
+    tk.Entry(live_dialog, textvariable=minutes_var, width=6).pack()
+    
+    tk.Label(live_dialog, text="Stop after MB (0 = no limit):").pack(pady=2)
+    size_var = tk.StringVar(value=str(settings.get('live_max_mb', 0)))
+    tk.Entry(live_dialog, textvariable=size_var, width=6).pack()
+    
+    def save_live_recording():
+        try:
+            minutes = int(minutes_var.get())
+            size = int(size_var.get())
+            if minutes >= 0 and size >= 0:
+                settings['live_record'] = record_var.get()
+                settings['live_max_minutes'] = minutes
+                settings['live_max_mb'] = size
+                save_settings()
+                live_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Limits cannot be negative.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(live_dialog, text="Save", command=save_live_recording).pack(pady=5)
+
+def set_bandwidth_limit():
+    # 创建带宽上限设置对话框，保存后正在进行的下载立即使用新的上限
+    limit_dialog = tk.Toplevel(root)
+    limit_dialog.title("Set Bandwidth Limit")
+    limit_dialog.geometry("340x180")
+    limit_dialog.resizable(False, False)
+    
+    tk.Label(limit_dialog, text="Total download limit in KB/s (0 = unlimited):").pack(pady=2)
+    limit_var = tk.StringVar(value=str(settings.get('bandwidth_limit_kb', 0)))
+    tk.Entry(limit_dialog, textvariable=limit_var, width=8).pack()
+    
+    tk.Label(limit_dialog, text="Burst size in KB (0 = a quarter second of the limit):").pack(pady=2)
+    burst_var = tk.StringVar(value=str(settings.get('bandwidth_burst_kb', 0)))
+    tk.Entry(limit_dialog, textvariable=burst_var, width=8).pack()
+    
+    def save_bandwidth_limit():
+        try:
+            limit = int(limit_var.get())
+            burst = int(burst_var.get())
+            if limit >= 0 and burst >= 0:
+                settings['bandwidth_limit_kb'] = limit
+                settings['bandwidth_burst_kb'] = burst
+                save_settings()
+                bandwidth_limiter.configure_from_settings()
+                limit_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Values cannot be negative.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+    
+    tk.Button(limit_dialog, text="Save", command=save_bandwidth_limit).pack(pady=5)
+
+def set_metrics_port():
+    # 创建指标接口设置对话框，保存后立即在新端口上启动（0为关闭）
+    metrics_dialog = tk.Toplevel(root)
+    metrics_dialog.title("Set Metrics Endpoint")
+    metrics_dialog.geometry("340x130")
+    metrics_dialog.resizable(False, False)
+    
+    tk.Label(metrics_dialog, text="Local port for /metrics and /metrics.json (0 = off):").pack(pady=5)
+    port_var = tk.StringVar(value=str(settings.get('metrics_port', 0)))
+    tk.Entry(metrics_dialog, textvariable=port_var, width=8).pack()
+    
+    def save_metrics_port():
+        try:
+            port = int(port_var.get())
+            if 0 <= port <= 65535:
+                start_metrics_server(port)
+                settings['metrics_port'] = port
+                save_settings()
+                metrics_dialog.destroy()
+            else:
+                messagebox.showwarning("Invalid Value", "Port must be between 0 and 65535.")
+        except ValueError:
+            messagebox.showwarning("Invalid Value", "Please enter a valid number.")
+        except OSError as e:
+            messagebox.showwarning("Invalid Value", f"Could not listen on port {port_var.get()}: {e}")
+    
+    tk.Button(metrics_dialog, text="Save", command=save_metrics_port).pack(pady=5)
+
 def toggle_setting(setting):
     # 创建设置切换对话框
     toggle_dialog = tk.Toplevel(root)
@@ -1106,6 +5198,10 @@ def toggle_setting(setting):
     def save_toggle():
         settings[setting] = not settings[setting]
         save_settings()
+        if setting == 'http2':
+            if settings['http2'] and httpx is None:
+                messagebox.showwarning("Warning", "HTTP/2 needs httpx with HTTP/2 support: pip install httpx[http2]")
+            reset_http_session()
         toggle_dialog.destroy()
     
     tk.Button(toggle_dialog, text="Toggle", command=save_toggle).pack(pady=5)
@@ -1122,8 +5218,13 @@ def show_help():
     Tips:
     - The program will automatically skip already downloaded files.
     - Make sure ffmpeg is installed on your system.
-    - If you get a "URL has expired" error, you need to get a fresh URL from the source.
-      These URLs often contain authentication tokens that expire after some time.
+    - Expired segment URLs are refreshed automatically: when several segments in a row
+      fail with 401/403/410, the playlist is fetched again and the download continues
+      with the new URLs (token_refresh, token_refresh_failures and token_refresh_limit
+      in settings.json).
+    - If the playlist URL itself has expired, the job waits token_refresh_wait seconds
+      (default 120) for a fresh one: paste the new URL and click "Start Download" with
+      the same save directory, or write it into refresh_url.txt in the save directory.
     """
     
     help_dialog = tk.Toplevel(root)
@@ -1149,10 +5250,6 @@ def show_about():
     
     messagebox.showinfo("About", about_text)
 
-# 在GUI设置中添加新按钮
-button_new = tk.Button(frame, text="New Download", command=new_download)
-button_new.grid(row=2, column=0, pady=10)
-
 def open_file(file_path):
     """打开指定的文件"""
     try:
@@ -1166,7 +5263,389 @@ def open_file(file_path):
     except Exception as e:
         messagebox.showerror("Error", f"Could not open file: {str(e)}")
 
-root.mainloop()
+def build_gui():
+    """创建主窗口和所有控件"""
+    global root, frame, entry_url, entry_save_path, button_browse, button_start, button_merge
+    global progress_bar, progress_label, status_label, status_text, button_new, ui_updates
+    
+    # GUI setup
+    root = tk.Tk()
+    root.title("TS to MP4 Downloader")
+
+    frame = tk.Frame(root)
+    frame.pack(padx=10, pady=10)
+
+    label_url = tk.Label(frame, text="M3U8 URL:")
+    label_url.grid(row=0, column=0, sticky=tk.W)
+
+    entry_url = tk.Entry(frame, width=50)
+    entry_url.grid(row=0, column=1)
+
+    label_save_path = tk.Label(frame, text="Save Path:")
+    label_save_path.grid(row=1, column=0, sticky=tk.W)
 
+    entry_save_path = tk.Entry(frame, width=50)
+    entry_save_path.grid(row=1, column=1)
 
+    button_browse = tk.Button(frame, text="Browse", command=browse_save_path)
+    button_browse.grid(row=1, column=2)
+
+    button_start = tk.Button(frame, text="Start Download", command=start_download)
+    button_start.grid(row=2, column=1, pady=10)
+
+    button_merge = tk.Button(frame, text="Merge to MP4", command=merge_to_mp4)
+    button_merge.grid(row=2, column=2, pady=10)
+
+    # Progress Bar
+    progress_bar = ttk.Progressbar(frame, orient="horizontal", length=300, mode="determinate")
+    progress_bar.grid(row=3, column=0, columnspan=3, pady=10)
+
+    # Progress Label
+    progress_label = tk.Label(frame, text="0/0")
+    progress_label.grid(row=3, column=3, pady=10)
+
+    # Status Text Area
+    status_label = tk.Label(frame, text="Status Log:")
+    status_label.grid(row=4, column=0, sticky=tk.W)
+
+    status_text = scrolledtext.ScrolledText(frame, width=80, height=10, state=tk.DISABLED)
+    status_text.grid(row=5, column=0, columnspan=4, pady=10)
+
+    # 在GUI设置中添加新按钮
+    button_new = tk.Button(frame, text="New Download", command=new_download)
+    button_new.grid(row=2, column=0, pady=10)
+    
+    ui_updates = UiUpdateQueue(settings.get('status_log_lines', 1000), settings.get('status_log_file', ''))
+    ui_updates.start(root, settings.get('ui_refresh_hz', 10), append_status_lines, show_job_progress)
+    
+    create_menu()
+
+def read_job_list(source):
+    """读取批量任务列表，每行一个URL，可选第二列为保存子目录名
+
+    行末可以加 weight=<权重> 和 priority=<优先级>，用于多个任务同时运行时的调度；
+    返回 [(URL, 目录名, 权重, 优先级)]，权重或优先级无效时抛出 ValueError（说明中带行号）
+    """
+    if source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        # 跳过注释行和空行
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        url = parts.pop(0)
+        weight = 1.0
+        priority = 0
+        while parts and '=' in parts[-1]:
+            key, _, value = parts[-1].partition('=')
+            try:
+                if key == 'weight':
+                    weight = float(value)
+                    if not math.isfinite(weight) or weight <= 0:
+                        raise ValueError
+                elif key == 'priority':
+                    priority = int(value)
+                else:
+                    break
+            except ValueError:
+                kind = 'a positive number' if key == 'weight' else 'an integer'
+                raise ValueError(f"line {number}: invalid {key} '{value}', expected {kind}") from None
+            parts.pop()
+        name = ' '.join(parts) if parts else suggest_directory_name(url)
+        jobs.append((url, name, weight, priority))
+    return jobs
+
+def run_job(url, save_path, status_callback, progress_callback, merge=False, share=None):
+    """无界面执行单个任务：下载播放列表、下载TS片段，可选合并为MP4
+
+    share 为 JobScheduler 分配的连接配额，多个任务同时运行时使用
+    """
+    normalized_url = normalize_m3u8_url(url)
+    if not normalized_url:
+        status_callback(f"Invalid URL format: {url}")
+        return False
+    
+    # 创建保存目录；目录已存在时直接续传
+    os.makedirs(save_path, exist_ok=True)
+    
+    status_callback(f"Downloading playlist from: {normalized_url}")
+    media_url = download_m3u8(normalized_url, save_path, status_callback)
+    if not media_url:
+        status_callback("Failed to download playlist.")
+        return False
+    
+    if not download_ts_files(media_url, save_path, progress_callback, status_callback, share):
+        status_callback("Download failed or was interrupted.")
+        return False
+    
+    if merge and settings.get('streaming_output'):
+        # 边下载边输出模式下输出文件已经生成，不需要再合并
+        return True
+    
+    if merge:
+        output_file = os.path.join(save_path, f"output.{settings.get('merge_format', 'mp4')}")
+        ts_files, missing = merge_file_list(save_path, exclude=(os.path.basename(output_file),))
+        if missing:
+            status_callback(f"Not merging: {describe_missing(missing, len(ts_files) + len(missing))}.")
+            return False
+        status_callback(f"Merging {len(ts_files)} TS files into {output_file}")
+        if not merge_ts_files(save_path, ts_files, output_file, status_callback):
+            status_callback("Merge failed.")
+            return False
+        status_callback("Merge completed successfully.")
+    return True
+
+def run_cli(argv=None):
+    """命令行批量模式入口，不创建任何Tk对象"""
+    parser = argparse.ArgumentParser(
+        description="Download m3u8/ts videos in batch without the GUI."
+    )
+    parser.add_argument('-i', '--input', default='-',
+                        help="file with one URL per line, optionally followed by a directory name ('-' reads stdin, default)")
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help="directory under which one sub-directory per job is created")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of jobs downloaded at the same time (default: max_jobs from settings.json)")
+    parser.add_argument('--connections', type=int,
+                        help="segment requests in flight across all running jobs (default: max_connections from settings.json)")
+    parser.add_argument('-t', '--threads', type=int,
+                        help="number of download threads (default: max_threads from settings.json)")
+    parser.add_argument('-e', '--engine', choices=('thread', 'async'),
+                        help="segment download engine (default: download_engine from settings.json)")
+    parser.add_argument('-c', '--concurrency', type=int,
+                        help="concurrent requests for the async engine (default: async_concurrency from settings.json)")
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help="always use the full thread/concurrency count instead of adapting it to the server")
+    parser.add_argument('--variant', choices=('highest', 'lowest', 'resolution', 'bandwidth'),
+                        help="which variant of a master playlist to download (default: variant_policy from settings.json)")
+    parser.add_argument('--target-height', type=int,
+                        help="with --variant resolution: pick the variant closest to this height, e.g. 720")
+    parser.add_argument('--max-kbps', type=int,
+                        help="with --variant bandwidth: pick the best variant at or below this bitrate")
+    parser.add_argument('--split-connections', type=int,
+                        help="parallel connections per large segment, 1 disables splitting (default: split_connections from settings.json)")
+    parser.add_argument('--split-threshold-mb', type=int,
+                        help="segments at least this large are split across connections (default: split_threshold_mb from settings.json)")
+    parser.add_argument('--http2', action='store_true',
+                        help="fetch https segments over HTTP/2, multiplexing requests per host (needs httpx[http2])")
+    parser.add_argument('--no-validate', action='store_true',
+                        help="do not check downloaded segments for MPEG-TS packet structure")
+    parser.add_argument('--live', action='store_true',
+                        help="record live playlists (no EXT-X-ENDLIST) until the stream ends, a limit is reached or Ctrl+C")
+    parser.add_argument('--live-minutes', type=int,
+                        help="with --live: stop recording after this many minutes")
+    parser.add_argument('--live-max-mb', type=int,
+                        help="with --live: stop recording after this many MB")
+    parser.add_argument('--limit-rate',
+                        help="total download bandwidth across all jobs, e.g. 500K or 2M per second; "
+                             f"change it while running by writing a new value to {BandwidthLimiter.CONTROL_FILE} in the output directory")
+    parser.add_argument('--burst',
+                        help="with --limit-rate: token bucket size, e.g. 1M (default: a quarter second of the limit)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics and a JSON snapshot on /metrics.json "
+                             "(default: metrics_port from settings.json, 0 = off)")
+    parser.add_argument('-s', '--stream', choices=('ts', 'mp4'),
+                        help="write segments into output.ts/output.mp4 while downloading instead of saving separate .ts files")
+    parser.add_argument('-m', '--merge', action='store_true',
+                        help="merge each job to output.mp4 (or output.ts, see --merge-format) after its download completes")
+    parser.add_argument('--merge-mode', choices=('ffmpeg', 'native', 'parallel'),
+                        help="ffmpeg concat demuxer, native kernel-side concatenation of the segments, "
+                             "or parallel remux of segment groups by several ffmpeg processes")
+    parser.add_argument('--merge-workers', type=int,
+                        help="ffmpeg processes for --merge-mode parallel (default: merge_workers from settings.json, 0 = CPU count)")
+    parser.add_argument('--merge-format', choices=('mp4', 'ts'),
+                        help="container of the merged file (ts with --merge-mode native needs no ffmpeg)")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="only print job start/finish lines")
+    args = parser.parse_args(argv)
+    
+    if args.jobs is not None:
+        if args.jobs < 1:
+            parser.error("--jobs must be at least 1")
+        settings['max_jobs'] = args.jobs
+    if args.connections is not None:
+        if args.connections < 1:
+            parser.error("--connections must be at least 1")
+        settings['max_connections'] = args.connections
+    if args.threads is not None:
+        if args.threads < 1:
+            parser.error("--threads must be at least 1")
+        settings['max_threads'] = args.threads
+    if args.concurrency is not None:
+        if args.concurrency < 1:
+            parser.error("--concurrency must be at least 1")
+        settings['async_concurrency'] = args.concurrency
+    if args.engine:
+        settings['download_engine'] = args.engine
+    if args.fixed_concurrency:
+        settings['adaptive_concurrency'] = False
+    if args.no_validate:
+        settings['validate_segments'] = False
+    if args.http2:
+        if httpx is None:
+            parser.error("--http2 needs httpx with HTTP/2 support: pip install httpx[http2]")
+        settings['http2'] = True
+        reset_http_session()
+    if args.split_connections is not None:
+        if args.split_connections < 1:
+            parser.error("--split-connections must be at least 1")
+        settings['split_connections'] = args.split_connections
+    if args.split_threshold_mb is not None:
+        if args.split_threshold_mb < 1:
+            parser.error("--split-threshold-mb must be at least 1")
+        settings['split_threshold_mb'] = args.split_threshold_mb
+    
+    try:
+        if args.limit_rate is not None:
+            settings['bandwidth_limit_kb'] = parse_byte_size(args.limit_rate) // 1024
+        if args.burst is not None:
+            settings['bandwidth_burst_kb'] = parse_byte_size(args.burst) // 1024
+    except ValueError:
+        parser.error("--limit-rate and --burst take a size such as 500K or 2M")
+    bandwidth_limiter.configure_from_settings()
+    # 运行中修改限速：把新的上限写入输出目录中的控制文件
+    bandwidth_limiter.watch(os.path.join(args.output_dir, BandwidthLimiter.CONTROL_FILE))
+    
+    if args.live:
+        settings['live_record'] = True
+    if args.live_minutes is not None:
+        settings['live_max_minutes'] = args.live_minutes
+    if args.live_max_mb is not None:
+        settings['live_max_mb'] = args.live_max_mb
+    
+    if args.stream:
+        settings['streaming_output'] = args.stream
+    if args.variant:
+        settings['variant_policy'] = args.variant
+    if args.target_height:
+        settings['variant_target_height'] = args.target_height
+    if args.max_kbps:
+        settings['variant_max_kbps'] = args.max_kbps
+    
+    if args.merge_mode:
+        settings['merge_mode'] = args.merge_mode
+    if args.merge_workers is not None:
+        if args.merge_workers < 0:
+            parser.error("--merge-workers must not be negative")
+        settings['merge_workers'] = args.merge_workers
+    if args.merge_format:
+        settings['merge_format'] = args.merge_format
+    
+    # 原生模式合并为 .ts 时完全不需要ffmpeg
+    merge_needs_ffmpeg = args.merge and not (
+        settings.get('merge_mode') == 'native' and settings.get('merge_format') == 'ts'
+    )
+    if (merge_needs_ffmpeg or settings.get('streaming_output') == 'mp4') and not check_ffmpeg():
+        print("Error: ffmpeg is not installed or not in PATH. It is required for --merge and --stream mp4.", file=sys.stderr)
+        return 2
+    
+    metrics_port = args.metrics_port if args.metrics_port is not None else settings.get('metrics_port', 0)
+    if metrics_port:
+        try:
+            port = start_metrics_server(metrics_port)
+        except OSError as e:
+            print(f"Error: could not start the metrics endpoint on port {metrics_port}: {e}", file=sys.stderr)
+            return 2
+        if not args.quiet:
+            print(f"Metrics: http://127.0.0.1:{port}/metrics", flush=True)
+    
+    try:
+        jobs = read_job_list(args.input)
+    except OSError as e:
+        print(f"Error: could not read job list: {e}", file=sys.stderr)
+        return 2
+    except ValueError as e:
+        print(f"Error: job list {e}", file=sys.stderr)
+        return 2
+    
+    if not jobs:
+        print("No URLs to download.", file=sys.stderr)
+        return 0
+    
+    # 所有任务交给调度器，同时运行的任务共用 max_connections 个连接
+    scheduler = JobScheduler(
+        settings.get('max_connections', 20),
+        settings.get('max_jobs', 3),
+        status_callback=None if args.quiet else lambda message: print(message, flush=True)
+    )
+    failed_jobs = []
+    
+    def run_scheduled(share, url, save_path, prefix, update_status, update_progress):
+        print(f"{prefix} {url} -> {save_path}", flush=True)
+        try:
+            ok = run_job(url, save_path, update_status, update_progress, merge=args.merge, share=share)
+        except Exception as e:
+            update_status(f"An error occurred: {str(e)}")
+            ok = False
+        
+        print(f"{prefix} {'Done' if ok else 'FAILED'}: {url}", flush=True)
+        if not ok:
+            failed_jobs.append(url)
+    
+    for n, (url, name, weight, priority) in enumerate(jobs, 1):
+        prefix = f"[{n}/{len(jobs)}]"
+        save_path = os.path.join(args.output_dir, name)
+        
+        def update_status(message, prefix=prefix):
+            if not args.quiet:
+                print(f"{prefix} {message}", flush=True)
+        
+        # 进度输出限流，避免片段很多时刷屏
+        last_progress = [0.0]
+        def update_progress(success_count, total_count, prefix=prefix, last_progress=last_progress):
+            now = time.time()
+            if args.quiet or (now - last_progress[0] < 1 and success_count < total_count):
+                return
+            last_progress[0] = now
+            print(f"{prefix} Progress: {success_count}/{total_count}", flush=True)
+        
+        job_args = (url, save_path, prefix, update_status, update_progress)
+        scheduler.submit(lambda share, job_args=job_args: run_scheduled(share, *job_args),
+                         f"{prefix} {name}", weight, priority)
+    
+    try:
+        scheduler.wait()
+    except KeyboardInterrupt:
+        # Ctrl+C 结束直播录制：已经开始的片段下载完成并写入播放列表后退出
+        print("Stopping live recordings...", flush=True)
+        stop_live_recordings()
+        scheduler.wait()
+    print(f"{len(jobs) - len(failed_jobs)}/{len(jobs)} jobs succeeded.", flush=True)
+    return 1 if failed_jobs else 0
+
+def main():
+    global gui_mode
+    load_settings()
+    reset_http_session()
+    bandwidth_limiter.configure_from_settings()
+    
+    # 带命令行参数时进入批量模式，否则启动图形界面
+    if len(sys.argv) > 1:
+        sys.exit(run_cli())
+    
+    if tk is None:
+        print("Error: tkinter is not available. Use the command-line mode instead (see --help).", file=sys.stderr)
+        sys.exit(1)
+    
+    # 程序启动时检查
+    if not check_ffmpeg():
+        messagebox.showerror("Error", "ffmpeg is not installed or not in PATH. Please install ffmpeg to use this program.")
+        sys.exit(1)
+    
+    gui_mode = True
+    build_gui()
+    if settings.get('metrics_port'):
+        try:
+            start_metrics_server(settings['metrics_port'])
+        except OSError as e:
+            show_error(f"Could not start the metrics endpoint on port {settings['metrics_port']}: {e}")
+    root.mainloop()
 
+if __name__ == '__main__':
+    main()